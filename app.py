@@ -1,5 +1,8 @@
 import streamlit as st
 import requests
+import json
+import time
+import uuid
 import os
 
 # === FastAPI Backend URL ===
@@ -13,6 +16,13 @@ st.set_page_config(
 )
 
 
+def get_session_id():
+    """Stable id for this browser session, so the backend keeps our own history"""
+    if "session_id" not in st.session_state:
+        st.session_state["session_id"] = uuid.uuid4().hex
+    return st.session_state["session_id"]
+
+
 def get_uploaded_pdfs():
     """Fetch list of uploaded PDFs from FastAPI"""
     try:
@@ -28,15 +38,16 @@ def get_uploaded_pdfs():
 
 
 def upload_pdf(file, overwrite=False):
-    """Upload a PDF to FastAPI"""
+    """Upload a PDF to FastAPI and follow its ingestion job"""
     try:
         response = requests.post(
             f"{API_URL}/upload_pdf",
             files={"file": (file.name, file.getvalue())},
             params={"overwrite": overwrite},
         )
-        if response.status_code == 200:
-            st.success(f"{response.json()['message']}")
+        if response.status_code in (200, 202):
+            st.info(f"{response.json()['message']}")
+            wait_for_job(response.json()["job_id"])
         elif response.status_code == 409:
             st.warning(f"{response.json()['detail']}")
         else:
@@ -44,12 +55,47 @@ def upload_pdf(file, overwrite=False):
     except Exception as e:
         st.error(f" Upload failed: {e}")
 
-def chat_with_pdf(pdf_name, question):
+def wait_for_job(job_id, interval=1.0):
+    """Poll /jobs/{id} and render ingestion progress until the job finishes"""
+    status_line = st.empty()
+    bar = st.progress(0)
+    while True:
+        try:
+            response = requests.get(f"{API_URL}/jobs/{job_id}")
+        except Exception as e:
+            st.error(f" Could not connect to backend: {e}")
+            return
+        if response.status_code != 200:
+            st.error(f" {response.json().get('detail', 'Failed to fetch job status')}")
+            return
+
+        job = response.json()
+        if job["chunks_total"]:
+            bar.progress(min(job["chunks_embedded"] / job["chunks_total"], 1.0))
+        status_line.write(
+            f"Stage: **{job['stage']}** | pages parsed: {job['pages_parsed']} | "
+            f"chunks embedded: {job['chunks_embedded']}/{job['chunks_total']} | "
+            f"bytes saved: {job['bytes_saved']}"
+        )
+
+        if job["status"] == "succeeded":
+            bar.progress(1.0)
+            st.success(f" PDF '{job['filename']}' processed successfully.")
+            return
+        if job["status"] == "failed":
+            st.error(f" Failed to process PDF: {job['error']}")
+            return
+        time.sleep(interval)
+
+def chat_with_pdf(pdf_name, question, strategy=None):
     """Send a chat query to FastAPI"""
     try:
+        data = {"question": question, "session_id": get_session_id()}
+        if strategy:
+            data["strategy"] = strategy
         response = requests.post(
             f"{API_URL}/chat/{pdf_name}",
-            data={"question": question},
+            data=data,
         )
         if response.status_code == 200:
             return response.json()["answer"]
@@ -60,6 +106,34 @@ def chat_with_pdf(pdf_name, question):
         st.error(f" Could not connect to backend: {e}")
         return None
     
+def stream_chat_with_pdf(pdf_name, question, strategy=None):
+    """Yield answer tokens from the SSE endpoint as they arrive"""
+    data = {"question": question, "session_id": get_session_id()}
+    if strategy:
+        data["strategy"] = strategy
+    try:
+        with requests.post(
+            f"{API_URL}/chat/{pdf_name}/stream",
+            data=data,
+            stream=True,
+        ) as response:
+            if response.status_code != 200:
+                st.error(f" {response.json().get('detail', 'Failed to get response')}")
+                return
+            event = "message"
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    payload = json.loads(line[len("data:"):].strip())
+                    if event == "token":
+                        yield payload["token"]
+                    elif event == "error":
+                        st.error(f" {payload['detail']}")
+                        return
+    except Exception as e:
+        st.error(f" Could not connect to backend: {e}")
+
 def delete_pdf(filename):
     """Delete a PDF and its vectorstore"""
     try:
@@ -107,7 +181,7 @@ def main():
         overwrite = st.checkbox("Overwrite if file already exists?", value=False)
 
         if st.button("Upload PDF"):
-            with st.spinner("Uploading and processing..."):
+            with st.spinner("Uploading..."):
                 try:
                     
                     uploaded_file.seek(0)
@@ -124,17 +198,28 @@ def main():
             st.info("No PDFs found. Please upload a PDF first.")
         else:
             selected_pdf = st.selectbox("Select a PDF", pdf_files)
+            strategy = st.selectbox(
+                "Retrieval strategy",
+                ["hybrid", "multi_query", "expand", "mmr"],
+                help="hybrid mixes keyword and semantic search; multi_query adds an extra LLM call.",
+            )
             st.write(f"Chatting with: `{selected_pdf}`")
 
             # Chat interface
             user_question = st.text_input("Ask a question about the PDF")
+            stream = st.checkbox("Stream answer", value=True)
             if st.button("Ask"):
                 if user_question.strip():
-                    with st.spinner(" Thinking..."):
-                        answer = chat_with_pdf(selected_pdf, user_question)
-                        if answer:
-                            st.markdown(f"**You:** {user_question}")
-                            st.markdown(f"**StudyMate AI:** {answer}")
+                    if stream:
+                        st.markdown(f"**You:** {user_question}")
+                        st.markdown("**StudyMate AI:**")
+                        st.write_stream(stream_chat_with_pdf(selected_pdf, user_question, strategy))
+                    else:
+                        with st.spinner(" Thinking..."):
+                            answer = chat_with_pdf(selected_pdf, user_question, strategy)
+                            if answer:
+                                st.markdown(f"**You:** {user_question}")
+                                st.markdown(f"**StudyMate AI:** {answer}")
                 else:
                     st.warning("Please enter a question.")
 
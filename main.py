@@ -1,23 +1,55 @@
+import time
+IMPORT_STARTED = time.perf_counter()  # cold-start timing, reported by /ready
 import os
+import sys
 import shutil
+import json
+import asyncio
 import uvicorn
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, status, Query, Path
+from fastapi.responses import StreamingResponse, Response, JSONResponse
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 from typing import List
 
 
-from tools.pdf_tool import process_pdf_and_create_vectorstore
-from tools.chat_engine import build_chat_model
+from tools.pdf_tool import process_pdf_and_create_vectorstore, append_pdf_to_vectorstore
+from tools import pdf_extract
+from tools.chat_engine import build_chat_model, build_answer_chain, load_faiss_index, index_version, get_llm
+from tools.collection import CollectionRegistry, search_collection, format_attributed_context
+from tools.context import pack_documents, pack_context
+from tools.retrieval import resolve_strategy, retrieval_latency, retrieve_batch
+from tools.answer_cache import answer_cache, query_embedding_cache, answer_key, invalidate_pdf, SingleFlight, get_query_embeddings
+from tools.jobs import JobQueue, JobStore, QueueFullError
+from tools.session_cache import SessionCache, estimate_vector_store_bytes
+from tools.memory import get_conversation_memory, conversation_turn, recently_chatted_pdfs
+from tools.metrics import Trace, use_trace, span, record_cache, prometheus_payload, HTTP_SECONDS
+from tools.segments import Compactor, read_manifest, store_version, delete_source
+from tools.embedding_cache import get_cached_embeddings
+from tools.uploads import ContentIndex, UploadTooLargeError, stream_to_disk, link_or_move, fork_store, MAX_UPLOAD_BYTES
+from tools.storage import StorageManager
 from dotenv import load_dotenv
 
 load_dotenv()
 # Directories for PDF and Vectorstore
 TEMP_DIR = "temp/"
+SUPPLEMENTS_DIR = os.path.join(TEMP_DIR, "supplements/")  # supplements/<pdf stem>/<file>
 VECTORSTORE_DIR = "vectorstore/"
 os.makedirs(TEMP_DIR, exist_ok=True)
 os.makedirs(VECTORSTORE_DIR, exist_ok=True)
 
+# Concurrency (override via .env): threads for blocking work per worker, worker processes
+CHAT_THREADS = int(os.getenv("CHAT_THREADS", "32"))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", str(min(4, os.cpu_count() or 1))))
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", "cache/prometheus/")
+# Indexes loaded in the background at startup, most recently chatted with first; 0 disables (override via .env)
+PREWARM_INDEXES = int(os.getenv("PREWARM_INDEXES", "4"))
+# Batch chat (override via .env): questions per request, generations in flight at once
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "200"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
 # Response Models
 class APIMessage(BaseModel):
     message: str
@@ -29,6 +61,28 @@ class ChatResponse(BaseModel):
     pdf_name: str
     question: str
     answer: str
+    cached: bool = False
+    retrieval_strategy: str | None = None
+    retrieval_ms: float | None = None
+    context_tokens: int | None = None
+    context_tokens_saved: int | None = None
+    timings: dict | None = None
+
+class BatchChatRequest(BaseModel):
+    questions: List[str]
+    include_timings: bool = False
+
+class ReadinessInfo(BaseModel):
+    ready: bool
+    import_seconds: float
+    startup_seconds: float | None = None
+    prewarm_total: int = 0
+    prewarm_loaded: int = 0
+
+class StorageInfo(BaseModel):
+    usage_bytes: int
+    quota_bytes: int | None = None
+    documents: List[dict]
 
 class AboutInfo(BaseModel):
     project_name: str
@@ -39,15 +93,178 @@ class AboutInfo(BaseModel):
 class PDFList(BaseModel):
     files: list[str]
 
+class CacheStats(BaseModel):
+    entries: int
+    bytes: int
+    max_bytes: int
+    hits: int
+    misses: int
+    evictions: int
+    resident: list[str]
+    query_embeddings: dict
+    answers: dict
+    coalesced_requests: int
+
+class CollectionDefinition(BaseModel):
+    pdfs: list[str]
+
+class CollectionInfo(BaseModel):
+    name: str
+    pdfs: list[str]
+
+class CollectionList(BaseModel):
+    collections: list[CollectionInfo]
+
+class SourceChunk(BaseModel):
+    pdf_name: str
+    page: int | None = None
+    score: float | None = None
+    content: str
+
+class CollectionSearchResponse(BaseModel):
+    collection: str
+    question: str
+    results: list[SourceChunk]
+    timings: dict
+
+class CollectionChatResponse(BaseModel):
+    collection: str
+    question: str
+    answer: str
+    sources: list[SourceChunk]
+    timings: dict
+
+class RetrievalStats(BaseModel):
+    strategies: dict
+
+class JobAccepted(BaseModel):
+    job_id: str
+    message: str
+    status_url: str
+    deduplicated: bool = False
+
+class SegmentInfo(BaseModel):
+    name: str
+    chunks: int | None = None
+    tombstones: int
+
+class SegmentList(BaseModel):
+    pdf_name: str
+    version: str
+    segments: list[SegmentInfo]
+
+class JobStatus(BaseModel):
+    job_id: str
+    filename: str
+    status: str
+    stage: str
+    pages_parsed: int
+    chunks_total: int
+    chunks_embedded: int
+    bytes_saved: int
+    boilerplate_lines: int = 0
+    chunks_deduplicated: int = 0
+    tokens_saved: int = 0
+    error: str | None = None
+    timings: dict | None = None
+    created_at: float
+    updated_at: float
+
+# Startup progress of this worker process, reported by /ready
+startup = {"ready": False, "startup_seconds": None, "prewarm_total": 0, "prewarm_loaded": 0}
+
+def prewarm_indexes(limit: int):
+    """Import the LLM / embedding clients and load the most recently used indexes."""
+    try:
+        with span("prewarm_clients", pipeline="startup"):
+            get_llm()
+            get_query_embeddings()
+        names = []
+        for stem in recently_chatted_pdfs(limit * 2):
+            name = content_index.resolve(f"{stem}.pdf")
+            if name not in names and os.path.isdir(os.path.join(VECTORSTORE_DIR, os.path.splitext(name)[0])):
+                names.append(name)
+        if len(names) < limit:
+            # Never chatted with (or history cleared): newest indexes on disk
+            stems = sorted(
+                (entry for entry in os.scandir(VECTORSTORE_DIR) if entry.is_dir()),
+                key=lambda entry: entry.stat().st_mtime, reverse=True
+            )
+            names += [name for name in (f"{entry.name}.pdf" for entry in stems) if name not in names]
+        names = names[:limit]
+        startup["prewarm_total"] = len(names)
+        for name in names:
+            try:
+                with span("prewarm_index", pipeline="startup"):
+                    chat_sessions.get(name)
+                startup["prewarm_loaded"] += 1
+            except Exception as e:
+                print(f" Prewarm of '{name}' failed: {e}")
+    finally:
+        mark_ready()
+
+def mark_ready():
+    startup["startup_seconds"] = time.perf_counter() - IMPORT_STARTED
+    startup["ready"] = True
+    print(f" Ready in {startup['startup_seconds']:.2f}s (imports {IMPORT_SECONDS:.2f}s, "
+          f"{startup['prewarm_loaded']}/{startup['prewarm_total']} indexes prewarmed).")
+
+# Blocking work (index loads, SQLite, sync chain steps) runs on one bounded pool per worker
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Forked before any other thread exists; ingestion threads reuse it
+    pdf_extract.start_pool()
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=CHAT_THREADS, thread_name_prefix="chat")
+    )
+    # Threads and SQLite handles are opened here rather than at import
+    await asyncio.to_thread(start_background_services)
+    # Requests are served while prewarming; /ready turns 200 once it is done
+    prewarm = asyncio.create_task(asyncio.to_thread(prewarm_indexes, PREWARM_INDEXES)) if PREWARM_INDEXES > 0 else None
+    if prewarm is None:
+        mark_ready()
+    yield
+    stop_background_services()
+    pdf_extract.shutdown_pool()
+    if prewarm is not None and not prewarm.done():
+        prewarm.cancel()
+
 # Initialize FastAPI
 app = FastAPI(
     title="StudyMate AI",
-    description="Chat with PDFs using LangChain, OpenAI, and FAISS (RAG Pipeline).",
-    version="2.1.0"
+    description="Chat with PDFs using LangChain, Gemini, and FAISS (RAG Pipeline).",
+    version="2.1.0",
+    lifespan=lifespan
 )
 
 
 
+# Request latency per route template (raw paths would explode label cardinality)
+@app.middleware("http")
+async def record_request_latency(request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    HTTP_SECONDS.labels(request.method, getattr(route, "path", "unmatched"), str(response.status_code)).observe(
+        time.perf_counter() - start
+    )
+    return response
+
+# Refuse oversized uploads from their Content-Length before the body is read
+UPLOAD_ROUTES = ("/upload_pdf", "/append_pdf/")
+MULTIPART_OVERHEAD = 64 * 1024
+
+@app.middleware("http")
+async def limit_upload_size(request, call_next):
+    length = request.headers.get("content-length")
+    if (request.method == "POST" and request.url.path.startswith(UPLOAD_ROUTES)
+            and length and length.isdigit() and int(length) > MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD):
+        return JSONResponse(
+            status_code=413,
+            content={"detail": f"Upload exceeds the {MAX_UPLOAD_BYTES // (1024 * 1024)} MB limit."}
+        )
+    return await call_next(request)
+
 # Enable CORS for frontend (Streamlit)
 app.add_middleware(
     CORSMiddleware,
@@ -58,8 +275,113 @@ app.add_middleware(
 )
 
 
-# Global dict for chat sessions per PDF
-chat_sessions = {}
+# Load a chat session for a PDF from its vectorstore folder (cache miss path)
+def load_chat_session(pdf_name: str):
+    version = index_version(pdf_name, base_dir=VECTORSTORE_DIR)
+    vector_store = load_faiss_index(pdf_name, base_dir=VECTORSTORE_DIR)
+    chat_chain, _ = build_chat_model(pdf_name=pdf_name, vector_store=vector_store)
+    session = {"chain": chat_chain, "version": version, "vector_store": vector_store}
+    return session, estimate_vector_store_bytes(vector_store)
+
+# Bounded LRU of chat sessions per PDF, rehydrated lazily from disk; the index
+# version check picks up changes made by other worker processes
+chat_sessions = SessionCache(
+    loader=load_chat_session,
+    current_version=lambda pdf_name: index_version(pdf_name, base_dir=VECTORSTORE_DIR)
+)
+
+# Named groups of PDFs searched together
+collections = CollectionRegistry()
+
+# Identical concurrent chat requests share a single generation
+chat_flights = SingleFlight()
+
+# Background ingestion: bounded queue drained by a worker pool; job status is
+# shared so any worker process can answer /jobs/{id}
+ingestion_queue: JobQueue | None = None
+
+# A compaction swaps segments; resident sessions reload the merged one lazily
+def on_store_compacted(pdf_stem: str):
+    for pdf_name in chat_sessions.stats()["resident"]:
+        if os.path.splitext(pdf_name)[0] == pdf_stem:
+            chat_sessions.invalidate(pdf_name)
+
+# Merges small segments and drops tombstoned chunks in the background
+compactor: Compactor | None = None
+
+# sha256 of every ingested PDF; byte-identical uploads link to the existing index
+content_index = ContentIndex()
+
+# Archived or evicted documents: drop what this process still holds for them
+def on_storage_change(pdf_names: list[str]):
+    for pdf_name in pdf_names:
+        chat_sessions.invalidate(pdf_name)
+        invalidate_pdf(pdf_name)
+
+def supplements_dir(pdf_name: str) -> str:
+    return os.path.join(SUPPLEMENTS_DIR, os.path.splitext(pdf_name)[0])
+
+# Evicted indexes are re-ingested from the kept upload and its supplements; every
+# supplement on disk is in the index (overwrites and deletes remove theirs)
+def rebuild_index(pdf_name: str):
+    process_pdf_and_create_vectorstore(os.path.join(TEMP_DIR, pdf_name), base_dir=VECTORSTORE_DIR)
+    supplement_dir = supplements_dir(pdf_name)
+    if os.path.isdir(supplement_dir):
+        for name in sorted(os.listdir(supplement_dir)):
+            append_pdf_to_vectorstore(os.path.join(supplement_dir, name), pdf_name, base_dir=VECTORSTORE_DIR)
+
+# Catalog of uploads (sizes, last access) under the disk quota; cold indexes are archived
+storage: StorageManager | None = None
+
+def start_background_services():
+    """Create the ingestion queue, compactor and storage manager and start their threads (from lifespan)."""
+    global ingestion_queue, compactor, storage
+    ingestion_queue = JobQueue(store=JobStore())
+    compactor = Compactor(VECTORSTORE_DIR, embeddings_factory=get_cached_embeddings, on_change=on_store_compacted)
+    storage = StorageManager(content_index, temp_dir=TEMP_DIR, vectorstore_dir=VECTORSTORE_DIR,
+                             on_change=on_storage_change, rebuild=rebuild_index)
+    storage.start()
+
+def stop_background_services():
+    storage.stop()
+    compactor.stop()
+
+def open_index(pdf_name: str) -> str:
+    """Name whose index serves pdf_name, restored or rebuilt if needed; counts as an access."""
+    owner = content_index.resolve(pdf_name)
+    if storage.ensure_index(owner):
+        for name in {owner, pdf_name}:
+            storage.record(name)
+    storage.touch(pdf_name)
+    return owner
+
+def release_pdf_index(pdf_name: str, keep: bool = False):
+    """Drop pdf_name's claim on its index; other names linked to it inherit the folder."""
+    heir = storage.release_index(pdf_name, keep=keep)
+    if heir:
+        chat_sessions.invalidate(heir)
+
+def detach_pdf_index(pdf_name: str):
+    """Give pdf_name an index of its own before it diverges from identical uploads."""
+    open_index(pdf_name)
+    other, linked = content_index.release(pdf_name)
+    if linked:
+        fork_store(VECTORSTORE_DIR, other, pdf_name)
+    elif other:
+        fork_store(VECTORSTORE_DIR, pdf_name, other)
+
+async def receive_upload(file: UploadFile, dest_path: str) -> tuple[str, int]:
+    try:
+        digest, size = await stream_to_disk(file, dest_path)
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    if size == 0:
+        os.remove(dest_path)
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Uploaded file is empty or corrupted."
+        )
+    return digest, size
 
 # Home Route
 @app.get("/", response_model=APIMessage, tags=["Home"])
@@ -75,20 +397,21 @@ async def about():
         features=[
             "Upload and process PDFs into vectorstore",
             "Context-aware chat with memory",
-            "Supports MMR and Multi-Query Retrieval",
+            "Supports MMR, local query expansion and Multi-Query Retrieval",
+            "Cross-PDF search and chat over collections",
+            "Append supplementary PDFs to an existing one without re-indexing it",
         ],
         docs_url="/docs"
     )
 
 # Upload PDF
-@app.post("/upload_pdf", response_model=APIMessage, tags=["PDF"])
+@app.post("/upload_pdf", response_model=JobAccepted, status_code=status.HTTP_202_ACCEPTED, tags=["PDF"])
 async def upload_pdf(
     file: UploadFile = File(...),
     overwrite: bool = Query(False, description="Set true to overwrite an existing PDF.")
 ):
     
     file_path = os.path.join(TEMP_DIR, file.filename)
-    pdf_folder = os.path.join(VECTORSTORE_DIR, os.path.splitext(file.filename)[0])
 
     if os.path.exists(file_path) and not overwrite:
         raise HTTPException(
@@ -96,67 +419,302 @@ async def upload_pdf(
             detail=f"File '{file.filename}' already exists. Use overwrite=true to replace it."
         )
 
-    try:
-        # Save PDF to temp directory
-        content = await file.read()
-        if not content:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Uploaded file is empty or corrupted."
-            )
-        with open(file_path, "wb") as f:
-            f.write(content)
-
-        # Process PDF into vectorstore
-        process_pdf_and_create_vectorstore(file_path, base_dir=VECTORSTORE_DIR)
+    # Stream to disk while hashing; the PDF is never held in memory as a whole
+    part_path = f"{file_path}.part"
+    digest, size = await receive_upload(file, part_path)
 
-        # Build chat session for this PDF
-        chat_chain, memory = build_chat_model(pdf_name=file.filename)
-        chat_sessions[file.filename] = {"chain": chat_chain, "memory": memory}
+    previous = None  # (backup path, digest, catalog state) of an overwritten PDF
+    if os.path.exists(file_path):
+        if (content_index.lookup(digest) or {}).get("pdf") == file.filename:
+            os.remove(part_path)  # same bytes re-uploaded under the same name
+            storage.record(file.filename)
+            job = ingestion_queue.record(file.filename, stage="unchanged")
+            return JobAccepted(
+                job_id=job.id,
+                message=f" PDF '{file.filename}' is unchanged; keeping its index.",
+                status_url=f"/jobs/{job.id}",
+                deduplicated=True
+            )
+        # Overwrite with new content: the old index keeps serving until the new one is committed
+        previous = (f"{file_path}.previous", content_index.digest_of(file.filename), storage.catalog.state(file.filename))
+        await asyncio.to_thread(release_pdf_index, file.filename, True)
 
-        return APIMessage(message=f" PDF '{file.filename}' uploaded and processed successfully.")
+    owner = content_index.claim(digest, file.filename, size)
+    if owner is not None:
+        link_or_move(part_path, os.path.join(TEMP_DIR, owner["pdf"]), file_path)
+        if previous is not None:
+            await asyncio.to_thread(storage.discard_index, file.filename)  # now served by the owner
+            shutil.rmtree(supplements_dir(file.filename), ignore_errors=True)
+        storage.record(file.filename)
+        chat_sessions.invalidate(file.filename)
+        invalidate_pdf(file.filename)
+        # Follow the owner's ingestion if it is still running
+        job = ingestion_queue.get(owner["job"]) if owner["job"] else None
+        if job is None or job.finished:
+            job = ingestion_queue.record(file.filename, stage="deduplicated")
+        return JobAccepted(
+            job_id=job.id,
+            message=f" PDF '{file.filename}' is identical to '{owner['pdf']}'; linked to its index.",
+            status_url=f"/jobs/{job.id}",
+            deduplicated=True
+        )
+    if previous is not None:
+        os.replace(file_path, previous[0])  # kept until the new ingest succeeds
+    os.replace(part_path, file_path)
+    storage.record(file.filename)
 
-    except Exception as e:
+    def forget_upload():
         if os.path.exists(file_path):
             os.remove(file_path)  # Cleanup on failure
+        storage.forget(file.filename)
+        for name in content_index.forget(digest):
+            linked_path = os.path.join(TEMP_DIR, name)
+            if os.path.exists(linked_path):
+                os.remove(linked_path)
+            storage.forget(name)
+        if previous is not None:
+            # Failed overwrite: the previous PDF comes back, its index was never replaced
+            backup, previous_digest, previous_state = previous
+            os.replace(backup, file_path)
+            if previous_digest:
+                content_index.claim(previous_digest, file.filename, os.path.getsize(file_path))
+            storage.record(file.filename)
+            if previous_state == "evicted":
+                storage.catalog.set_state(file.filename, "evicted")
+
+    def ingest(job):
+        try:
+            # Process PDF into vectorstore; stage timings are reported on the job
+            with use_trace(Trace("ingest")) as trace:
+                try:
+                    process_pdf_and_create_vectorstore(file_path, base_dir=VECTORSTORE_DIR, progress=job)
+                finally:
+                    job.update(timings=trace.breakdown())
+
+            if previous is not None:
+                # Supplements belonged to the replaced document; the new index has none
+                shutil.rmtree(supplements_dir(file.filename), ignore_errors=True)
+                if os.path.exists(previous[0]):
+                    os.remove(previous[0])
+            # Drop any stale session; the next chat loads the new index lazily
+            chat_sessions.invalidate(file.filename)
+            invalidate_pdf(file.filename)
+            storage.record(file.filename)
+        except Exception:
+            forget_upload()
+            raise
+
+    try:
+        job = ingestion_queue.submit(file.filename, ingest)
+    except QueueFullError as e:
+        forget_upload()
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f" Failed to process PDF: {str(e)}"
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e)
         )
+    content_index.set_job(digest, job.id)
 
-# Chat with PDF
-@app.post("/chat/{pdf_name}", response_model=ChatResponse, tags=["Chat"])
-async def chat_with_pdf(
-    pdf_name: str = Path(..., description="Name of the PDF file to chat with."),
-    question: str = Form(..., description="Your question about the PDF.")
+    return JobAccepted(
+        job_id=job.id,
+        message=f" PDF '{file.filename}' uploaded and queued for processing.",
+        status_url=f"/jobs/{job.id}"
+    )
+
+# Ingestion job status
+@app.get("/jobs/{job_id}", response_model=JobStatus, tags=["PDF"])
+async def get_job_status(
+    job_id: str = Path(..., description="Job id returned by /upload_pdf.")
+):
+    job = ingestion_queue.get(job_id)
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f" Job '{job_id}' not found."
+        )
+    return JobStatus(**job.to_dict())
+
+# Append supplementary material (errata, a new chapter) to an uploaded PDF
+@app.post("/append_pdf/{pdf_name}", response_model=JobAccepted, status_code=status.HTTP_202_ACCEPTED, tags=["PDF"])
+async def append_pdf(
+    pdf_name: str = Path(..., description="Uploaded PDF to extend."),
+    file: UploadFile = File(...)
+):
+    if not os.path.exists(os.path.join(TEMP_DIR, pdf_name)):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f" File '{pdf_name}' not found."
+        )
+
+    supplement_dir = supplements_dir(pdf_name)
+    os.makedirs(supplement_dir, exist_ok=True)
+    file_path = os.path.join(supplement_dir, file.filename)
+    await receive_upload(file, file_path)
+
+    def ingest(job):
+        try:
+            # A PDF linked to an identical upload gets its own copy before it diverges
+            detach_pdf_index(pdf_name)
+            # Written as a new segment; queryable as soon as it is committed
+            with use_trace(Trace("ingest")) as trace:
+                try:
+                    append_pdf_to_vectorstore(file_path, pdf_name, base_dir=VECTORSTORE_DIR, progress=job)
+                finally:
+                    job.update(timings=trace.breakdown())
+            chat_sessions.invalidate(pdf_name)
+            invalidate_pdf(pdf_name)
+            storage.record(pdf_name)
+        except Exception:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            raise
+
+    try:
+        job = ingestion_queue.submit(file.filename, ingest)
+    except QueueFullError as e:
+        os.remove(file_path)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e)
+        )
+
+    return JobAccepted(
+        job_id=job.id,
+        message=f" '{file.filename}' queued to be appended to '{pdf_name}'.",
+        status_url=f"/jobs/{job.id}"
+    )
+
+# Remove an appended document; its chunks are tombstoned until the next compaction
+@app.delete("/append_pdf/{pdf_name}/{source}", response_model=APIMessage, tags=["PDF"])
+async def delete_appended_pdf(
+    pdf_name: str = Path(..., description="PDF the document was appended to."),
+    source: str = Path(..., description="File name of the appended document.")
+):
+    await asyncio.to_thread(open_index, pdf_name)
+    vectorstore_path = os.path.join(VECTORSTORE_DIR, os.path.splitext(pdf_name)[0])
+    if not os.path.exists(vectorstore_path):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f" No vectorstore found for '{pdf_name}'."
+        )
+
+    # Only appended documents match: the PDF itself lives outside the supplements folder
+    supplement_path = os.path.join(supplements_dir(pdf_name), os.path.basename(source))
+    deleted = await asyncio.to_thread(delete_source, vectorstore_path, supplement_path)
+    if not deleted:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f" No chunks from '{source}' found in '{pdf_name}'."
+        )
+    if os.path.exists(supplement_path):
+        os.remove(supplement_path)
+    chat_sessions.invalidate(pdf_name)
+    invalidate_pdf(pdf_name)
+    storage.record(pdf_name)
+    return APIMessage(message=f" Removed {deleted} chunks of '{source}' from '{pdf_name}'.")
+
+# Index segments of a PDF
+@app.get("/segments/{pdf_name}", response_model=SegmentList, tags=["PDF"])
+async def list_segments(
+    pdf_name: str = Path(..., description="Name of the uploaded PDF.")
 ):
-    session = chat_sessions.get(pdf_name)
-    if not session:
+    owner = await asyncio.to_thread(open_index, pdf_name)
+    vectorstore_path = os.path.join(VECTORSTORE_DIR, os.path.splitext(owner)[0])
+    if not os.path.exists(vectorstore_path):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f" No vectorstore found for '{pdf_name}'."
+        )
+    manifest = read_manifest(vectorstore_path)
+    return SegmentList(
+        pdf_name=pdf_name,
+        version=store_version(vectorstore_path),
+        segments=[
+            SegmentInfo(name=seg["name"], chunks=seg.get("ntotal"), tombstones=len(seg["tombstones"]))
+            for seg in manifest["segments"]
+        ],
+    )
+
+# Shared request validation for the chat endpoints
+def get_strategy_or_400(strategy: str | None) -> str:
+    try:
+        return resolve_strategy(strategy)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+
+async def get_session_or_404(pdf_name: str) -> dict:
+    try:
+        # A miss loads the index from disk: keep it off the event loop
+        return await asyncio.to_thread(lambda: chat_sessions.get(open_index(pdf_name)))
+    except FileNotFoundError:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f" No chat session found for '{pdf_name}'. Please upload the PDF first."
         )
 
+# Chat with PDF
+@app.post("/chat/{pdf_name}", response_model=ChatResponse, tags=["Chat"])
+async def chat_with_pdf(
+    pdf_name: str = Path(..., description="Name of the PDF file to chat with."),
+    question: str = Form(..., description="Your question about the PDF."),
+    strategy: str | None = Form(None, description="Retrieval strategy: hybrid, mmr, expand or multi_query."),
+    session_id: str = Form("default", description="Client session id; conversation memory is kept per session and PDF."),
+    include_timings: bool = Form(False, description="Add a per-stage timing breakdown to the response.")
+):
+    # Turns of one session run one at a time so each sees the previous answer
+    with use_trace(Trace("chat")) as trace:
+        async with conversation_turn(pdf_name, session_id):
+            return await answer_chat(pdf_name, question, strategy, session_id, include_timings, trace)
+
+async def answer_chat(pdf_name, question, strategy, session_id, include_timings, trace):
+    strategy = get_strategy_or_400(strategy)
+    session = await get_session_or_404(pdf_name)
+
     chat_chain = session["chain"]
-    memory = session["memory"]
+    memory = get_conversation_memory(pdf_name, session_id=session_id)
 
     try:
         # Retrieve chat history
-        chat_history = memory.load_memory_variables({})["chat_history"]
+        with span("memory_load"):
+            chat_history = (await asyncio.to_thread(memory.load_memory_variables, {}))["chat_history"]
+
+        # Serve repeated questions from the answer cache
+        key = answer_key(pdf_name, session["version"], question, chat_history, strategy)
+        response = answer_cache.get(key)
+        cached = response is not None
+        record_cache("answer", hits=int(cached), misses=int(not cached))
+        timings = {}
+
+        if not cached:
+            async def generate():
+                # Async chain: the LLM call awaits, sync steps run on the bounded pool
+                answer = await chat_chain.ainvoke({
+                    "question": question,
+                    "chat_history": chat_history,
+                    "strategy": strategy,
+                    "timings": timings
+                })
+                answer_cache.set(key, answer)
+                return answer
 
-        # Generate response
-        response = chat_chain.invoke({
-            "question": question,
-            "chat_history": chat_history
-        })
+            response = await chat_flights.do(key, generate)
 
         # Save to memory
-        memory.save_context({"input": question}, {"output": response})
+        with span("memory_save"):
+            await asyncio.to_thread(memory.save_context, {"input": question}, {"output": response})
 
         return ChatResponse(
             pdf_name=pdf_name,
             question=f"You asked: {question}",
-            answer=f"AI answered: {response}"
+            answer=f"AI answered: {response}",
+            cached=cached,
+            retrieval_strategy=timings.get("retrieval_strategy"),
+            retrieval_ms=timings.get("retrieval_ms"),
+            context_tokens=timings.get("context_tokens"),
+            context_tokens_saved=timings.get("context_tokens_saved"),
+            timings=trace.breakdown() if include_timings else None
         )
 
     except Exception as e:
@@ -165,11 +723,327 @@ async def chat_with_pdf(
             detail=f"Failed to generate response: {str(e)}"
         )
 
+# Server-Sent Events frame
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Chat with PDF, streaming tokens as Server-Sent Events
+@app.post("/chat/{pdf_name}/stream", tags=["Chat"])
+async def chat_with_pdf_stream(
+    pdf_name: str = Path(..., description="Name of the PDF file to chat with."),
+    question: str = Form(..., description="Your question about the PDF."),
+    strategy: str | None = Form(None, description="Retrieval strategy: hybrid, mmr, expand or multi_query."),
+    session_id: str = Form("default", description="Client session id; conversation memory is kept per session and PDF."),
+    include_timings: bool = Form(False, description="Add a per-stage timing breakdown to the done event.")
+):
+    """
+    Emits `token` events as the answer is generated, then one `done` event with
+    the full answer (committed to memory at that point) or an `error` event.
+    """
+    strategy = get_strategy_or_400(strategy)
+    session = await get_session_or_404(pdf_name)
+
+    chat_chain = session["chain"]
+    memory = get_conversation_memory(pdf_name, session_id=session_id)
+
+    async def event_stream():
+        # Set inside the generator: it runs in the streaming task's context.
+        # The turn lock is held until the answer is saved to memory.
+        with use_trace(Trace("chat_stream")) as trace:
+            async with conversation_turn(pdf_name, session_id):
+                try:
+                    with span("memory_load"):
+                        chat_history = (await asyncio.to_thread(memory.load_memory_variables, {}))["chat_history"]
+                    key = answer_key(pdf_name, session["version"], question, chat_history, strategy)
+                    answer = answer_cache.get(key)
+                    cached = answer is not None
+                    record_cache("answer", hits=int(cached), misses=int(not cached))
+                    timings = {}
+
+                    if cached:
+                        yield sse_event("token", {"token": answer})
+                    else:
+                        parts = []
+                        async for token in chat_chain.astream({
+                            "question": question,
+                            "chat_history": chat_history,
+                            "strategy": strategy,
+                            "timings": timings
+                        }):
+                            parts.append(token)
+                            yield sse_event("token", {"token": token})
+                        answer = "".join(parts)
+                        answer_cache.set(key, answer)
+
+                    # Commit the full answer to memory once generation finished
+                    with span("memory_save"):
+                        await asyncio.to_thread(memory.save_context, {"input": question}, {"output": answer})
+                    yield sse_event("done", {
+                        "pdf_name": pdf_name,
+                        "answer": answer,
+                        "cached": cached,
+                        "retrieval_strategy": timings.get("retrieval_strategy"),
+                        "retrieval_ms": timings.get("retrieval_ms"),
+                        "context_tokens": timings.get("context_tokens"),
+                        "context_tokens_saved": timings.get("context_tokens_saved"),
+                        "timings": trace.breakdown() if include_timings else None
+                    })
+                except Exception as e:
+                    yield sse_event("error", {"detail": f"Failed to generate response: {str(e)}"})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Answer many independent questions (quiz / study-guide generation) as NDJSON
+@app.post("/chat/{pdf_name}/batch", tags=["Chat"])
+async def chat_with_pdf_batch(
+    request: BatchChatRequest,
+    pdf_name: str = Path(..., description="Name of the PDF file to ask about.")
+):
+    """
+    Questions are answered without conversation memory. Retrieval for all
+    uncached questions is one embedding call and one FAISS search; at most
+    BATCH_CONCURRENCY generations run at once. Each response line is one result
+    as soon as it completes, {"index", "question", "answer", ...} or
+    {"index", "question", "error"}; the last line is {"done": true, ...}.
+    """
+    questions = [question.strip() for question in request.questions]
+    if not questions or not all(questions) or len(questions) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f" Send between 1 and {BATCH_MAX_QUESTIONS} non-empty questions."
+        )
+    session = await get_session_or_404(pdf_name)
+    answer_chain = build_answer_chain()
+
+    async def answer_one(index: int, docs) -> dict:
+        key = keys[index]
+        async with semaphore:
+            try:
+                timings = {}
+                context = pack_context(docs, timings=timings)
+
+                async def generate():
+                    answer = await answer_chain.ainvoke({
+                        "context": context,
+                        "question": questions[index],
+                        "chat_history": []
+                    })
+                    answer_cache.set(key, answer)
+                    return answer
+
+                return {
+                    "index": index,
+                    "question": questions[index],
+                    "answer": await chat_flights.do(key, generate),
+                    "cached": False,
+                    "context_tokens": timings.get("context_tokens"),
+                    "context_tokens_saved": timings.get("context_tokens_saved")
+                }
+            except Exception as e:
+                # Includes FlightCancelledError: the generation shared with another request was
+                # cancelled. Cancellation of this task itself still propagates.
+                return {"index": index, "question": questions[index], "error": f"Failed to generate response: {str(e)}"}
+
+    # Same key scheme as /chat with an empty history; "batch" keeps its retrieval apart
+    keys = [answer_key(pdf_name, session["version"], question, [], "batch") for question in questions]
+    semaphore = asyncio.Semaphore(max(1, BATCH_CONCURRENCY))
+
+    async def result_lines():
+        with use_trace(Trace("chat_batch")) as trace:
+            counts = {"answered": 0, "cached": 0, "failed": 0}
+
+            def line(result: dict) -> str:
+                counts["failed" if "error" in result else "answered"] += 1
+                return json.dumps(result) + "\n"
+
+            misses = []
+            for index, key in enumerate(keys):
+                answer = answer_cache.get(key)
+                if answer is None:
+                    misses.append(index)
+                    continue
+                counts["cached"] += 1
+                yield line({"index": index, "question": questions[index], "answer": answer, "cached": True})
+            record_cache("answer", hits=len(keys) - len(misses), misses=len(misses))
+
+            tasks = []
+            if misses:
+                try:
+                    retrieved = await asyncio.to_thread(
+                        retrieve_batch, session["vector_store"], [questions[i] for i in misses]
+                    )
+                    tasks = [asyncio.create_task(answer_one(i, docs)) for i, docs in zip(misses, retrieved)]
+                except Exception as e:
+                    for index in misses:
+                        yield line({"index": index, "question": questions[index], "error": f"Retrieval failed: {str(e)}"})
+            try:
+                for finished in asyncio.as_completed(tasks):
+                    yield line(await finished)
+            finally:
+                # Client went away: stop waiting; a generation shared with other requests keeps running for them
+                for task in tasks:
+                    task.cancel()
+
+            yield json.dumps({
+                "done": True,
+                "pdf_name": pdf_name,
+                "questions": len(questions),
+                **counts,
+                "timings": trace.breakdown() if request.include_timings else None
+            }) + "\n"
+
+    return StreamingResponse(
+        result_lines(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Collections (cross-PDF search)
+def get_collection_or_404(name: str) -> list[str]:
+    pdfs = collections.get(name)
+    if pdfs is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f" Collection '{name}' not found."
+        )
+    return pdfs
+
+def to_source_chunks(docs) -> list[SourceChunk]:
+    return [
+        SourceChunk(
+            pdf_name=doc.metadata["source_pdf"],
+            page=doc.metadata.get("page"),
+            score=doc.metadata.get("score"),
+            content=doc.page_content
+        )
+        for doc in docs
+    ]
+
+def run_collection_search(name: str, question: str, k: int, timings: dict):
+    return search_collection(
+        get_collection_or_404(name),
+        lambda pdf: chat_sessions.get(open_index(pdf))["vector_store"],
+        get_query_embeddings(),
+        question,
+        k=k,
+        fetch_k=max(k * 3, 15),
+        timings=timings
+    )
+
+@app.put("/collections/{name}", response_model=CollectionInfo, tags=["Collections"])
+async def put_collection(
+    definition: CollectionDefinition,
+    name: str = Path(..., description="Collection name, e.g. a course code.")
+):
+    missing = [pdf for pdf in definition.pdfs if not storage.has_index(pdf)]
+    if missing:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f" No vectorstore found for: {', '.join(missing)}. Upload them first."
+        )
+    collections.put(name, definition.pdfs)
+    return CollectionInfo(name=name, pdfs=collections.get(name))
+
+@app.get("/collections", response_model=CollectionList, tags=["Collections"])
+async def list_collections():
+    return CollectionList(collections=[
+        CollectionInfo(name=name, pdfs=pdfs) for name, pdfs in collections.all().items()
+    ])
+
+@app.delete("/collections/{name}", response_model=APIMessage, tags=["Collections"])
+async def delete_collection(name: str = Path(..., description="Collection name.")):
+    if not collections.delete(name):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f" Collection '{name}' not found."
+        )
+    return APIMessage(message=f"Collection '{name}' deleted successfully.")
+
+@app.post("/collections/{name}/search", response_model=CollectionSearchResponse, tags=["Collections"])
+async def search_in_collection(
+    name: str = Path(..., description="Collection name."),
+    question: str = Form(..., description="Your question across the collection."),
+    k: int = Form(6, ge=1, le=50, description="Number of chunks to return.")
+):
+    timings = {}
+    docs = await asyncio.to_thread(run_collection_search, name, question, k, timings)
+    return CollectionSearchResponse(
+        collection=name, question=question, results=to_source_chunks(docs), timings=timings
+    )
+
+@app.post("/collections/{name}/chat", response_model=CollectionChatResponse, tags=["Collections"])
+async def chat_with_collection(
+    name: str = Path(..., description="Collection name."),
+    question: str = Form(..., description="Your question across the collection."),
+    session_id: str = Form("default", description="Client session id; conversation memory is kept per session and collection.")
+):
+    memory = get_conversation_memory(f"collection_{name}", session_id=session_id)
+    try:
+        timings = {}
+        docs = await asyncio.to_thread(run_collection_search, name, question, 6, timings)
+        async with conversation_turn(f"collection_{name}", session_id):
+            chat_history = (await asyncio.to_thread(memory.load_memory_variables, {}))["chat_history"]
+            answer = await build_answer_chain().ainvoke({
+                "context": format_attributed_context(pack_documents(docs, timings=timings)),
+                "question": question,
+                "chat_history": chat_history
+            })
+            await asyncio.to_thread(memory.save_context, {"input": question}, {"output": answer})
+        return CollectionChatResponse(
+            collection=name, question=question, answer=answer,
+            sources=to_source_chunks(docs), timings=timings
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to generate response: {str(e)}"
+        )
+
+# Session / query-embedding / answer cache counters
+@app.get("/cache/stats", response_model=CacheStats, tags=["Chat"])
+async def session_cache_stats():
+    return CacheStats(
+        **chat_sessions.stats(),
+        query_embeddings=query_embedding_cache.stats(),
+        answers=answer_cache.stats(),
+        coalesced_requests=chat_flights.coalesced
+    )
+
+# Retrieval latency per strategy
+@app.get("/retrieval/stats", response_model=RetrievalStats, tags=["Chat"])
+async def retrieval_stats():
+    return RetrievalStats(strategies=retrieval_latency.summary())
+
+# Readiness probe: load balancers hold traffic until the worker has prewarmed
+@app.get("/ready", response_model=ReadinessInfo, responses={503: {"model": ReadinessInfo}}, tags=["About"])
+async def readiness():
+    """200 once this worker finished starting up (incl. prewarming), 503 before."""
+    info = ReadinessInfo(import_seconds=IMPORT_SECONDS, **startup)
+    return JSONResponse(status_code=200 if info.ready else 503, content=info.model_dump())
+
+# Prometheus scrape endpoint (stage latencies, token counts, cache hit rates, HTTP latency)
+@app.get("/metrics", tags=["About"], include_in_schema=False)
+async def metrics():
+    body, content_type = prometheus_payload()
+    return Response(content=body, media_type=content_type)
+
+# Disk usage per document (storage catalog)
+@app.get("/storage/stats", response_model=StorageInfo, tags=["PDF"])
+async def storage_stats():
+    return StorageInfo(**await asyncio.to_thread(storage.status))
+
 # List Uploaded PDFs
 @app.get("/list_pdfs", response_model=PDFList, tags=["PDF"])
 async def list_uploaded_pdfs():
     try:
-        files = [f for f in os.listdir(TEMP_DIR) if f.endswith(".pdf")]
+        # Served from the storage catalog, kept in sync by uploads, deletes and the storage task
+        files = await asyncio.to_thread(storage.list_pdfs)
         return PDFList(files=files)
     except Exception as e:
         raise HTTPException(
@@ -184,8 +1058,6 @@ async def delete_uploaded_pdf(
 ):
     
     file_path = os.path.join(TEMP_DIR, filename)
-    vectorstore_path = os.path.join(VECTORSTORE_DIR, os.path.splitext(filename)[0])
-
 
     if not os.path.exists(file_path):
         raise HTTPException(
@@ -194,19 +1066,31 @@ async def delete_uploaded_pdf(
         )
 
     try:
-         # Delete PDF
-        os.remove(file_path)
-
-        # Delete vectorstore folder
-        if os.path.exists(vectorstore_path):
-            shutil.rmtree(vectorstore_path)
+        # PDF, vectorstore folder or archive (unless identical uploads still use it),
+        # appended documents, history, collection entries and catalog row
+        heir = await asyncio.to_thread(storage.remove, filename)
+        if heir:
+            chat_sessions.invalidate(heir)
 
-        chat_sessions.pop(filename, None)  # Remove chat session if exists
+        chat_sessions.invalidate(filename)  # Remove chat session if exists
+        invalidate_pdf(filename)
         return APIMessage(message=f"PDF '{filename}' deleted successfully.")
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to delete '{filename}': {str(e)}"
         )
+
+# Everything above is module import; the rest of startup happens in lifespan.
+# uvicorn workers load this file twice (as __mp_main__, then as main): time from the first load
+_first_load = sys.modules.get("__mp_main__")
+IMPORT_STARTED = getattr(_first_load, "IMPORT_STARTED", IMPORT_STARTED)
+IMPORT_SECONDS = getattr(_first_load, "IMPORT_SECONDS", None) or time.perf_counter() - IMPORT_STARTED
+
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000,reload=True)
+    # Several workers share the on-disk indexes, memory DB, job table and metrics
+    if WEB_CONCURRENCY > 1:
+        shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+        os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = PROMETHEUS_MULTIPROC_DIR
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=WEB_CONCURRENCY)
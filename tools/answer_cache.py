@@ -0,0 +1,185 @@
+# two-level /chat cache: question embeddings + final answers
+import os
+import re
+import time
+import asyncio
+import hashlib
+import inspect
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Awaitable, Callable, List
+
+from langchain_core.embeddings import Embeddings
+
+from tools.embedding_cache import get_embeddings, EMBEDDING_MODEL
+from tools.metrics import record_cache
+
+# Size / TTL limits per level (override via .env)
+QUERY_EMBED_CACHE_SIZE = int(os.getenv("QUERY_EMBED_CACHE_SIZE", "4096"))
+QUERY_EMBED_CACHE_TTL = float(os.getenv("QUERY_EMBED_CACHE_TTL", "3600"))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "900"))
+
+
+def normalize_question(question: str) -> str:
+    """Case-fold, collapse whitespace and drop trailing punctuation."""
+    text = re.sub(r"\s+", " ", question.strip().lower())
+    return text.rstrip(" ?!.")
+
+
+class TTLCache:
+    """Thread-safe LRU mapping whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard_where(self, predicate: Callable[[object], bool]):
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class FlightCancelledError(Exception):
+    """The shared work a caller was waiting on was cancelled (the caller itself was not)."""
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent async calls: the first caller for a key starts
+    the work, later callers await the same result instead of starting their own.
+    The work runs as its own task, so a caller that goes away (client disconnect)
+    only stops waiting; it does not cancel the result for the others.
+    """
+
+    def __init__(self):
+        self._in_flight = {}
+        self.coalesced = 0
+
+    def _finished(self, key, task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved when nobody is waiting any more
+
+    async def do(self, key, fn: Callable[[], Awaitable]):
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+        else:
+            self.coalesced += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            current = asyncio.current_task()
+            if task.cancelled() and not (hasattr(current, "cancelling") and current.cancelling()):
+                raise FlightCancelledError("The shared generation was cancelled.")
+            raise
+
+
+class QueryCachedEmbeddings(Embeddings):
+    """Level 1: caches embed_query() by normalized question text."""
+
+    def __init__(self, underlying: Embeddings, model: str, cache: TTLCache):
+        self.underlying = underlying
+        self.model = model
+        self.cache = cache
+        # Batched query embeddings need embed_documents(..., task_type=...)
+        params = inspect.signature(underlying.embed_documents).parameters.values()
+        self._batch_queries = any(p.name == "task_type" or p.kind is p.VAR_KEYWORD for p in params)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.underlying.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = (self.model, normalize_question(text))
+        vector = self.cache.get(key)
+        record_cache("query_embedding", hits=int(vector is not None), misses=int(vector is None))
+        if vector is None:
+            vector = self.underlying.embed_query(text)
+            self.cache.set(key, vector)
+        return vector
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embed several queries, sending all cache misses in a single request."""
+        keys = [(self.model, normalize_question(text)) for text in texts]
+        vectors = [self.cache.get(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        record_cache("query_embedding", hits=len(texts) - len(missing), misses=len(missing))
+        if missing:
+            misses = [texts[i] for i in missing]
+            if self._batch_queries:
+                fresh = self.underlying.embed_documents(misses, task_type="RETRIEVAL_QUERY")
+            else:
+                fresh = [self.underlying.embed_query(text) for text in misses]
+            for i, vector in zip(missing, fresh):
+                vectors[i] = vector
+                self.cache.set(keys[i], vector)
+        return vectors
+
+
+query_embedding_cache = TTLCache(QUERY_EMBED_CACHE_SIZE, QUERY_EMBED_CACHE_TTL)
+answer_cache = TTLCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL)
+
+
+@lru_cache(maxsize=None)
+def get_query_embeddings(model: str = EMBEDDING_MODEL) -> QueryCachedEmbeddings:
+    """Shared embeddings client whose query embeddings go through level 1."""
+    return QueryCachedEmbeddings(get_embeddings(model), model, query_embedding_cache)
+
+
+def history_fingerprint(chat_history) -> str:
+    """Stable hash of prior turns; empty history always maps to the same value."""
+    h = hashlib.sha256()
+    for message in chat_history or []:
+        h.update(getattr(message, "type", "").encode("utf-8"))
+        h.update(b"\x00")
+        h.update(str(getattr(message, "content", message)).encode("utf-8"))
+        h.update(b"\x01")
+    return h.hexdigest()
+
+
+def answer_key(pdf_name: str, index_version: str, question: str, chat_history, strategy: str = "") -> tuple:
+    """Level 2 key: same PDF, same index build, same question, same history."""
+    return (pdf_name, index_version, normalize_question(question), history_fingerprint(chat_history), strategy)
+
+
+def invalidate_pdf(pdf_name: str):
+    """Drop cached answers for a PDF (e.g. after re-upload or delete)."""
+    answer_cache.discard_where(lambda key: key[0] == pdf_name)
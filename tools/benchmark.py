@@ -0,0 +1,428 @@
+# offline benchmarks: ingestion, retrieval and /chat latency against fake backends
+#
+#   python -m tools.benchmark                          # all suites, default sizes
+#   python -m tools.benchmark --suite retrieval --chunks 5000
+#   python -m tools.benchmark compare old.json new.json
+#
+# Results are written as JSON (default cache/benchmarks/results-<time>.json).
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import itertools
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+from functools import lru_cache
+
+try:
+    import resource
+except ImportError:  # Windows: peak RSS is not reported
+    resource = None
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join("cache", "benchmarks")
+SUITES = ("ingest", "retrieval", "chat", "startup")
+
+_SYLLABLES = ("ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ze", "pra", "qua", "ster", "nol", "bri", "dex")
+
+
+# Synthetic corpus
+
+def synthetic_vocabulary(size: int = 3000, seed: int = 0) -> list:
+    """Pseudo-words plus a few section numbers and acronyms, as in textbooks."""
+    rng = random.Random(seed)
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(_SYLLABLES) for _ in range(rng.randint(2, 4))))
+    words = sorted(words)
+    words += [f"{a}.{b}" for a in range(1, 13) for b in range(1, 10)]
+    words += ["".join(rng.choice("ABCDEFGHKLMNPRSTUVXYZ") for _ in range(3)) for _ in range(50)]
+    rng.shuffle(words)  # list position is the word's frequency rank
+    return words
+
+
+@lru_cache(maxsize=8)
+def _zipf_cum_weights(n: int) -> list:
+    return list(itertools.accumulate(1.0 / (rank + 1) for rank in range(n)))
+
+
+def synthetic_text(rng: random.Random, vocab: list, n_words: int) -> str:
+    # Zipf-distributed: a few words are common, most are rare, like real prose
+    return " ".join(rng.choices(vocab, cum_weights=_zipf_cum_weights(len(vocab)), k=n_words))
+
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def make_synthetic_pdf(path: str, pages: int, words_per_page: int = 350, seed: int = 0) -> str:
+    """Write a text-only PDF (Helvetica, no dependencies) readable by both PDF backends."""
+    rng = random.Random(seed)
+    vocab = synthetic_vocabulary(seed=seed)
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+
+    def add(body: bytes):
+        offsets.append(len(out))
+        out.extend(f"{len(offsets)} 0 obj\n".encode("latin-1") + body + b"\nendobj\n")
+
+    # 1 catalog, 2 page tree, 3 font, then (page, content) per page
+    kids = " ".join(f"{4 + 2 * i} 0 R" for i in range(pages))
+    add(b"<< /Type /Catalog /Pages 2 0 R >>")
+    add(f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>".encode("latin-1"))
+    add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    for p in range(pages):
+        words = synthetic_text(rng, vocab, words_per_page).split()
+        lines = [f"Section {p + 1}"] + [" ".join(words[i:i + 12]) for i in range(0, len(words), 12)]
+        stream = ("BT /F1 10 Tf 12 TL 50 800 Td " + " ".join(f"({_pdf_escape(line)}) '" for line in lines) + " ET").encode("latin-1")
+        add(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> "
+            f"/Contents {5 + 2 * p} 0 R >>".encode("latin-1"))
+        add(f"<< /Length {len(stream)} >>\nstream\n".encode("latin-1") + stream + b"\nendstream")
+
+    xref = len(out)
+    out.extend(f"xref\n0 {len(offsets) + 1}\n0000000000 65535 f \n".encode("latin-1"))
+    out.extend("".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode("latin-1"))
+    out.extend(f"trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1"))
+    with open(path, "wb") as f:
+        f.write(out)
+    return path
+
+
+def synthetic_questions(n: int, seed: int = 1) -> list:
+    """Half keyword-style lookups, half natural-language questions."""
+    rng = random.Random(seed)
+    vocab = synthetic_vocabulary()
+    questions = []
+    for i in range(n):
+        terms = synthetic_text(rng, vocab, rng.randint(2, 3))
+        questions.append(terms if i % 2 else f"What does the text say about {terms}?")
+    return questions
+
+
+# Measurement helpers
+
+def latency_summary(samples_ms: list) -> dict:
+    ordered = sorted(samples_ms)
+    n = len(ordered)
+    if not n:
+        return {"count": 0}
+
+    def pct(p):  # nearest rank
+        return ordered[max(0, math.ceil(p / 100 * n) - 1)]
+
+    return {
+        "count": n,
+        "mean_ms": sum(ordered) / n,
+        "p50_ms": pct(50),
+        "p90_ms": pct(90),
+        "p99_ms": pct(99),
+        "max_ms": ordered[-1],
+    }
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process and its finished children (e.g. PDF workers)."""
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024  # bytes on macOS, KiB elsewhere
+
+
+def _child_main(conn, fn_name: str, kwargs: dict):
+    try:
+        conn.send(("ok", globals()[fn_name](**kwargs)))
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+
+
+def run_isolated(fn_name: str, env: dict = None, **kwargs) -> dict:
+    """Run a benchmark function in a fresh process so peak RSS and module state are its own."""
+    ctx = multiprocessing.get_context("spawn")
+    receiver, sender = ctx.Pipe(duplex=False)
+    saved = dict(os.environ)
+    os.environ.update(env or {})  # spawned children read configuration at import
+    try:
+        proc = ctx.Process(target=_child_main, args=(sender, fn_name, kwargs))
+        proc.start()
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+    sender.close()
+    try:
+        status, value = receiver.recv()
+    except EOFError:
+        status, value = "error", "benchmark process died"
+    proc.join()
+    if status != "ok":
+        raise RuntimeError(value)
+    return value
+
+
+# Suites
+
+def _ingest_one(pdf_path: str, work_dir: str, embed_latency: float) -> dict:
+    from tools.fake_backends import FakeEmbeddings
+    from tools.jobs import Job
+    from tools import pdf_tool
+
+    job = Job(os.path.basename(pdf_path))
+    embeddings = FakeEmbeddings(latency=embed_latency)
+    start = time.perf_counter()
+    store = pdf_tool.stream_pdf_to_vectorstore(
+        pdf_path, base_dir=os.path.join(work_dir, "vectorstore"), embeddings=embeddings, progress=job,
+    )
+    seconds = time.perf_counter() - start
+    chunks = store.index.ntotal
+    return {
+        "pages": job.pages_parsed,
+        "chunks": chunks,
+        "seconds": seconds,
+        "pages_per_s": job.pages_parsed / seconds,
+        "chunks_per_s": chunks / seconds,
+        "embed_calls": embeddings.calls,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def bench_ingest(page_counts, work_dir: str, embed_latency: float, backend: str = "auto") -> list:
+    rows = []
+    for pages in page_counts:
+        pdf_path = make_synthetic_pdf(os.path.join(work_dir, f"synthetic-{pages}p.pdf"), pages)
+        row = run_isolated(
+            "_ingest_one",
+            env={"EMBED_CHECKPOINT_DIR": os.path.join(work_dir, "checkpoints") + os.sep, "PDF_BACKEND": backend},
+            pdf_path=pdf_path, work_dir=work_dir, embed_latency=embed_latency,
+        )
+        row["name"] = f"{pages}p"
+        print(f" ingest {pages:>5} pages: {row['pages_per_s']:8.1f} pages/s  {row['chunks_per_s']:8.1f} chunks/s  "
+              f"peak RSS {row['peak_rss_mb'] or 0:.0f} MB")
+        rows.append(row)
+    return rows
+
+
+def bench_retrieval(n_chunks: int, n_queries: int, index_types, strategies, embed_latency: float,
+                    llm_latency: float) -> list:
+    from langchain_community.vectorstores import FAISS
+    from tools.fake_backends import FakeChatModel, FakeEmbeddings
+    from tools.index_builder import apply_index_type
+    from tools.lexical_index import LexicalIndex
+    from tools.retrieval import retrieve
+
+    rng = random.Random(2)
+    vocab = synthetic_vocabulary()
+    texts = [synthetic_text(rng, vocab, 150) for _ in range(n_chunks)]
+    vectors = FakeEmbeddings().embed_documents(texts)
+    questions = synthetic_questions(n_queries)
+    llm = FakeChatModel(latency=llm_latency)
+
+    rows = []
+    for index_type in index_types:
+        store = FAISS.from_embeddings(list(zip(texts, vectors)), FakeEmbeddings(latency=embed_latency),
+                                      metadatas=[{"page": i} for i in range(n_chunks)])
+        meta = apply_index_type(store, index_type, "none")
+        store.lexical_index = LexicalIndex.build(texts)
+        for strategy in strategies:
+            samples = []
+            for question in questions:
+                start = time.perf_counter()
+                retrieve(store, question, strategy, llm)
+                samples.append((time.perf_counter() - start) * 1000)
+            row = {"name": f"{meta['index_type']}/{strategy}", "index_type": meta["index_type"],
+                   "strategy": strategy, "chunks": n_chunks, "recall_at_k": meta["eval"]["recall_at_k"]}
+            row.update(latency_summary(samples))
+            print(f" retrieval {row['name']:<22} p50 {row['p50_ms']:8.2f} ms  p99 {row['p99_ms']:8.2f} ms")
+            rows.append(row)
+    return rows
+
+
+def _chat_load(work_dir: str, pages: int, n_requests: int, concurrency_levels: list, strategies: list) -> list:
+    import httpx
+
+    os.makedirs(work_dir, exist_ok=True)
+    os.chdir(work_dir)  # main.py keeps temp/, vectorstore/ and cache/ relative to the cwd
+    sys.path.insert(0, REPO_ROOT)
+    import main
+    from tools.pdf_tool import process_pdf_and_create_vectorstore
+
+    pdf_name = "bench.pdf"
+    pdf_path = make_synthetic_pdf(os.path.join(main.TEMP_DIR, pdf_name), pages)
+    process_pdf_and_create_vectorstore(pdf_path, base_dir=main.VECTORSTORE_DIR)
+
+    async def run(strategy: str, concurrency: int, questions: list) -> dict:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            # Warm the session cache so the first request does not pay the index load
+            await client.post(f"/chat/{pdf_name}", data={"question": "warm up", "session_id": "warmup"})
+            gate = asyncio.Semaphore(concurrency)
+
+            async def one(i: int, question: str):
+                async with gate:
+                    start = time.perf_counter()
+                    response = await client.post(f"/chat/{pdf_name}", data={
+                        "question": question, "strategy": strategy, "session_id": f"bench-{i % concurrency}",
+                    })
+                    return (time.perf_counter() - start) * 1000, response.status_code
+
+            start = time.perf_counter()
+            results = await asyncio.gather(*[one(i, q) for i, q in enumerate(questions)])
+            wall = time.perf_counter() - start
+        row = latency_summary([ms for ms, code in results if code == 200])
+        row.update({"errors": sum(1 for _, code in results if code != 200), "throughput_rps": len(results) / wall})
+        return row
+
+    async def run_all() -> list:
+        rows = []
+        # ASGITransport does not run lifespan, which starts the app's background services
+        async with main.app.router.lifespan_context(main.app):
+            for strategy in strategies:
+                for concurrency in concurrency_levels:
+                    # Fresh questions per run: answer-cache hits would hide the pipeline latency
+                    questions = [f"{q} (run {strategy}-{concurrency})"
+                                 for q in synthetic_questions(n_requests, seed=concurrency)]
+                    row = await run(strategy, concurrency, questions)
+                    row.update({"name": f"{strategy}/c{concurrency}", "strategy": strategy, "concurrency": concurrency})
+                    rows.append(row)
+        return rows
+
+    return asyncio.run(run_all())
+
+
+def bench_chat(work_dir: str, pages: int, n_requests: int, concurrency_levels, strategies, embed_latency: float,
+               llm_latency: float, token_latency: float) -> list:
+    rows = run_isolated(
+        "_chat_load",
+        env={
+            "FAKE_BACKENDS": "true",
+            "FAKE_EMBED_LATENCY": str(embed_latency),
+            "FAKE_LLM_LATENCY": str(llm_latency),
+            "FAKE_LLM_TOKEN_LATENCY": str(token_latency),
+        },
+        work_dir=work_dir, pages=pages, n_requests=n_requests,
+        concurrency_levels=list(concurrency_levels), strategies=list(strategies),
+    )
+    for row in rows:
+        print(f" chat {row['name']:<20} p50 {row['p50_ms']:8.1f} ms  p99 {row['p99_ms']:8.1f} ms  "
+              f"{row['throughput_rps']:6.1f} req/s  errors {row['errors']}")
+    return rows
+
+
+def bench_startup(work_dir: str, runs: int) -> list:
+    """Cold `import main` in fresh interpreters: module import alone, and the whole process."""
+    os.makedirs(work_dir, exist_ok=True)
+    env = dict(os.environ, FAKE_BACKENDS="true", PYTHONPATH=REPO_ROOT)
+    imports, processes = [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", "import main; print(main.IMPORT_SECONDS)"], cwd=work_dir,
+                             env=env, capture_output=True, text=True, check=True).stdout
+        processes.append((time.perf_counter() - start) * 1000)
+        imports.append(float(out.strip().splitlines()[-1]) * 1000)
+    rows = [{"name": "import_main", **latency_summary(imports)}, {"name": "process", **latency_summary(processes)}]
+    for row in rows:
+        print(f" startup {row['name']:<12} p50 {row['p50_ms']:8.1f} ms  max {row['max_ms']:8.1f} ms")
+    return rows
+
+
+# Runs and comparisons
+
+def environment_info() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                                capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(old_path: str, new_path: str):
+    """Print every numeric metric of two result files side by side."""
+    with open(old_path, "r", encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, "r", encoding="utf-8") as f:
+        new = json.load(f)
+    print(f"{'metric':<48} {'old':>12} {'new':>12} {'change':>9}")
+    for suite in SUITES:
+        old_rows = {row["name"]: row for row in old.get(suite, [])}
+        for row in new.get(suite, []):
+            before = old_rows.get(row["name"])
+            if before is None:
+                continue
+            for metric, value in row.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)) \
+                        or not isinstance(before.get(metric), (int, float)):
+                    continue
+                change = f"{(value - before[metric]) / before[metric] * 100:+.1f}%" if before[metric] else ""
+                print(f"{suite + '.' + row['name'] + '.' + metric:<48} {before[metric]:>12.3f} {value:>12.3f} {change:>9}")
+
+
+def _csv(value: str, cast=str) -> list:
+    return [cast(v) for v in value.split(",") if v]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline StudyMate benchmarks (fake embeddings and LLM).")
+    parser.add_argument("--suite", default=",".join(SUITES), help="Comma-separated: ingest,retrieval,chat,startup.")
+    parser.add_argument("--pages", default="10,50,200", help="Synthetic PDF sizes for ingestion.")
+    parser.add_argument("--pdf-backend", default="auto", help="auto, pymupdf or pypdf.")
+    parser.add_argument("--chunks", type=int, default=2000, help="Corpus size for retrieval.")
+    parser.add_argument("--queries", type=int, default=200, help="Queries per retrieval strategy.")
+    parser.add_argument("--index-types", default="flat,hnsw,ivf")
+    parser.add_argument("--strategies", default="hybrid,mmr,expand,multi_query")
+    parser.add_argument("--chat-pages", type=int, default=50, help="Size of the PDF chatted with.")
+    parser.add_argument("--requests", type=int, default=100, help="/chat requests per concurrency level.")
+    parser.add_argument("--concurrency", default="1,8,32")
+    parser.add_argument("--chat-strategies", default="hybrid,multi_query")
+    parser.add_argument("--embed-latency", type=float, default=0.02, help="Seconds per fake embedding call.")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="Seconds to the fake LLM's first token.")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Seconds per further fake LLM token.")
+    parser.add_argument("--startup-runs", type=int, default=5, help="Fresh interpreters timed importing main.")
+    parser.add_argument("--out", default=None, help="Result file (JSON).")
+    args = parser.parse_args(argv)
+
+    suites = _csv(args.suite)
+    results = {"environment": environment_info(), "config": vars(args)}
+    work_dir = tempfile.mkdtemp(prefix="studymate-bench-")
+    try:
+        if "ingest" in suites:
+            results["ingest"] = bench_ingest(_csv(args.pages, int), work_dir, args.embed_latency, args.pdf_backend)
+        if "retrieval" in suites:
+            results["retrieval"] = bench_retrieval(args.chunks, args.queries, _csv(args.index_types),
+                                                   _csv(args.strategies), args.embed_latency, args.llm_latency)
+        if "chat" in suites:
+            results["chat"] = bench_chat(os.path.join(work_dir, "chat"), args.chat_pages, args.requests,
+                                         _csv(args.concurrency, int), _csv(args.chat_strategies),
+                                         args.embed_latency, args.llm_latency, args.token_latency)
+        if "startup" in suites:
+            results["startup"] = bench_startup(os.path.join(work_dir, "startup"), args.startup_runs)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    out = args.out or os.path.join(RESULTS_DIR, f"results-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    if os.path.dirname(out):
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f" Results written to {out}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "compare":
+        compare(sys.argv[2], sys.argv[3])
+    else:
+        main()
@@ -1,73 +1,98 @@
 import os
 import warnings
+from functools import lru_cache
 warnings.simplefilter("ignore")
-from langchain_community.vectorstores import FAISS                # For FAISS vectorstore operations
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI     
-from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI       # OpenAI LLM / gemini  + embeddings
-from langchain.retrievers.multi_query import MultiQueryRetriever  # Multi-query retriever for better recall
-from langchain.schema.runnable import RunnableMap                 # For building modular chains
+from langchain_core.runnables import RunnableMap, RunnableLambda # For building modular chains
 from langchain_core.output_parsers import StrOutputParser         # Parses output into string
-from langchain.schema import HumanMessage, AIMessage              # For structured chat history
 
-from tools.memory import get_conversation_memory                  # Load memory
+from tools.fake_backends import FAKE_BACKENDS, FAKE_LLM_LATENCY, FAKE_LLM_TOKEN_LATENCY, FakeChatModel  # Offline stand-ins
+from tools.answer_cache import get_query_embeddings               # Shared embeddings client w/ query cache
+from tools.memory import get_conversation_memory, estimate_tokens # Load memory
+from tools.metrics import llm_metrics_callback, span              # Stage timings / token counts
+from tools.segments import load_segmented_store, store_version  # All live index segments as one store
 from tools.prompt_template import get_pdf_chat_prompt             # Load custom prompt template
+from tools.retrieval import retrieve                              # MMR / local expansion / multi-query retrieval
+from tools.context import pack_context                            # Merged, deduplicated, token-budgeted context
 from dotenv import load_dotenv                                    # Load environment variables from .env file
 
 load_dotenv()
 
 
 
-# Load Vector Store (FAISS)
+# Shared Gemini chat model (one client per process, not per PDF)
+@lru_cache(maxsize=1)
+def get_llm():
+    # The metrics callback times every call and counts its tokens (see tools.metrics)
+    if FAKE_BACKENDS:
+        return FakeChatModel(latency=FAKE_LLM_LATENCY, token_latency=FAKE_LLM_TOKEN_LATENCY,
+                             callbacks=[llm_metrics_callback])
+    from langchain_google_genai import ChatGoogleGenerativeAI  # heavy import, paid on first use (or prewarm)
+    return ChatGoogleGenerativeAI(
+        model="gemini-2.5-flash",max_tokens=5000,
+        temperature=0.3,
+        callbacks=[llm_metrics_callback],
+    )
+
+
+# Load FAISS index for a PDF from disk
 
-def load_vector_store(pdf_name: str, base_dir="vectorstore/"):
+def load_faiss_index(pdf_name: str, base_dir="vectorstore/"):
     """
-    Load FAISS vectorstore for a specific PDF.
+    Load the FAISS index of a specific PDF using the shared embeddings client.
     """
     folder_path = os.path.join(base_dir, os.path.splitext(pdf_name)[0])  # Use PDF name without extension
     if not os.path.exists(folder_path):
         raise FileNotFoundError(f"Vectorstore for '{pdf_name}' not found in {folder_path}")
     
-    embeddings = GoogleGenerativeAIEmbeddings(
-        model="models/embedding-001")
-    
-    vector_store = FAISS.load_local(
+    return load_segmented_store(
         folder_path=folder_path,
-        embeddings=embeddings,
-        allow_dangerous_deserialization=True
-    )
-    base_retriever = vector_store.as_retriever(
-        search_type="mmr",
-        search_kwargs={"k": 6, "fetch_k": 15}
+        embeddings=get_query_embeddings()
     )
-    return base_retriever
 
 
+# Version tag of the index on disk; changes whenever segments are added, replaced or tombstoned
+def index_version(pdf_name: str, base_dir="vectorstore/") -> str:
+    return store_version(os.path.join(base_dir, os.path.splitext(pdf_name)[0]))
+
 
-def build_chat_model(pdf_name: str):
+# Prompt -> Gemini -> text, for callers that assemble the context themselves
+# Chain input: {"context", "question", "chat_history"}
+def build_answer_chain():
+    return timed_prompt(get_pdf_chat_prompt()) | get_llm() | StrOutputParser()
+
+
+# Prompt formatting step that reports its time and prompt size as the "prompt" stage
+def timed_prompt(prompt):
+    def assemble(x):
+        with span("prompt") as attrs:
+            value = prompt.invoke(x)
+            attrs["tokens"] = estimate_tokens(value.to_string())
+        return value
+    return RunnableLambda(assemble)
+
+
+# Chain input: {"question", "chat_history" (messages from the caller's memory),
+# optional "strategy" (see tools.retrieval.STRATEGIES),
+# optional "timings" dict that receives the retrieval strategy, latency and context token counts}
+def build_chat_model(pdf_name: str, vector_store=None):
     
-    base_retriever = load_vector_store(pdf_name)
+    vector_store = vector_store or load_faiss_index(pdf_name)
      # Gemini chat model
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-2.5-flash",max_tokens=5000,
-        temperature=0.3 
-    )
-    multi_query_retriever = MultiQueryRetriever.from_llm(
-        retriever=base_retriever,
-        llm=llm
-    )
+    llm = get_llm()
     prompt = get_pdf_chat_prompt()
     parser = StrOutputParser()
-    memory = get_conversation_memory(pdf_name)  # Use per-PDF memory
+    memory = get_conversation_memory(pdf_name)  # Default session; callers pass per-session history
 
     chain = (
         RunnableMap({
-            "context": lambda x: "\n\n".join(
-                [doc.page_content for doc in multi_query_retriever.invoke(x["question"])]
+            "context": lambda x: pack_context(
+                retrieve(vector_store, x["question"], x.get("strategy"), llm, x.get("timings")),
+                timings=x.get("timings")
             ),
             "question": lambda x: x["question"],
-            "chat_history": lambda x: memory.load_memory_variables({})["chat_history"]
+            "chat_history": lambda x: x.get("chat_history", [])
         })
-        | prompt
+        | timed_prompt(prompt)
         | llm
         | parser
     )
@@ -85,12 +110,12 @@ if __name__ == "__main__":
         print(f"User: {user_question}")
 
         # Call chain
-        response = chain.invoke({"question": user_question})
+        chat_history = memory.load_memory_variables({})["chat_history"]
+        response = chain.invoke({"question": user_question, "chat_history": chat_history})
         print(f"\nChatbot: {response}")
 
         # Save to memory
-        memory.chat_memory.add_user_message(HumanMessage(content=user_question))
-        memory.chat_memory.add_ai_message(AIMessage(content=response))
+        memory.save_context({"input": user_question}, {"output": response})
     
     
     except FileNotFoundError as e:
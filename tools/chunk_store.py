@@ -0,0 +1,220 @@
+# pickle-free chunk store: texts + metadata read lazily by id via mmap
+import os
+import sys
+import json
+import mmap
+import struct
+import pickle
+import threading
+from typing import Dict, Iterable, List, Union
+
+from langchain_core.documents import Document
+from langchain_community.docstore.base import AddableMixin, Docstore
+
+from tools.lexical_index import build_lexical_index
+
+# On-disk layout inside a vectorstore folder:
+#   chunks.txt   UTF-8 chunk texts, concatenated
+#   chunks.meta  UTF-8 JSON metadata objects, concatenated
+#   chunks.idx   one fixed-size record per chunk id: text offset/length, metadata offset/length
+#   chunks.json  format marker and chunk count
+TEXT_FILE = "chunks.txt"
+META_FILE = "chunks.meta"
+IDX_FILE = "chunks.idx"
+MANIFEST_FILE = "chunks.json"
+FORMAT = "studymate-chunks"
+VERSION = 1
+
+_RECORD = struct.Struct("<QIQI")
+
+
+def has_chunk_store(folder_path: str) -> bool:
+    return os.path.exists(os.path.join(folder_path, MANIFEST_FILE))
+
+
+class ChunkStore:
+    """
+    Append-friendly, offset-indexed chunk storage. Chunk id == FAISS row id.
+    Reads go through read-only mmaps, so only the chunks a query touches are
+    decoded and the OS page cache is shared between processes.
+    """
+
+    def __init__(self, folder_path: str):
+        self.folder_path = folder_path
+        self._lock = threading.Lock()
+        self._maps = {}
+        self._files = {}
+        with open(os.path.join(folder_path, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("format") != FORMAT or manifest.get("version") != VERSION:
+            raise ValueError(f"Unsupported chunk store in {folder_path}: {manifest}")
+        self._remap()
+
+    @classmethod
+    def create(cls, folder_path: str, docs: Iterable[Document]) -> "ChunkStore":
+        """Write a new store from documents in id order (replaces any existing one)."""
+        os.makedirs(folder_path, exist_ok=True)
+        # Build in a scratch folder, then swap files in by rename: readers that
+        # still map the old files keep their inodes instead of crashing on truncation
+        scratch = os.path.join(folder_path, ".chunks.new")
+        os.makedirs(scratch, exist_ok=True)
+        for name in (TEXT_FILE, META_FILE, IDX_FILE):
+            open(os.path.join(scratch, name), "wb").close()
+        cls._append_files(scratch, docs, 0, 0)
+        for name in (TEXT_FILE, META_FILE, IDX_FILE):
+            os.replace(os.path.join(scratch, name), os.path.join(folder_path, name))
+        os.rmdir(scratch)
+        cls._write_manifest(folder_path)
+        return cls(folder_path)
+
+    @staticmethod
+    def _write_manifest(folder_path: str):
+        tmp = os.path.join(folder_path, MANIFEST_FILE + ".tmp")
+        count = os.path.getsize(os.path.join(folder_path, IDX_FILE)) // _RECORD.size
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"format": FORMAT, "version": VERSION, "count": count}, f)
+        os.replace(tmp, os.path.join(folder_path, MANIFEST_FILE))
+
+    @staticmethod
+    def _append_files(folder_path: str, docs: Iterable[Document], text_off: int, meta_off: int) -> int:
+        n = 0
+        with open(os.path.join(folder_path, TEXT_FILE), "ab") as ft, \
+                open(os.path.join(folder_path, META_FILE), "ab") as fm, \
+                open(os.path.join(folder_path, IDX_FILE), "ab") as fi:
+            for doc in docs:
+                text = doc.page_content.encode("utf-8")
+                meta = json.dumps(doc.metadata, default=str).encode("utf-8")
+                ft.write(text)
+                fm.write(meta)
+                fi.write(_RECORD.pack(text_off, len(text), meta_off, len(meta)))
+                text_off += len(text)
+                meta_off += len(meta)
+                n += 1
+        return n
+
+    def _close_maps(self):
+        for m in self._maps.values():
+            if isinstance(m, mmap.mmap):
+                m.close()
+        for f in self._files.values():
+            f.close()
+        self._maps, self._files = {}, {}
+
+    def _remap(self):
+        self._close_maps()
+        for name in (TEXT_FILE, META_FILE, IDX_FILE):
+            path = os.path.join(self.folder_path, name)
+            f = open(path, "rb")
+            self._files[name] = f
+            # mmap cannot map empty files; an empty bytes object reads the same
+            self._maps[name] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b""
+        self._count = len(self._maps[IDX_FILE]) // _RECORD.size
+
+    def __len__(self) -> int:
+        return self._count
+
+    def get(self, chunk_id: int) -> Document:
+        with self._lock:
+            if not 0 <= chunk_id < self._count:
+                raise KeyError(chunk_id)
+            text_off, text_len, meta_off, meta_len = _RECORD.unpack_from(self._maps[IDX_FILE], chunk_id * _RECORD.size)
+            text = self._maps[TEXT_FILE][text_off:text_off + text_len].decode("utf-8")
+            meta = json.loads(self._maps[META_FILE][meta_off:meta_off + meta_len])
+        return Document(page_content=text, metadata=meta)
+
+    def append(self, docs: List[Document]) -> List[int]:
+        """Append documents; returns their new ids."""
+        with self._lock:
+            start = self._count
+            text_off = len(self._maps[TEXT_FILE])
+            meta_off = len(self._maps[META_FILE])
+            self._append_files(self.folder_path, docs, text_off, meta_off)
+            self._write_manifest(self.folder_path)
+            self._remap()
+            return list(range(start, self._count))
+
+    def iter_documents(self):
+        for i in range(len(self)):
+            yield self.get(i)
+
+    def close(self):
+        with self._lock:
+            self._close_maps()
+
+
+class ChunkStoreDocstore(Docstore, AddableMixin):
+    """LangChain docstore backed by a ChunkStore; docstore ids are str(chunk id)."""
+
+    def __init__(self, store: ChunkStore):
+        self.store = store
+
+    def search(self, search: str) -> Union[str, Document]:
+        try:
+            return self.store.get(int(search))
+        except (KeyError, ValueError):
+            return f"ID {search} not found."
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        expected = [str(i) for i in range(len(self.store), len(self.store) + len(texts))]
+        if list(texts.keys()) != expected:
+            raise ValueError("ChunkStoreDocstore ids must be sequential row ids; pass ids=[str(i), ...] when adding.")
+        self.store.append(list(texts.values()))
+
+    def delete(self, ids: List) -> None:
+        # Overrides Docstore.delete so FAISS.delete fails with a clear reason
+        raise ValueError("chunk store is read-only; tombstone chunks via tools.segments.delete_source")
+
+
+def identity_id_map(n: int) -> Dict[int, str]:
+    """FAISS row id -> docstore id for a chunk store."""
+    return {i: str(i) for i in range(n)}
+
+
+def convert_folder(folder_path: str, index_name: str = "index", keep_pickle: bool = False) -> int:
+    """
+    Convert a LangChain FAISS folder (index.pkl docstore) to the chunk store
+    layout, building its BM25 index on the way. Only run on folders this
+    service wrote: it unpickles index.pkl.
+    """
+    pkl_path = os.path.join(folder_path, f"{index_name}.pkl")
+    with open(pkl_path, "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+
+    n = len(index_to_docstore_id)
+    docs = []
+    for i in range(n):
+        doc = docstore.search(index_to_docstore_id[i])
+        if isinstance(doc, str):
+            raise ValueError(f"{folder_path}: FAISS row {i} has no document ({doc}).")
+        docs.append(doc)
+    store = ChunkStore.create(folder_path, docs)
+    build_lexical_index(folder_path, (doc.page_content for doc in docs))
+    count = len(store)
+    store.close()
+    if count != n:
+        raise ValueError(f"{folder_path}: wrote {count} chunks, expected {n}.")
+    if not keep_pickle:
+        os.remove(pkl_path)
+    return count
+
+
+#  Converter: python -m tools.chunk_store [--keep-pickle] <vectorstore/<stem> | vectorstore/>
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    keep = "--keep-pickle" in sys.argv
+    target = args[0] if args else "vectorstore/"
+
+    if os.path.exists(os.path.join(target, "index.pkl")):
+        folders = [target]
+    else:
+        folders = [
+            os.path.join(target, name) for name in sorted(os.listdir(target))
+            if os.path.exists(os.path.join(target, name, "index.pkl"))
+        ]
+    for folder in folders:
+        if has_chunk_store(folder) and not os.path.exists(os.path.join(folder, "index.pkl")):
+            continue
+        try:
+            print(f" Converted {folder}: {convert_folder(folder, keep_pickle=keep)} chunks.")
+        except Exception as e:
+            print(f" Failed to convert {folder}: {e}")
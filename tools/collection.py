@@ -0,0 +1,164 @@
+# cross-PDF collections over per-PDF FAISS shards
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+
+from tools.retrieval import RETRIEVAL_K, RETRIEVAL_FETCH_K
+
+# Where collection definitions live (override via .env)
+COLLECTIONS_PATH = os.getenv("COLLECTIONS_PATH", "vectorstore/collections.json")
+COLLECTION_SHARD_THREADS = int(os.getenv("COLLECTION_SHARD_THREADS", "16"))
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.5"))
+
+# Shard loads and searches fan out here; faiss releases the GIL while searching
+_shard_pool = ThreadPoolExecutor(max_workers=COLLECTION_SHARD_THREADS, thread_name_prefix="shard")
+
+
+class CollectionRegistry:
+    """Named groups of PDFs, persisted as one JSON file {name: [pdf, ...]}."""
+
+    def __init__(self, path: str = COLLECTIONS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write(self, data: dict):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, self.path)  # atomic: readers never see a partial file
+
+    def all(self) -> dict:
+        with self._lock:
+            return self._read()
+
+    def get(self, name: str):
+        return self.all().get(name)
+
+    def put(self, name: str, pdfs: List[str]):
+        with self._lock:
+            data = self._read()
+            data[name] = list(dict.fromkeys(pdfs))  # dedupe, keep order
+            self._write(data)
+
+    def delete(self, name: str) -> bool:
+        with self._lock:
+            data = self._read()
+            if name not in data:
+                return False
+            del data[name]
+            self._write(data)
+            return True
+
+    def remove_pdf(self, pdf_name: str):
+        """Drop a deleted PDF from every collection."""
+        with self._lock:
+            data = self._read()
+            changed = False
+            for name, pdfs in data.items():
+                if pdf_name in pdfs:
+                    pdfs.remove(pdf_name)
+                    changed = True
+            if changed:
+                self._write(data)
+
+
+def _search_shard(pdf_name: str, vector_store, query: np.ndarray, fetch_k: int):
+    """Top `fetch_k` hits of one shard as (distance, pdf_name, faiss_id)."""
+    q = query.copy()
+    if getattr(vector_store, "_normalize_L2", False):
+        q /= np.linalg.norm(q, axis=1, keepdims=True)
+    distances, ids = vector_store.index.search(q, fetch_k)
+    return [(float(d), pdf_name, int(i)) for d, i in zip(distances[0], ids[0]) if i != -1]
+
+
+def search_collection(
+    pdf_names: List[str],
+    get_vector_store: Callable[[str], object],
+    embeddings,
+    question: str,
+    k: int = RETRIEVAL_K,
+    fetch_k: int = RETRIEVAL_FETCH_K,
+    lambda_mult: float = MMR_LAMBDA,
+    timings: dict = None,
+):
+    """
+    Embed the question once, search every shard in parallel, keep the global
+    top `fetch_k` candidates by distance and pick `k` of them with MMR. Each
+    returned Document carries `source_pdf` and `page` metadata.
+    """
+    start = time.perf_counter()
+    query = np.asarray([embeddings.embed_query(question)], dtype=np.float32)
+    embedded = time.perf_counter()
+
+    # Load (or fetch from the session cache) and search all shards concurrently
+    def load_and_search(pdf_name):
+        vector_store = get_vector_store(pdf_name)
+        return vector_store, _search_shard(pdf_name, vector_store, query, fetch_k)
+
+    stores: Dict[str, object] = {}
+    candidates = []
+    for pdf_name, future in [(p, _shard_pool.submit(load_and_search, p)) for p in pdf_names]:
+        try:
+            vector_store, hits = future.result()
+        except FileNotFoundError:
+            print(f" Skipping '{pdf_name}': no vectorstore on disk.")
+            continue
+        stores[pdf_name] = vector_store
+        candidates.extend(hits)
+    searched = time.perf_counter()
+
+    # Global top-k across shards (all shards share the embedding model and metric)
+    candidates.sort(key=lambda hit: hit[0])
+    candidates = candidates[:fetch_k]
+
+    # Global MMR when candidate vectors can be reconstructed; plain top-k otherwise
+    try:
+        vectors = [stores[pdf].index.reconstruct(i) for _, pdf, i in candidates]
+        picked = maximal_marginal_relevance(query[0], vectors, lambda_mult=lambda_mult, k=k) if vectors else []
+        chosen = [candidates[j] for j in picked]
+    except RuntimeError:
+        chosen = candidates[:k]
+
+    docs = []
+    for distance, pdf_name, faiss_id in chosen:
+        store = stores[pdf_name]
+        doc = store.docstore.search(store.index_to_docstore_id[faiss_id])
+        if isinstance(doc, str):
+            continue
+        # Copy: the docstore's Document objects are shared across requests
+        docs.append(Document(
+            page_content=doc.page_content,
+            metadata={**doc.metadata, "source_pdf": pdf_name, "score": distance},
+        ))
+
+    if timings is not None:
+        timings["embed_ms"] = (embedded - start) * 1000
+        timings["search_ms"] = (searched - embedded) * 1000
+        timings["retrieval_ms"] = (time.perf_counter() - start) * 1000
+        timings["shards"] = len(stores)
+    return docs
+
+
+def format_attributed_context(docs) -> str:
+    """Context block where every chunk names its source PDF and page."""
+    parts = []
+    for doc in docs:
+        page = doc.metadata.get("page")
+        where = f"{doc.metadata.get('source_pdf')}, page {page + 1}" if isinstance(page, int) else doc.metadata.get("source_pdf")
+        parts.append(f"[Source: {where}]\n{doc.page_content}")
+    return "\n\n".join(parts)
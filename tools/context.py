@@ -0,0 +1,137 @@
+# context packing: merge overlapping chunks, drop duplicates, fit a token budget
+import os
+import re
+from typing import List, Optional
+
+from langchain_core.documents import Document
+
+from tools.memory import estimate_tokens
+from tools.metrics import span
+
+# Token budget of the context block in each prompt (override via .env)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+# Shortest suffix/prefix match treated as chunk overlap when offsets are unknown
+MIN_TEXT_OVERLAP = 40
+
+_SPACE = re.compile(r"\s+")
+
+
+def _location(doc: Document) -> tuple:
+    meta = doc.metadata
+    return (meta.get("source_pdf") or meta.get("source") or "", meta.get("page"))
+
+
+def _text_overlap(left: str, right: str) -> int:
+    """Length of the longest suffix of `left` that is a prefix of `right`."""
+    if len(right) < MIN_TEXT_OVERLAP:
+        return 0
+    probe = right[:MIN_TEXT_OVERLAP]
+    pos = left.find(probe, max(0, len(left) - len(right)))
+    while pos != -1:
+        if right.startswith(left[pos:]):
+            return len(left) - pos
+        pos = left.find(probe, pos + 1)
+    return 0
+
+
+class _Span:
+    """Merged run of chunks from one page, ranked by its most relevant chunk."""
+
+    def __init__(self, doc: Document, rank: int):
+        self.metadata = dict(doc.metadata)
+        self.text = doc.page_content
+        self.rank = rank
+        self.start = doc.metadata.get("start_index")
+
+    @property
+    def end(self):
+        return None if self.start is None else self.start + len(self.text)
+
+    def absorb(self, doc: Document, rank: int) -> bool:
+        """Merge `doc` if it overlaps or touches this span; False if it does not."""
+        text, start = doc.page_content, doc.metadata.get("start_index")
+        if self.start is not None and start is not None:
+            if start > self.end or start + len(text) < self.start:
+                return False
+            if start < self.start:
+                self.text = text[:self.start - start] + self.text
+                self.start = start
+            if start + len(text) > self.end:
+                self.text += text[self.end - start:]
+        elif text in self.text:
+            pass
+        elif self.text in text:
+            self.text = text
+        else:
+            # Chunks from indexes built before start_index was recorded: match the overlap text
+            tail = _text_overlap(self.text, text)
+            head = 0 if tail else _text_overlap(text, self.text)
+            if tail:
+                self.text += text[tail:]
+            elif head:
+                self.text = text[:len(text) - head] + self.text
+            else:
+                return False
+        self.rank = min(self.rank, rank)
+        return True
+
+
+def pack_documents(docs: List[Document], budget: int = CONTEXT_TOKEN_BUDGET,
+                   timings: Optional[dict] = None) -> List[Document]:
+    """
+    Turn ranked chunks into the context actually sent: duplicates dropped,
+    overlapping/adjacent chunks of a page merged, spans chosen by relevance
+    until `budget` tokens are used, then ordered by source and page. Token
+    counts before and after go to `timings` (context_tokens, context_tokens_saved).
+    """
+    with span("context_pack") as attrs:
+        raw_tokens = sum(estimate_tokens(doc.page_content) for doc in docs)
+
+        spans, seen = [], set()
+        for rank, doc in enumerate(docs):
+            key = _SPACE.sub(" ", doc.page_content.strip().lower())
+            if key in seen:
+                continue
+            seen.add(key)
+            for candidate in spans:
+                if _location(candidate) == _location(doc) and candidate.absorb(doc, rank):
+                    break
+            else:
+                spans.append(_Span(doc, rank))
+
+        # Merging can make two spans of a page touch; fold those together as well
+        merged = []
+        for current in sorted(spans, key=lambda s: (str(_location(s)), s.start or 0)):
+            previous = merged[-1] if merged else None
+            if previous is not None and _location(previous) == _location(current) and previous.absorb(
+                Document(page_content=current.text, metadata=current.metadata), current.rank
+            ):
+                continue
+            merged.append(current)
+
+        # Most relevant spans first until the budget is spent; never return nothing
+        chosen, used = [], 0
+        for current in sorted(merged, key=lambda s: s.rank):
+            tokens = estimate_tokens(current.text)
+            if used + tokens > budget and chosen:
+                continue
+            chosen.append(current)
+            used += tokens
+
+        packed = []
+        for current in sorted(chosen, key=lambda s: (_location(s)[0], _location(s)[1] or 0, s.start or 0)):
+            metadata = dict(current.metadata)
+            if current.start is not None:
+                metadata["start_index"] = current.start
+            packed.append(Document(page_content=current.text, metadata=metadata))
+
+        attrs.update(tokens=used, saved=max(0, raw_tokens - used), chunks_in=len(docs), chunks_out=len(packed))
+    if timings is not None:
+        timings["context_tokens"] = used
+        timings["context_tokens_saved"] = max(0, raw_tokens - used)
+    return packed
+
+
+def pack_context(docs: List[Document], budget: int = CONTEXT_TOKEN_BUDGET, timings: Optional[dict] = None) -> str:
+    """Packed chunks joined into one context block."""
+    return "\n\n".join(doc.page_content for doc in pack_documents(docs, budget, timings))
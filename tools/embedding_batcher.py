@@ -0,0 +1,246 @@
+# batched embedding with retries and checkpoints
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+# Tunables (override via .env)
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+EMBED_MAX_IN_FLIGHT = int(os.getenv("EMBED_MAX_IN_FLIGHT", "4"))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "6"))
+EMBED_BACKOFF_BASE = float(os.getenv("EMBED_BACKOFF_BASE", "1.0"))
+EMBED_BACKOFF_MAX = float(os.getenv("EMBED_BACKOFF_MAX", "60.0"))
+CHECKPOINT_DIR = os.getenv("EMBED_CHECKPOINT_DIR", "cache/checkpoints/")
+
+# Status codes in messages must stand alone: "5000 tokens" is not a 500
+RETRYABLE_STATUS = re.compile(r"\b(429|5\d\d)\b")
+RETRYABLE_MARKERS = (
+    "resourceexhausted", "resource exhausted", "quota", "rate limit",
+    "unavailable", "deadline exceeded", "internal error",
+)
+
+
+def is_retryable(exc: Exception) -> bool:
+    """True for rate-limit (429) and server-side (5xx) errors."""
+    for attr in ("status_code", "code", "status"):
+        code = getattr(exc, attr, None)
+        if isinstance(code, int):
+            return code == 429 or 500 <= code < 600
+    response = getattr(exc, "response", None)
+    code = getattr(response, "status_code", None)
+    if isinstance(code, int):
+        return code == 429 or 500 <= code < 600
+    text = f"{type(exc).__name__} {exc}".lower()
+    return bool(RETRYABLE_STATUS.search(text)) or any(marker in text for marker in RETRYABLE_MARKERS)
+
+
+class Backoff:
+    """
+    Exponential backoff shared by all workers: once any request is throttled,
+    every worker waits out the same cooldown before sending the next batch.
+    """
+
+    def __init__(self, base: float = EMBED_BACKOFF_BASE, max_delay: float = EMBED_BACKOFF_MAX):
+        self.base = base
+        self.max_delay = max_delay
+        self._cooldown_until = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self._lock:
+                remaining = self._cooldown_until - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def throttle(self, attempt: int) -> float:
+        delay = min(self.max_delay, self.base * (2 ** attempt))
+        delay *= random.uniform(0.5, 1.0)  # jitter
+        with self._lock:
+            self._cooldown_until = max(self._cooldown_until, time.monotonic() + delay)
+        return delay
+
+
+class EmbeddingCheckpoint:
+    """
+    Append-only JSONL record of finished batches, keyed by a hash of the batch
+    texts so a retry only skips batches whose input is unchanged. Only file
+    offsets are kept in memory; vectors are read back on demand.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._offsets = {}
+        if os.path.exists(path):
+            with open(path, "r+b") as f:
+                offset = 0
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # torn final line from an interrupted write
+                    self._offsets[record["key"]] = offset
+                    offset += len(line)
+                f.truncate(offset)
+
+    @staticmethod
+    def batch_key(texts: List[str]) -> str:
+        h = hashlib.sha256()
+        for text in texts:
+            h.update(text.encode("utf-8"))
+            h.update(b"\x00")
+        return h.hexdigest()
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def has(self, key: str) -> bool:
+        return key in self._offsets
+
+    def get(self, key: str) -> List[List[float]]:
+        with self._lock, open(self.path, "rb") as f:
+            f.seek(self._offsets[key])
+            return json.loads(f.readline())["vectors"]
+
+    def record(self, key: str, vectors: List[List[float]]):
+        with self._lock:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "ab") as f:
+                offset = f.tell()
+                f.write((json.dumps({"key": key, "vectors": vectors}) + "\n").encode("utf-8"))
+            self._offsets[key] = offset
+
+    def clear(self):
+        with self._lock:
+            self._offsets = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def checkpoint_path_for(pdf_name: str) -> str:
+    return os.path.join(CHECKPOINT_DIR, f"{os.path.splitext(os.path.basename(pdf_name))[0]}.jsonl")
+
+
+def embed_with_backoff(
+    embeddings: Embeddings,
+    texts: List[str],
+    backoff: Backoff,
+    max_retries: int = EMBED_MAX_RETRIES,
+) -> List[List[float]]:
+    """Embed one batch, retrying 429/5xx errors with exponential backoff."""
+    attempt = 0
+    while True:
+        backoff.wait()
+        try:
+            return embeddings.embed_documents(texts)
+        except Exception as e:
+            if not is_retryable(e) or attempt >= max_retries:
+                raise
+            delay = backoff.throttle(attempt)
+            print(f" Embedding batch throttled ({e}); retrying in {delay:.1f}s.")
+            attempt += 1
+
+
+def embed_in_batches(
+    texts: List[str],
+    embeddings: Embeddings,
+    batch_size: int = EMBED_BATCH_SIZE,
+    max_in_flight: int = EMBED_MAX_IN_FLIGHT,
+    max_retries: int = EMBED_MAX_RETRIES,
+    checkpoint_path: Optional[str] = None,
+    on_batch: Optional[Callable[[int], None]] = None,
+    checkpoint: Optional[EmbeddingCheckpoint] = None,
+    backoff: Optional[Backoff] = None,
+) -> List[List[float]]:
+    """
+    Embed `texts` in batches of `batch_size` with up to `max_in_flight` concurrent
+    requests. Finished batches are checkpointed so a failed run resumes where it
+    stopped. `on_batch` is called with the number of texts in each finished batch.
+
+    Pass `checkpoint`/`backoff` objects instead of `checkpoint_path` to share them
+    across calls (the caller then owns clearing the checkpoint).
+    """
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    owns_checkpoint = checkpoint is None and checkpoint_path is not None
+    if owns_checkpoint:
+        checkpoint = EmbeddingCheckpoint(checkpoint_path)
+    backoff = backoff or Backoff()
+    results: List[Optional[List[List[float]]]] = [None] * len(batches)
+
+    pending = []
+    for idx, batch in enumerate(batches):
+        key = EmbeddingCheckpoint.batch_key(batch)
+        if checkpoint is not None and checkpoint.has(key):
+            results[idx] = checkpoint.get(key)
+            if on_batch:
+                on_batch(len(batch))
+        else:
+            pending.append((idx, key, batch))
+
+    if checkpoint is not None and len(pending) < len(batches):
+        print(f" Resuming from checkpoint: {len(batches) - len(pending)}/{len(batches)} batches already embedded.")
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as pool:
+        futures = {
+            # Each batch runs in a copy of the caller's context so cache lookups reach its trace
+            pool.submit(contextvars.copy_context().run, embed_with_backoff, embeddings, batch, backoff, max_retries): (idx, key, batch)
+            for idx, key, batch in pending
+        }
+        for future in as_completed(futures):
+            idx, key, batch = futures[future]
+            try:
+                vectors = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            results[idx] = vectors
+            if checkpoint is not None:
+                checkpoint.record(key, vectors)
+            if on_batch:
+                on_batch(len(batch))
+
+    if errors:
+        done = sum(r is not None for r in results)
+        raise RuntimeError(
+            f"Embedding failed for {len(errors)} of {len(batches)} batches "
+            f"({done} checkpointed; rerun to resume): {errors[0]}"
+        ) from errors[0]
+
+    if owns_checkpoint:
+        checkpoint.clear()
+    return [vector for batch in results for vector in batch]
+
+
+#  Test block: exercise retries and resume against the fake backend
+if __name__ == "__main__":
+    from tools.fake_backends import FakeEmbeddings
+
+    sample = [f"chunk {i}" for i in range(500)]
+    path = checkpoint_path_for("fake_demo.pdf")
+
+    flaky = FakeEmbeddings(dim=8, latency=0.05, error_rate=0.2, error_status=429)
+    start = time.perf_counter()
+    vectors = embed_in_batches(sample, flaky, batch_size=32, max_in_flight=4, max_retries=8, checkpoint_path=path)
+    print(f"Embedded {len(vectors)} texts in {time.perf_counter() - start:.2f}s "
+          f"({flaky.calls} API calls).")
+
+    broken = FakeEmbeddings(dim=8, error_rate=0.5, error_status=500)
+    try:
+        embed_in_batches(sample, broken, batch_size=32, max_retries=0, checkpoint_path=path)
+    except RuntimeError as e:
+        print(f"First run failed: {e}")
+    healthy = FakeEmbeddings(dim=8)
+    embed_in_batches(sample, healthy, batch_size=32, checkpoint_path=path)
+    print(f"Resumed run needed {healthy.calls} API calls.")
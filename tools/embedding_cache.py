@@ -0,0 +1,176 @@
+# embedding cache
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+from array import array
+from functools import lru_cache
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+from tools.fake_backends import FAKE_BACKENDS, FAKE_EMBED_LATENCY, FakeEmbeddings
+from tools.metrics import record_cache
+
+# Cache location and size budget (override via .env)
+EMBEDDING_MODEL = "models/embedding-001"
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "cache/embeddings.sqlite")
+EMBEDDING_CACHE_MAX_MB = float(os.getenv("EMBEDDING_CACHE_MAX_MB", "512"))
+
+
+def chunk_key(text: str, model: str) -> str:
+    """Content address of a chunk: sha256 over model name + chunk text."""
+    return hashlib.sha256(f"{model}\x00{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent SQLite store of embedding vectors keyed by chunk_key().
+    Least-recently-used rows are evicted once the stored size exceeds max_bytes.
+    """
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH, max_mb: float = EMBEDDING_CACHE_MAX_MB):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY, vector BLOB NOT NULL,"
+            " size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON embeddings(last_access)")
+        self._conn.commit()
+
+    def get_many(self, keys: List[str]) -> dict:
+        """Return {key: vector} for the keys present in the cache."""
+        found = {}
+        now = time.time()
+        with self._lock:
+            # Stay well below SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                marks = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({marks})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+                if rows:
+                    self._conn.execute(
+                        f"UPDATE embeddings SET last_access = ? WHERE key IN ({marks})",
+                        [now, *batch],
+                    )
+            self._conn.commit()
+        return found
+
+    def put_many(self, items: dict):
+        """Store {key: vector} and evict old rows if the cache is over budget."""
+        if not items:
+            return
+        now = time.time()
+        rows = []
+        for key, vector in items.items():
+            blob = array("f", vector).tobytes()
+            rows.append((key, blob, len(blob) + len(key), now))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, size, last_access) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+            self._evict()
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._total_bytes()
+
+    def _total_bytes(self) -> int:
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    def _evict(self):
+        total = self._total_bytes()
+        if total <= self.max_bytes:
+            return
+        # Trim to 90% of the budget so we don't evict on every insert
+        target = int(self.max_bytes * 0.9)
+        freed = 0
+        doomed = []
+        for key, size in self._conn.execute("SELECT key, size FROM embeddings ORDER BY last_access ASC"):
+            if total - freed <= target:
+                break
+            doomed.append((key,))
+            freed += size
+        self._conn.executemany("DELETE FROM embeddings WHERE key = ?", doomed)
+        self._conn.commit()
+        print(f" Embedding cache evicted {len(doomed)} entries ({freed} bytes).")
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embeddings client so embed_documents() only calls the API
+    for chunks that are not already in the cache.
+    """
+
+    def __init__(self, underlying: Embeddings, model: str, cache: EmbeddingCache):
+        self.underlying = underlying
+        self.model = model
+        self.cache = cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [chunk_key(text, self.model) for text in texts]
+        found = self.cache.get_many(list(set(keys)))
+
+        # Embed each unseen text once, even if it repeats inside this batch
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = self.underlying.embed_documents(list(missing.values()))
+            fresh = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(fresh)
+            found.update(fresh)
+
+        print(f" Embedding cache: {len(texts) - len(missing)} hits, {len(missing)} misses.")
+        record_cache("chunk_embedding", hits=len(texts) - len(missing), misses=len(missing))
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.underlying.embed_query(text)
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Process-wide cache instance (opened lazily)."""
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = EmbeddingCache()
+        return _shared_cache
+
+
+@lru_cache(maxsize=None)
+def get_embeddings(model: str = EMBEDDING_MODEL) -> Embeddings:
+    """Shared Gemini embeddings client (one per model per process)."""
+    if FAKE_BACKENDS:
+        return FakeEmbeddings(latency=FAKE_EMBED_LATENCY)
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings  # heavy import, paid on first use (or prewarm)
+    return GoogleGenerativeAIEmbeddings(model=model)
+
+
+@lru_cache(maxsize=None)
+def get_cached_embeddings(model: str = EMBEDDING_MODEL) -> CachedEmbeddings:
+    """Gemini embeddings backed by the persistent chunk cache."""
+    return CachedEmbeddings(
+        get_embeddings(model),
+        model=f"fake:{model}" if FAKE_BACKENDS else model,  # never mix fake vectors into real entries
+        cache=get_embedding_cache(),
+    )
@@ -0,0 +1,129 @@
+# fake backends for offline testing
+import os
+import time
+import random
+import hashlib
+import threading
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+# Serve the app from these fakes instead of Gemini: offline dev and benchmarks (override via .env)
+FAKE_BACKENDS = os.getenv("FAKE_BACKENDS", "false").lower() == "true"
+FAKE_EMBED_LATENCY = float(os.getenv("FAKE_EMBED_LATENCY", "0.05"))       # seconds per embedding call
+FAKE_LLM_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "0.3"))            # seconds to first token
+FAKE_LLM_TOKEN_LATENCY = float(os.getenv("FAKE_LLM_TOKEN_LATENCY", "0.01"))  # seconds per further token
+
+_WORDS = (
+    "the model uses attention layers to weigh each token against its context so "
+    "training maximizes the likelihood of masked words while fine tuning adapts "
+    "pretrained weights to a downstream task with a small labelled dataset"
+).split()
+
+
+class FakeAPIError(Exception):
+    """Mimics a provider error that carries an HTTP status code."""
+
+    def __init__(self, status_code: int, message: str = ""):
+        self.status_code = status_code
+        super().__init__(message or f"{status_code} fake embedding API error")
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Deterministic local embeddings: the same text always maps to the same vector.
+    Latency and failures can be injected to exercise batching and retries.
+    """
+
+    def __init__(
+        self,
+        dim: int = 768,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 429,
+        fail_first: int = 0,
+        seed: int = 0,
+    ):
+        self.dim = dim
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.fail_first = fail_first
+        self.calls = 0
+        self.texts_embedded = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _vector(self, text: str) -> List[float]:
+        # Expand a sha256 digest into `dim` floats in [-1, 1]
+        values = []
+        counter = 0
+        while len(values) < self.dim:
+            digest = hashlib.sha256(f"{counter}:{text}".encode("utf-8")).digest()
+            values.extend((b / 127.5) - 1.0 for b in digest)
+            counter += 1
+        return values[:self.dim]
+
+    def _call(self, n_texts: int):
+        with self._lock:
+            self.calls += 1
+            call_no = self.calls
+            fail = call_no <= self.fail_first or self._rng.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise FakeAPIError(self.error_status)
+        with self._lock:
+            self.texts_embedded += n_texts
+
+    def embed_documents(self, texts: List[str], **kwargs) -> List[List[float]]:
+        self._call(len(texts))
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        self._call(1)
+        return self._vector(text)
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Deterministic chat model: the answer is derived from a hash of the prompt,
+    one sentence per line. `latency` is paid before the first token and
+    `token_latency` per further token, for both invoke and streaming.
+    """
+
+    latency: float = 0.0
+    token_latency: float = 0.0
+    answer_words: int = 60
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _answer(self, messages) -> List[str]:
+        prompt = "\n".join(str(m.content) for m in messages)
+        digest = hashlib.sha256(prompt.encode("utf-8")).digest()
+        words = [_WORDS[(digest[i % len(digest)] + i) % len(_WORDS)] for i in range(self.answer_words)]
+        # 12-word sentences on separate lines (multi-query parses one variant per line)
+        return [word + ("\n" if (i + 1) % 12 == 0 else " ") for i, word in enumerate(words)]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        self.calls += 1
+        tokens = self._answer(messages)
+        time.sleep(self.latency + self.token_latency * (len(tokens) - 1))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens).strip()))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        for i, token in enumerate(self._answer(messages)):
+            if i:
+                time.sleep(self.token_latency)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
@@ -0,0 +1,246 @@
+# FAISS index types: flat / HNSW / IVF with optional quantization
+import os
+import json
+import time
+import pickle
+import math
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+
+from tools.chunk_store import ChunkStore, ChunkStoreDocstore, has_chunk_store, identity_id_map
+from tools.lexical_index import build_lexical_index, load_lexical_index
+
+# Index configuration at ingest (override via .env)
+INDEX_TYPE = os.getenv("INDEX_TYPE", "flat")                    # flat | hnsw | ivf
+INDEX_QUANTIZATION = os.getenv("INDEX_QUANTIZATION", "none")    # none | sq8 | fp16 | pq
+INDEX_HNSW_M = int(os.getenv("INDEX_HNSW_M", "32"))
+INDEX_HNSW_EF_SEARCH = int(os.getenv("INDEX_HNSW_EF_SEARCH", "64"))
+INDEX_IVF_NLIST = int(os.getenv("INDEX_IVF_NLIST", "0"))        # 0 = derive from corpus size
+INDEX_IVF_NPROBE = int(os.getenv("INDEX_IVF_NPROBE", "8"))
+INDEX_PQ_M = int(os.getenv("INDEX_PQ_M", "48"))                 # sub-quantizers; must divide dim
+# Compare every index type at build time and record the table (slower ingest)
+INDEX_COMPARE = os.getenv("INDEX_COMPARE", "false").lower() == "true"
+# Memory-map index files on load so processes share the page cache
+INDEX_MMAP = os.getenv("INDEX_MMAP", "true").lower() == "true"
+
+INDEX_TYPES = ("flat", "hnsw", "ivf")
+QUANTIZATIONS = ("none", "sq8", "fp16", "pq")
+META_FILE = "index_meta.json"
+
+# Training needs enough points: PQ codebooks use 256 centroids per sub-quantizer
+MIN_TRAIN_POINTS_PQ = 256
+MIN_POINTS_PER_LIST = 39
+
+
+def _scalar_type(quantization: str):
+    return faiss.ScalarQuantizer.QT_8bit if quantization == "sq8" else faiss.ScalarQuantizer.QT_fp16
+
+
+def _pq_m(dim: int, requested: int = INDEX_PQ_M) -> int:
+    # Largest sub-quantizer count <= requested that divides the dimension
+    for m in range(min(requested, dim), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def _nlist(n: int) -> int:
+    if INDEX_IVF_NLIST:
+        return INDEX_IVF_NLIST
+    return max(1, min(int(4 * math.sqrt(n)), n // MIN_POINTS_PER_LIST))
+
+
+def effective_config(n: int, index_type: str, quantization: str) -> tuple:
+    """Downgrade to a config that can be trained on `n` vectors."""
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown INDEX_TYPE '{index_type}'. Choose one of {INDEX_TYPES}.")
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown INDEX_QUANTIZATION '{quantization}'. Choose one of {QUANTIZATIONS}.")
+    if quantization == "pq" and n < MIN_TRAIN_POINTS_PQ:
+        print(f" Only {n} vectors: too few to train PQ, using sq8 instead.")
+        quantization = "sq8"
+    if index_type == "ivf" and n < MIN_POINTS_PER_LIST * 2:
+        print(f" Only {n} vectors: too few for IVF, using a flat index instead.")
+        index_type = "flat"
+    return index_type, quantization
+
+
+def create_index(dim: int, n: int, index_type: str, quantization: str):
+    """Untrained, empty index for the given config (L2 metric, like LangChain's default)."""
+    if index_type == "flat":
+        if quantization == "none":
+            return faiss.IndexFlatL2(dim)
+        if quantization == "pq":
+            return faiss.IndexPQ(dim, _pq_m(dim), 8)
+        return faiss.IndexScalarQuantizer(dim, _scalar_type(quantization))
+
+    if index_type == "hnsw":
+        if quantization == "none":
+            index = faiss.IndexHNSWFlat(dim, INDEX_HNSW_M)
+        elif quantization == "pq":
+            index = faiss.IndexHNSWPQ(dim, _pq_m(dim), INDEX_HNSW_M)
+        else:
+            index = faiss.IndexHNSWSQ(dim, _scalar_type(quantization), INDEX_HNSW_M)
+        index.hnsw.efSearch = INDEX_HNSW_EF_SEARCH
+        return index
+
+    quantizer = faiss.IndexFlatL2(dim)
+    nlist = _nlist(n)
+    if quantization == "none":
+        index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+    elif quantization == "pq":
+        index = faiss.IndexIVFPQ(quantizer, dim, nlist, _pq_m(dim), 8)
+    else:
+        index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, _scalar_type(quantization))
+    index.nprobe = min(INDEX_IVF_NPROBE, nlist)
+    return index
+
+
+def build_index(vectors: np.ndarray, index_type: str, quantization: str):
+    n, dim = vectors.shape
+    index_type, quantization = effective_config(n, index_type, quantization)
+    index = create_index(dim, n, index_type, quantization)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    if isinstance(index, faiss.IndexIVF):
+        index.make_direct_map()  # LangChain's MMR reconstructs vectors by id
+    return index, index_type, quantization
+
+
+def evaluate_index(index, exact, vectors: np.ndarray, k: int = 10, n_queries: int = 100) -> dict:
+    """Recall@k against exact search, mean single-query latency and serialized size."""
+    rng = np.random.default_rng(0)
+    n = vectors.shape[0]
+    sample = vectors[rng.choice(n, size=min(n_queries, n), replace=False)]
+    # Perturb the stored vectors a little so queries are not exact duplicates
+    queries = sample + rng.normal(scale=0.01, size=sample.shape).astype(np.float32)
+    k = min(k, n)
+
+    _, truth = exact.search(queries, k)
+    start = time.perf_counter()
+    found = [index.search(q.reshape(1, -1), k)[1][0] for q in queries]
+    latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    hits = sum(len(set(f) & set(t)) for f, t in zip(found, truth))
+    return {
+        "recall_at_k": hits / (k * len(queries)),
+        "k": k,
+        "latency_ms": latency_ms,
+        "index_bytes": int(faiss.serialize_index(index).nbytes),
+    }
+
+
+def apply_index_type(vector_store: FAISS, index_type: str = INDEX_TYPE, quantization: str = INDEX_QUANTIZATION) -> dict:
+    """
+    Rebuild the flat index of a freshly ingested store as the configured type
+    (ids are preserved) and return the build metadata to save with it.
+    """
+    exact = vector_store.index
+    n = exact.ntotal
+    vectors = exact.reconstruct_n(0, n).astype(np.float32)
+
+    start = time.perf_counter()
+    if (index_type, quantization) == ("flat", "none"):
+        index, built_type, built_quant = exact, "flat", "none"
+    else:
+        index, built_type, built_quant = build_index(vectors, index_type, quantization)
+    build_seconds = time.perf_counter() - start
+
+    meta = {
+        "index_type": built_type,
+        "quantization": built_quant,
+        "ntotal": n,
+        "dim": exact.d,
+        "build_seconds": build_seconds,
+        "params": {"hnsw_m": INDEX_HNSW_M, "ef_search": INDEX_HNSW_EF_SEARCH,
+                   "nprobe": getattr(index, "nprobe", None), "pq_m": _pq_m(exact.d)},
+        "eval": evaluate_index(index, exact, vectors),
+    }
+    if INDEX_COMPARE:
+        meta["comparison"] = compare_index_types(vectors, exact)
+
+    vector_store.index = index
+    print(f" Built {built_type}/{built_quant} index: recall@{meta['eval']['k']}={meta['eval']['recall_at_k']:.3f}, "
+          f"{meta['eval']['latency_ms']:.3f} ms/query, {meta['eval']['index_bytes']} bytes.")
+    return meta
+
+
+def compare_index_types(vectors: np.ndarray, exact) -> list:
+    rows = []
+    for index_type in INDEX_TYPES:
+        for quantization in QUANTIZATIONS:
+            if effective_config(vectors.shape[0], index_type, quantization) != (index_type, quantization):
+                continue
+            start = time.perf_counter()
+            index, _, _ = build_index(vectors, index_type, quantization)
+            row = {"index_type": index_type, "quantization": quantization,
+                   "build_seconds": time.perf_counter() - start}
+            row.update(evaluate_index(index, exact, vectors))
+            rows.append(row)
+    return rows
+
+
+def write_index_meta(folder_path: str, meta: dict):
+    with open(os.path.join(folder_path, META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+
+
+def read_index_meta(folder_path: str) -> dict:
+    path = os.path.join(folder_path, META_FILE)
+    if not os.path.exists(path):
+        return {"index_type": "flat", "quantization": "none"}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def read_faiss_file(path: str, mmap: bool = INDEX_MMAP):
+    """Read an index file, memory-mapped when the index type supports it."""
+    if mmap:
+        try:
+            return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            pass  # e.g. HNSW graphs cannot be mapped; fall back to a full read
+    return faiss.read_index(path)
+
+
+def save_local_index(vector_store: FAISS, folder_path: str, index_name: str = "index"):
+    """FAISS.save_local equivalent that writes chunks to a chunk store instead of a pickle."""
+    os.makedirs(folder_path, exist_ok=True)
+    docs = []
+    for i in range(vector_store.index.ntotal):
+        doc = vector_store.docstore.search(vector_store.index_to_docstore_id[i])
+        if isinstance(doc, str):
+            raise ValueError(f"FAISS row {i} has no document ({doc}).")
+        docs.append(doc)
+    ChunkStore.create(folder_path, docs).close()
+    build_lexical_index(folder_path, (doc.page_content for doc in docs))
+    faiss.write_index(vector_store.index, os.path.join(folder_path, f"{index_name}.faiss"))
+    # Drop the legacy pickle left by an older ingest of this PDF
+    stale = os.path.join(folder_path, f"{index_name}.pkl")
+    if os.path.exists(stale):
+        os.remove(stale)
+
+
+def load_local_index(folder_path: str, embeddings, index_name: str = "index", mmap: bool = INDEX_MMAP) -> FAISS:
+    """FAISS.load_local equivalent that can memory-map the index file."""
+    index = read_faiss_file(os.path.join(folder_path, f"{index_name}.faiss"), mmap=mmap)
+    if has_chunk_store(folder_path):
+        docstore = ChunkStoreDocstore(ChunkStore(folder_path))
+        index_to_docstore_id = identity_id_map(index.ntotal)
+    else:
+        # Legacy layout; convert with `python -m tools.chunk_store <folder>`
+        print(f" {folder_path} still uses a pickled docstore; run `python -m tools.chunk_store` to convert it.")
+        with open(os.path.join(folder_path, f"{index_name}.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+
+    params = read_index_meta(folder_path).get("params", {})
+    if isinstance(index, faiss.IndexIVF) and params.get("nprobe"):
+        index.nprobe = params["nprobe"]
+    if hasattr(index, "hnsw") and params.get("ef_search"):
+        index.hnsw.efSearch = params["ef_search"]
+    vector_store = FAISS(embeddings, index, docstore, index_to_docstore_id)
+    vector_store.lexical_index = load_lexical_index(folder_path)  # None: dense-only retrieval
+    return vector_store
@@ -0,0 +1,217 @@
+# background ingestion jobs
+import os
+import json
+import time
+import uuid
+import queue
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+# Worker pool / queue sizing (override via .env)
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "16"))
+JOB_HISTORY = int(os.getenv("JOB_HISTORY", "200"))
+# Job status shared by every worker process; progress is written at most this often
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "cache/jobs.sqlite")
+JOB_PERSIST_INTERVAL = float(os.getenv("JOB_PERSIST_INTERVAL", "0.5"))
+
+
+class QueueFullError(Exception):
+    """Raised when the ingestion queue has no free slot."""
+
+
+class JobStore:
+    """SQLite table of job snapshots, so /jobs/{id} works on any worker process."""
+
+    def __init__(self, path: str = JOBS_DB_PATH, history: int = JOB_HISTORY):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.history = history
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)")
+        self._conn.commit()
+
+    def save(self, data: dict):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, data, updated) VALUES (?, ?, ?)",
+                (data["job_id"], json.dumps(data), data["updated_at"]),
+            )
+            self._conn.commit()
+
+    def load(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def prune(self):
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM jobs WHERE id NOT IN (SELECT id FROM jobs ORDER BY updated DESC LIMIT ?)",
+                (self.history,),
+            )
+            self._conn.commit()
+
+
+class Job:
+    """State and progress counters of one ingestion job."""
+
+    def __init__(self, filename: str, store: Optional[JobStore] = None):
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.status = "queued"      # queued -> running -> succeeded | failed
+        self.stage = "queued"       # parsing / splitting / embedding / saving / done
+        self.pages_parsed = 0
+        self.chunks_total = 0
+        self.chunks_embedded = 0
+        self.bytes_saved = 0
+        self.boilerplate_lines = 0    # removed by tools.preprocess
+        self.chunks_deduplicated = 0
+        self.tokens_saved = 0
+        self.error = None
+        self.timings = None         # per-stage breakdown, set when the job ends
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self._lock = threading.Lock()
+        self._store = store
+        self._persisted_at = 0.0
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Job":
+        """Read-only copy of a job tracked by another worker process."""
+        job = cls(data["filename"])
+        for name, value in data.items():
+            setattr(job, "id" if name == "job_id" else name, value)
+        return job
+
+    def _persist(self, force: bool = False):
+        if self._store is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._persisted_at < JOB_PERSIST_INTERVAL:
+            return
+        self._persisted_at = now
+        self._store.save(self.to_dict())
+
+    # Progress hooks used by tools.pdf_tool
+    def set_stage(self, stage: str):
+        with self._lock:
+            self.stage = stage
+            self.updated_at = time.time()
+        self._persist(force=True)
+
+    def update(self, **fields):
+        with self._lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.updated_at = time.time()
+        self._persist(force="status" in fields or "stage" in fields)
+
+    def advance(self, field: str, n: int = 1):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + n)
+            self.updated_at = time.time()
+        self._persist()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "job_id": self.id,
+                "filename": self.filename,
+                "status": self.status,
+                "stage": self.stage,
+                "pages_parsed": self.pages_parsed,
+                "chunks_total": self.chunks_total,
+                "chunks_embedded": self.chunks_embedded,
+                "bytes_saved": self.bytes_saved,
+                "boilerplate_lines": self.boilerplate_lines,
+                "chunks_deduplicated": self.chunks_deduplicated,
+                "tokens_saved": self.tokens_saved,
+                "error": self.error,
+                "timings": self.timings,
+                "created_at": self.created_at,
+                "updated_at": self.updated_at,
+            }
+
+
+class JobQueue:
+    """
+    Bounded FIFO of ingestion jobs drained by a fixed pool of worker threads.
+    `task(job)` runs on a worker; it reports progress through the job hooks.
+    """
+
+    def __init__(self, workers: int = INGEST_WORKERS, maxsize: int = INGEST_QUEUE_SIZE, history: int = JOB_HISTORY,
+                 store: Optional[JobStore] = None):
+        self._store = store
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._history = history
+        self._threads = []
+        for i in range(max(1, workers)):
+            t = threading.Thread(target=self._worker, name=f"ingest-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, filename: str, task: Callable[[Job], None]) -> Job:
+        job = Job(filename, store=self._store)
+        with self._lock:
+            self._jobs[job.id] = job
+            try:
+                self._queue.put_nowait((job, task))
+            except queue.Full:
+                del self._jobs[job.id]
+                raise QueueFullError("Ingestion queue is full, try again later.")
+            self._prune()
+        job._persist(force=True)
+        return job
+
+    def record(self, filename: str, stage: str = "done") -> Job:
+        """Track a job that finished without queueing (e.g. a deduplicated upload)."""
+        job = Job(filename, store=self._store)
+        job.update(status="succeeded", stage=stage)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Jobs of this process first, then those persisted by other workers."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self._store is not None:
+            data = self._store.load(job_id)
+            job = Job.from_dict(data) if data else None
+        return job
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _prune(self):
+        # Forget the oldest finished jobs beyond the history limit
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self._history)]:
+            del self._jobs[job_id]
+        if self._store is not None and finished:
+            self._store.prune()
+
+    def _worker(self):
+        while True:
+            job, task = self._queue.get()
+            job.update(status="running")
+            try:
+                task(job)
+                job.update(status="succeeded", stage="done")
+            except Exception as e:
+                job.update(status="failed", error=str(e))
+                print(f" Ingestion job {job.id} for '{job.filename}' failed: {e}")
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,120 @@
+# BM25 inverted index over chunks, stored next to the FAISS files
+import os
+import re
+from collections import Counter
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+LEXICAL_FILE = "lexical.npz"
+BM25_K1 = float(os.getenv("BM25_K1", "1.5"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+# Keeps "3.2", "x-ray" and "h2o" as single terms
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[.\-][a-z0-9]+)*")
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+
+class LexicalIndex:
+    """
+    BM25 over chunk ids (== FAISS row ids). Postings are flat numpy arrays:
+    terms[t] owns doc_ids/tfs[offsets[t]:offsets[t + 1]].
+    """
+
+    def __init__(self, terms: np.ndarray, offsets: np.ndarray, doc_ids: np.ndarray,
+                 tfs: np.ndarray, doc_lens: np.ndarray):
+        self.terms = terms
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_lens = doc_lens
+        self.n_docs = len(doc_lens)
+        self.avg_len = float(doc_lens.mean()) if self.n_docs else 0.0
+
+    @classmethod
+    def build(cls, texts: Iterable[str]) -> "LexicalIndex":
+        postings = {}
+        doc_lens = []
+        for doc_id, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_lens.append(sum(counts.values()))
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append((doc_id, tf))
+
+        terms = sorted(postings)
+        offsets = [0]
+        doc_ids, tfs = [], []
+        for term in terms:
+            for doc_id, tf in postings[term]:
+                doc_ids.append(doc_id)
+                tfs.append(min(tf, 65535))
+            offsets.append(len(doc_ids))
+        return cls(
+            np.asarray(terms, dtype=np.str_),
+            np.asarray(offsets, dtype=np.int64),
+            np.asarray(doc_ids, dtype=np.int32),
+            np.asarray(tfs, dtype=np.uint16),
+            np.asarray(doc_lens, dtype=np.int32),
+        )
+
+    def save(self, folder_path: str):
+        tmp = os.path.join(folder_path, LEXICAL_FILE + ".tmp.npz")
+        np.savez_compressed(tmp, terms=self.terms, offsets=self.offsets, doc_ids=self.doc_ids,
+                            tfs=self.tfs, doc_lens=self.doc_lens)
+        os.replace(tmp, os.path.join(folder_path, LEXICAL_FILE))
+
+    @classmethod
+    def load(cls, folder_path: str) -> "LexicalIndex":
+        with np.load(os.path.join(folder_path, LEXICAL_FILE), allow_pickle=False) as data:
+            return cls(data["terms"], data["offsets"], data["doc_ids"], data["tfs"], data["doc_lens"])
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in (self.terms, self.offsets, self.doc_ids, self.tfs, self.doc_lens))
+
+    def _postings(self, term: str):
+        t = int(np.searchsorted(self.terms, term))
+        if t >= len(self.terms) or self.terms[t] != term:
+            return None
+        return self.doc_ids[self.offsets[t]:self.offsets[t + 1]], self.tfs[self.offsets[t]:self.offsets[t + 1]]
+
+    def covers(self, query: str) -> bool:
+        """True when every query term occurs somewhere in the corpus."""
+        terms = tokenize(query)
+        return bool(terms) and all(self._postings(term) is not None for term in terms)
+
+    def search(self, query: str, k: int) -> List[Tuple[int, float]]:
+        """Top k (chunk id, BM25 score), best first."""
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for term in set(tokenize(query)):
+            found = self._postings(term)
+            if found is None:
+                continue
+            doc_ids, tfs = found
+            df = len(doc_ids)
+            idf = np.log(1.0 + (self.n_docs - df + 0.5) / (df + 0.5))
+            tf = tfs.astype(np.float32)
+            norm = BM25_K1 * (1.0 - BM25_B + BM25_B * self.doc_lens[doc_ids] / self.avg_len)
+            scores[doc_ids] += idf * tf * (BM25_K1 + 1.0) / (tf + norm)
+
+        hits = np.flatnonzero(scores)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        hits = hits[np.argsort(-scores[hits], kind="stable")]
+        return [(int(i), float(scores[i])) for i in hits]
+
+
+def build_lexical_index(folder_path: str, texts: Iterable[str]) -> LexicalIndex:
+    index = LexicalIndex.build(texts)
+    index.save(folder_path)
+    return index
+
+
+def load_lexical_index(folder_path: str) -> Optional[LexicalIndex]:
+    """The folder's BM25 index, or None for folders ingested before it existed."""
+    if not os.path.exists(os.path.join(folder_path, LEXICAL_FILE)):
+        return None
+    return LexicalIndex.load(folder_path)
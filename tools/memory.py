@@ -1,18 +1,339 @@
 # memory
 import os
-from langchain.memory.buffer import ConversationBufferMemory
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 
+try:
+    import fcntl  # cross-process turn locks (POSIX only)
+except ImportError:
+    fcntl = None
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 
+# Storage and token-budget policy (override via .env)
+MEMORY_DB_PATH = os.getenv("MEMORY_DB_PATH", "cache/memory.sqlite")
+# Hard cap on history tokens sent with each prompt (summary + verbatim turns)
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "2000"))
+# Most recent turns kept verbatim; anything older is folded into the summary
+MEMORY_RECENT_TOKENS = int(os.getenv("MEMORY_RECENT_TOKENS", "1000"))
+# One lock file per (session, PDF), shared by every worker process
+MEMORY_LOCK_DIR = os.getenv("MEMORY_LOCK_DIR", "cache/locks/")
 
-def get_conversation_memory(pdf_name:str , memory_key:str="chat_history"):
+SUMMARY_PROMPT = (
+    "Progressively summarize the conversation between a student and StudyMate, "
+    "a tutor answering questions about a PDF. Extend the current summary with the "
+    "new lines and return only the new summary, in at most 200 words.\n\n"
+    "Current summary:\n{summary}\n\nNew lines:\n{lines}\n\nNew summary:"
+)
 
-    scoped_memory_key = f"{os.path.splitext(pdf_name)[0]}_{memory_key}"
 
-    memory= ConversationBufferMemory(
-        memory_key=memory_key,
-        return_messages=True  # required for message-style history
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token)."""
+    return max(1, len(text) // 4)
+
+
+def truncate_to_tokens(text: str, tokens: int) -> str:
+    """Cut text to at most `tokens` (same estimate as estimate_tokens), marking the cut."""
+    if estimate_tokens(text) <= tokens:
+        return text
+    if tokens <= 0:
+        return ""
+    return text[:tokens * 4 - 4] + " ..."
+
+
+class ConversationStore:
+    """SQLite-backed messages and rolling summaries, one scope per (session, PDF)."""
+
+    def __init__(self, path: str = MEMORY_DB_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Other worker processes write the same file; wait for their locks instead of failing
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, pdf TEXT NOT NULL,"
+            " role TEXT NOT NULL, content TEXT NOT NULL, tokens INTEGER NOT NULL, created REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_scope ON messages(session_id, pdf, id)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS summaries ("
+            " session_id TEXT NOT NULL, pdf TEXT NOT NULL, summary TEXT NOT NULL,"
+            " upto_id INTEGER NOT NULL, updated REAL NOT NULL, PRIMARY KEY (session_id, pdf))"
+        )
+        self._conn.commit()
+
+    def append(self, session_id: str, pdf: str, pairs):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO messages (session_id, pdf, role, content, tokens, created) VALUES (?, ?, ?, ?, ?, ?)",
+                [(session_id, pdf, role, content, estimate_tokens(content), now) for role, content in pairs],
+            )
+            self._conn.commit()
+
+    def summary(self, session_id: str, pdf: str):
+        """(summary text, id of the last message folded into it)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT summary, upto_id FROM summaries WHERE session_id = ? AND pdf = ?",
+                (session_id, pdf),
+            ).fetchone()
+        return row if row else ("", 0)
+
+    def messages_after(self, session_id: str, pdf: str, after_id: int):
+        """[(id, role, content, tokens)] oldest first."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, role, content, tokens FROM messages"
+                " WHERE session_id = ? AND pdf = ? AND id > ? ORDER BY id",
+                (session_id, pdf, after_id),
+            ).fetchall()
+
+    def save_summary(self, session_id: str, pdf: str, summary: str, upto_id: int, previous_upto_id: int = 0) -> bool:
+        """Store a summary built on top of `previous_upto_id`; a no-op if another
+        process already moved the summary on (returns False then)."""
+        with self._lock:
+            changed = self._conn.execute(
+                "INSERT INTO summaries (session_id, pdf, summary, upto_id, updated) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT(session_id, pdf) DO UPDATE SET"
+                " summary = excluded.summary, upto_id = excluded.upto_id, updated = excluded.updated"
+                " WHERE summaries.upto_id = ?",
+                (session_id, pdf, summary, upto_id, time.time(), previous_upto_id),
+            ).rowcount
+            if changed:
+                # Summarized turns are no longer needed verbatim
+                self._conn.execute(
+                    "DELETE FROM messages WHERE session_id = ? AND pdf = ? AND id <= ?",
+                    (session_id, pdf, upto_id),
+                )
+            self._conn.commit()
+            return bool(changed)
+
+    def recent_pdfs(self, limit: int) -> list:
+        """PDF scopes (names without extension) by latest conversation activity, newest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT pdf FROM (SELECT pdf, created AS at FROM messages UNION ALL SELECT pdf, updated FROM summaries)"
+                " GROUP BY pdf ORDER BY MAX(at) DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def clear(self, pdf: str, session_id: str = None):
+        with self._lock:
+            for table in ("messages", "summaries"):
+                if session_id is None:
+                    self._conn.execute(f"DELETE FROM {table} WHERE pdf = ?", (pdf,))
+                else:
+                    self._conn.execute(f"DELETE FROM {table} WHERE pdf = ? AND session_id = ?", (pdf, session_id))
+            self._conn.commit()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+# Summaries are computed here, off the request path (one at a time per scope)
+_summarizer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-summarizer")
+_pending_summaries = set()
+_pending_lock = threading.Lock()
+
+
+def get_store() -> ConversationStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ConversationStore()
+        return _store
+
+
+def default_summarize(summary: str, lines: str) -> str:
+    from tools.chat_engine import get_llm  # lazy: chat_engine imports this module
+
+    response = get_llm().invoke(SUMMARY_PROMPT.format(summary=summary or "(none)", lines=lines),
+                                config={"tags": ["memory_summary"]})
+    return str(getattr(response, "content", response)).strip()
+
+
+class TokenBudgetMemory:
+    """
+    Conversation memory for one (session, PDF) scope with a bounded prompt
+    footprint: a rolling summary of older turns plus the most recent turns
+    verbatim. Exposes the load_memory_variables / save_context interface the
+    chat endpoints already use.
+    """
+
+    def __init__(self, session_id: str, pdf: str, memory_key: str = "chat_history",
+                 store: ConversationStore = None, summarize=default_summarize,
+                 token_budget: int = MEMORY_TOKEN_BUDGET, recent_tokens: int = MEMORY_RECENT_TOKENS):
+        self.session_id = session_id
+        self.pdf = pdf
+        self.memory_key = memory_key
+        self.store = store or get_store()
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self.recent_tokens = recent_tokens
+
+    def load_memory_variables(self, inputs: dict = None) -> dict:
+        summary, upto_id = self.store.summary(self.session_id, self.pdf)
+        rows = self.store.messages_after(self.session_id, self.pdf, upto_id)
 
+        budget = self.token_budget
+        if summary:
+            summary = truncate_to_tokens(summary, budget)
+            budget -= estimate_tokens(summary)
+
+        # Whole (question, answer) turns, newest first, until the budget is used up
+        turns = []
+        for _, role, content, tokens in rows:
+            if role == "human" or not turns or turns[-1][-1][0] == "ai":
+                turns.append([])
+            turns[-1].append((role, content, tokens))
+        kept = []
+        for turn in reversed(turns):
+            cost = sum(tokens for _, _, tokens in turn)
+            if cost <= budget:
+                kept[:0] = [(role, content) for role, content, _ in turn]
+                budget -= cost
+                continue
+            if not kept:
+                # The newest turn alone is over budget: cut the question to half, the answer to the rest
+                for i, (role, content, tokens) in enumerate(turn):
+                    content = truncate_to_tokens(content, budget if i == len(turn) - 1 else min(tokens, budget // 2))
+                    if content:
+                        kept.append((role, content))
+                        budget -= estimate_tokens(content)
+            break
+
+        messages = [SystemMessage(content=f"Summary of the earlier conversation: {summary}")] if summary else []
+        for role, content in kept:
+            messages.append(HumanMessage(content=content) if role == "human" else AIMessage(content=content))
+        return {self.memory_key: messages}
+
+    def save_context(self, inputs: dict, outputs: dict):
+        question = inputs.get("input") or inputs.get("question") or ""
+        answer = outputs.get("output") or outputs.get("answer") or ""
+        self.store.append(self.session_id, self.pdf, [("human", question), ("ai", answer)])
+        self._maybe_schedule_summary()
+
+    def clear(self):
+        self.store.clear(self.pdf, self.session_id)
+
+    def _maybe_schedule_summary(self):
+        _, upto_id = self.store.summary(self.session_id, self.pdf)
+        rows = self.store.messages_after(self.session_id, self.pdf, upto_id)
+        if sum(row[3] for row in rows) <= self.token_budget:
+            return
+        scope = (self.session_id, self.pdf)
+        with _pending_lock:
+            if scope in _pending_summaries:
+                return
+            _pending_summaries.add(scope)
+        _summarizer.submit(self._fold_old_turns)
+
+    def _fold_old_turns(self):
+        try:
+            summary, upto_id = self.store.summary(self.session_id, self.pdf)
+            rows = self.store.messages_after(self.session_id, self.pdf, upto_id)
+
+            # Keep the newest `recent_tokens` verbatim; fold everything older
+            recent = 0
+            cut = len(rows)
+            while cut > 0 and recent + rows[cut - 1][3] <= self.recent_tokens:
+                cut -= 1
+                recent += rows[cut][3]
+            old = rows[:cut]
+            if not old:
+                return
+            lines = "\n".join(f"{'Student' if role == 'human' else 'StudyMate'}: {content}" for _, role, content, _ in old)
+            new_summary = self.summarize(summary, lines)
+            self.store.save_summary(self.session_id, self.pdf, new_summary, old[-1][0], previous_upto_id=upto_id)
+        except Exception as e:
+            print(f" Memory summarization failed for {self.session_id}/{self.pdf}: {e}")
+        finally:
+            with _pending_lock:
+                _pending_summaries.discard((self.session_id, self.pdf))
+
+
+
+def get_conversation_memory(pdf_name:str , memory_key:str="chat_history", session_id:str="default"):
+
+    scoped_pdf = os.path.splitext(pdf_name)[0]
+
+    memory = TokenBudgetMemory(
+        session_id=session_id,
+        pdf=scoped_pdf,
+        memory_key=memory_key,
     )
 
     return memory
 
+
+# In-process half of the turn lock; the file lock covers the other workers
+_turn_locks = {}
+_turn_locks_guard = threading.Lock()
+
+
+def _acquire_file_lock(path: str):
+    f = open(path, "a")
+    fcntl.flock(f, fcntl.LOCK_EX)
+    return f
+
+
+def _release_file_lock(f):
+    fcntl.flock(f, fcntl.LOCK_UN)
+    f.close()
+
+
+@asynccontextmanager
+async def conversation_turn(pdf_name: str, session_id: str = "default"):
+    """
+    Serialize chat turns of one (session, PDF) so each turn reads the history
+    the previous one saved. Waiting happens off the event loop.
+    """
+    scope = (session_id, os.path.splitext(pdf_name)[0])
+    with _turn_locks_guard:
+        entry = _turn_locks.setdefault(scope, [asyncio.Lock(), 0])
+        entry[1] += 1
+    try:
+        async with entry[0]:
+            if fcntl is None:
+                yield
+                return
+            os.makedirs(MEMORY_LOCK_DIR, exist_ok=True)
+            name = hashlib.sha256("\x00".join(scope).encode("utf-8")).hexdigest()[:32]
+            acquiring = asyncio.ensure_future(
+                asyncio.to_thread(_acquire_file_lock, os.path.join(MEMORY_LOCK_DIR, f"{name}.lock"))
+            )
+            try:
+                f = await asyncio.shield(acquiring)
+            except asyncio.CancelledError:
+                # The thread still gets the lock; hand it back as soon as it does
+                acquiring.add_done_callback(
+                    lambda done: done.cancelled() or done.exception() or _release_file_lock(done.result())
+                )
+                raise
+            try:
+                yield
+            finally:
+                _release_file_lock(f)
+    finally:
+        with _turn_locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                _turn_locks.pop(scope, None)
+
+
+def recently_chatted_pdfs(limit: int) -> list:
+    """Names (without extension) of the PDFs chatted with most recently, newest first."""
+    return get_store().recent_pdfs(limit)
+
+
+def clear_conversation_memory(pdf_name:str , session_id:str=None):
+    """Forget the history of one session, or of every session when session_id is None."""
+    get_store().clear(os.path.splitext(pdf_name)[0], session_id)
@@ -0,0 +1,182 @@
+# timing spans, per-request breakdowns and Prometheus metrics
+import os
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+
+_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+STAGE_SECONDS = Histogram(
+    "studymate_stage_seconds", "Time spent in one pipeline stage.", ["pipeline", "stage"], buckets=_BUCKETS,
+)
+STAGE_TOKENS = Counter(
+    "studymate_stage_tokens_total", "Tokens processed by a pipeline stage.", ["pipeline", "stage", "kind"],
+)
+CACHE_LOOKUPS = Counter(
+    "studymate_cache_lookups_total", "Cache lookups by cache and result.", ["cache", "result"],
+)
+HTTP_SECONDS = Histogram(
+    "studymate_http_request_seconds", "HTTP request latency.", ["method", "route", "status"], buckets=_BUCKETS,
+)
+
+# Trace of the request / ingestion job running in this context (asyncio.to_thread and
+# LangChain's executors copy context, so spans recorded on worker threads land here too)
+_current_trace = contextvars.ContextVar("studymate_trace", default=None)
+
+
+class Trace:
+    """Per-request (or per-job) totals of every stage: time, calls, tokens and cache lookups."""
+
+    def __init__(self, pipeline: str):
+        self.pipeline = pipeline
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.caches = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float, **attrs):
+        STAGE_SECONDS.labels(self.pipeline, stage).observe(seconds)
+        with self._lock:
+            entry = self.stages.setdefault(stage, {"ms": 0.0, "calls": 0})
+            entry["ms"] += seconds * 1000
+            entry["calls"] += 1
+            for name, value in attrs.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    entry[name] = entry.get(name, 0) + value
+                else:
+                    entry[name] = value
+        for kind in ("tokens", "prompt_tokens", "completion_tokens"):
+            if attrs.get(kind):
+                STAGE_TOKENS.labels(self.pipeline, stage, kind).inc(attrs[kind])
+
+    def cache(self, cache: str, hits: int, misses: int):
+        with self._lock:
+            entry = self.caches.setdefault(cache, {"hits": 0, "misses": 0})
+            entry["hits"] += hits
+            entry["misses"] += misses
+
+    def breakdown(self) -> dict:
+        with self._lock:
+            return {
+                "total_ms": (time.perf_counter() - self.started) * 1000,
+                "stages": {stage: dict(entry) for stage, entry in self.stages.items()},
+                "caches": {cache: dict(entry) for cache, entry in self.caches.items()},
+            }
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def use_trace(trace: Trace):
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(stage: str, pipeline: str = None, **attrs):
+    """
+    Time a block as `stage` of the current trace. The yielded dict can be
+    filled with extra attributes (token counts, flags) before the block ends.
+    Without a trace the timing still reaches Prometheus under `pipeline`.
+    """
+    extra = dict(attrs)
+    start = time.perf_counter()
+    try:
+        yield extra
+    finally:
+        seconds = time.perf_counter() - start
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.record(stage, seconds, **extra)
+        else:
+            STAGE_SECONDS.labels(pipeline or "background", stage).observe(seconds)
+
+
+def record_cache(cache: str, hits: int = 0, misses: int = 0):
+    if hits:
+        CACHE_LOOKUPS.labels(cache, "hit").inc(hits)
+    if misses:
+        CACHE_LOOKUPS.labels(cache, "miss").inc(misses)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.cache(cache, hits, misses)
+
+
+# Tags that name an LLM call's stage; untagged calls are the answer generation ("llm")
+LLM_STAGE_TAGS = ("query_expansion", "memory_summary")
+
+
+class LLMMetricsCallback(BaseCallbackHandler):
+    """
+    Records every chat-model call as a span (stage from LLM_STAGE_TAGS, else
+    "llm") with token usage and time to first token.
+    """
+
+    def __init__(self):
+        self._runs = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, tags=None, **kwargs):
+        prompt_chars = sum(len(str(m.content)) for batch in messages for m in batch)
+        self._runs[run_id] = {"start": time.perf_counter(), "stage": next((t for t in tags or [] if t in LLM_STAGE_TAGS), "llm"),
+                              "first_token": None, "prompt_chars": prompt_chars, "trace": _current_trace.get()}
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        run = self._runs.get(run_id)
+        if run and run["first_token"] is None:
+            run["first_token"] = time.perf_counter()
+
+    def _finish(self, run_id, prompt_tokens=None, completion_tokens=None, error=False):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        end = time.perf_counter()
+        attrs = {
+            "prompt_tokens": prompt_tokens if prompt_tokens is not None else run["prompt_chars"] // 4,
+            "completion_tokens": completion_tokens or 0,
+        }
+        if run["first_token"] is not None:
+            attrs["ttft_ms"] = (run["first_token"] - run["start"]) * 1000
+        if error:
+            attrs["errors"] = 1
+        trace = run["trace"] or _current_trace.get()
+        if trace is not None:
+            trace.record(run["stage"], end - run["start"], **attrs)
+        else:
+            STAGE_SECONDS.labels("background", run["stage"]).observe(end - run["start"])
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        prompt_tokens = completion_tokens = None
+        try:
+            generation = response.generations[0][0]
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+            prompt_tokens = usage.get("input_tokens")
+            completion_tokens = usage.get("output_tokens") or max(1, len(generation.text) // 4)
+        except (IndexError, AttributeError):
+            pass
+        self._finish(run_id, prompt_tokens, completion_tokens)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id, error=True)
+
+
+llm_metrics_callback = LLMMetricsCallback()
+
+
+def prometheus_payload():
+    """(body, content type) for the /metrics endpoint; aggregates every worker
+    process when PROMETHEUS_MULTIPROC_DIR is set."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,191 @@
+# PDF text extraction backends
+import os
+import time
+import signal
+import threading
+import importlib.util
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterator, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+# PyMuPDF is optional (fallback: PyPDFLoader); both are imported on first extraction, not at startup
+HAS_PYMUPDF = importlib.util.find_spec("fitz") is not None
+
+# "auto" picks PyMuPDF when installed, otherwise PyPDFLoader (override via .env)
+PDF_BACKEND = os.getenv("PDF_BACKEND", "auto")
+# Capped: extraction shares the CPU with embedding and chat requests
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "16"))
+# Below this many pages a process pool costs more than it saves
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "32"))
+
+BACKENDS = ("auto", "pymupdf", "pypdf")
+
+
+def resolve_backend(backend: Optional[str] = None) -> str:
+    backend = (backend or PDF_BACKEND).lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown PDF backend '{backend}'. Choose one of {BACKENDS}.")
+    if backend == "auto":
+        return "pymupdf" if HAS_PYMUPDF else "pypdf"
+    if backend == "pymupdf" and not HAS_PYMUPDF:
+        raise ImportError("PDF_BACKEND=pymupdf requires PyMuPDF (pip install PyMuPDF).")
+    return backend
+
+
+def _extract_range(file_path: str, start: int, end: int) -> List[Tuple[int, str, str]]:
+    """Worker: (page index, page label, text) for pages [start, end)."""
+    import fitz
+    with fitz.open(file_path) as pdf:
+        out = []
+        for i in range(start, end):
+            page = pdf[i]
+            out.append((i, page.get_label() or str(i + 1), page.get_text("text")))
+        return out
+
+
+def _init_worker():
+    # Forked children inherit the server's signal handlers, which only set a flag
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+
+
+def _noop():
+    return None
+
+
+# Persistent extraction pool, forked once per process by start_pool()
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def start_pool(workers: int = PDF_EXTRACT_WORKERS) -> Optional[ProcessPoolExecutor]:
+    """
+    Fork the extraction workers. Forked children reuse the imported app and
+    start instantly, but forking is only safe before this process starts
+    threads of its own, so the server calls this first thing at startup.
+    Returns None when there is no pool (pages are then extracted in-process).
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None and workers > 1 and HAS_PYMUPDF and "fork" in multiprocessing.get_all_start_methods():
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"),
+                                        initializer=_init_worker)
+            _pool.submit(_noop).result()  # a fork pool starts every worker on its first task
+        return _pool
+
+
+def get_pool(workers: int = PDF_EXTRACT_WORKERS) -> Optional[ProcessPoolExecutor]:
+    """The started pool; a single-threaded caller (CLI, benchmark) starts one on demand."""
+    if _pool is None and threading.active_count() == 1:
+        return start_pool(workers)
+    return _pool
+
+
+def _discard_pool(pool: ProcessPoolExecutor, wait: bool = False):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=wait, cancel_futures=True)
+
+
+def _drop_broken(pool: Optional[ProcessPoolExecutor]) -> None:
+    if pool is not None:
+        print(" PDF extraction pool broke; extracting the remaining pages in-process.")
+        _discard_pool(pool)
+
+
+def shutdown_pool():
+    """Stop the workers (server shutdown); waits so no child outlives the process."""
+    with _pool_lock:
+        pool = _pool
+    if pool is not None:
+        _discard_pool(pool, wait=True)
+
+
+def _to_document(file_path: str, total: int, page: int, label: str, text: str) -> Document:
+    # Same keys PyPDFLoader emits, so chunks and citations look identical
+    return Document(
+        page_content=text,
+        metadata={"source": file_path, "page": page, "page_label": label, "total_pages": total},
+    )
+
+
+def iter_pages_pymupdf(
+    file_path: str,
+    workers: int = PDF_EXTRACT_WORKERS,
+    pages_per_task: int = PDF_PAGES_PER_TASK,
+) -> Iterator[Document]:
+    """
+    Yield pages in order while the extraction pool works on page ranges in
+    parallel. At most 2 ranges per worker are outstanding, so a slow consumer
+    keeps memory bounded. If a worker dies, the rest is extracted in-process.
+    """
+    import fitz
+    with fitz.open(file_path) as pdf:
+        total = pdf.page_count
+
+    pool = get_pool(workers) if total >= PDF_PARALLEL_MIN_PAGES else None
+    if pool is None:
+        for page, label, text in _extract_range(file_path, 0, total):
+            yield _to_document(file_path, total, page, label, text)
+        return
+
+    ranges = deque((start, min(start + pages_per_task, total)) for start in range(0, total, pages_per_task))
+    in_flight = deque()
+    while ranges or in_flight:
+        try:
+            while pool is not None and ranges and len(in_flight) < workers * 2:
+                start, end = ranges[0]
+                in_flight.append((pool.submit(_extract_range, file_path, start, end), start, end))
+                ranges.popleft()
+        except BrokenProcessPool:
+            pool = _drop_broken(pool)
+        if in_flight:
+            future, start, end = in_flight.popleft()
+            try:
+                pages = future.result()
+            except BrokenProcessPool:
+                pool = _drop_broken(pool)
+                pages = _extract_range(file_path, start, end)
+        else:
+            start, end = ranges.popleft()
+            pages = _extract_range(file_path, start, end)
+        for page, label, text in pages:
+            yield _to_document(file_path, total, page, label, text)
+
+
+def iter_pages(file_path: str, backend: Optional[str] = None) -> Iterator[Document]:
+    """Lazily yield one Document per page using the selected backend."""
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"PDF file '{file_path}' not found.")
+    if resolve_backend(backend) == "pymupdf":
+        return iter_pages_pymupdf(file_path)
+    from langchain_community.document_loaders import PyPDFLoader
+    return PyPDFLoader(file_path).lazy_load()
+
+
+def measure_throughput(file_path: str, backend: str) -> dict:
+    start = time.perf_counter()
+    pages = sum(1 for _ in iter_pages(file_path, backend))
+    elapsed = time.perf_counter() - start
+    return {"backend": backend, "pages": pages, "seconds": elapsed, "pages_per_sec": pages / elapsed if elapsed else 0.0}
+
+
+#  Throughput comparison: python -m tools.pdf_extract <file.pdf>
+if __name__ == "__main__":
+    import sys
+
+    path = sys.argv[1] if len(sys.argv) > 1 else "temp/file"
+    for name in ("pypdf", "pymupdf"):
+        try:
+            r = measure_throughput(path, name)
+        except ImportError as e:
+            print(f"{name:8s} skipped: {e}")
+            continue
+        print(f"{name:8s} {r['pages']:6d} pages in {r['seconds']:7.2f}s -> {r['pages_per_sec']:8.1f} pages/s")
@@ -1,69 +1,306 @@
 import os
+import queue
 import pathlib
-from langchain_community.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import threading
+import contextvars
 from langchain_community.vectorstores import FAISS
-from langchain_openai import OpenAIEmbeddings
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
+from tools.embedding_cache import get_cached_embeddings
+from tools import pdf_extract
+from tools.preprocess import (
+    STRIP_BOILERPLATE, DEDUP_CHUNKS, BoilerplateStripper, ChunkDeduplicator, PreprocessStats, get_text_splitter,
+)
+from tools.index_builder import apply_index_type
+from tools.segments import write_segment, commit_segment
+from tools.memory import estimate_tokens
+from tools.metrics import span
+from tools.embedding_batcher import (
+    embed_in_batches, checkpoint_path_for, EmbeddingCheckpoint, Backoff,
+    EMBED_BATCH_SIZE, EMBED_MAX_IN_FLIGHT,
+)
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# Memory ceiling for chunks parsed but not yet embedded + indexed (MB)
+INGEST_MEMORY_MB = float(os.getenv("INGEST_MEMORY_MB", "256"))
+# Rough in-memory cost of one embedding vector held as Python floats
+EST_VECTOR_BYTES = 768 * 32
 
-# Load PDF
-def load_pdf(file_path: str):
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"PDF file '{file_path}' not found.")
 
+# Load PDF
+# `backend` is "pymupdf" (parallel), "pypdf" (PyPDFLoader) or "auto"; default from PDF_BACKEND.
+def load_pdf(file_path: str, backend=None):
     print(f"Loading PDF: {file_path}")
-    loader = PyPDFLoader(file_path)
-    docs = loader.load()
+    docs = list(pdf_extract.iter_pages(file_path, backend))
     print(f"Loaded {len(docs)} pages.")
     return docs
 
 
-# Split text into chunks
+# Lazily yield one Document per page
+def iter_pages(file_path: str, backend=None):
+    pages = pdf_extract.iter_pages(file_path, backend)
+    print(f"Streaming PDF: {file_path} ({pdf_extract.resolve_backend(backend)} backend)")
+    yield from pages
+
+
+# Split text into chunks (boilerplate stripped, duplicates dropped)
 def split_chunks(docs: list):
     print(" Splitting text into chunks...")
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200
-    )
-    chunks = splitter.split_documents(docs)
+    chunks = list(iter_chunks(docs))
     print(f"Created {len(chunks)} chunks.")
     return chunks
 
 
+# Total bytes on disk under a folder
+def folder_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
 # Create & save FAISS vectorstore
-def create_and_save_vectorstore(docs, pdf_name: str, base_dir="vectorstore/"):
+# `progress` is an optional tools.jobs.Job that receives stage/counter updates.
+def create_and_save_vectorstore(docs, pdf_name: str, base_dir="vectorstore/", embeddings=None, progress=None):
     print("Generating embeddings and creating FAISS vectorstore...")
-    embeddings = GoogleGenerativeAIEmbeddings(
-        model="models/embedding-001")
-    vectorstore = FAISS.from_documents(docs, embeddings)
+    # Cached wrapper: only chunks not seen before hit the embedding API
+    embeddings = embeddings or get_cached_embeddings()
+
+    # Batched, concurrent embedding; finished batches are checkpointed so a retry resumes
+    texts = [doc.page_content for doc in docs]
+    metadatas = [doc.metadata for doc in docs]
+    if progress:
+        progress.update(stage="embedding", chunks_total=len(texts))
+    with span("embed", pipeline="ingest", chunks=len(texts), tokens=sum(estimate_tokens(t) for t in texts)):
+        vectors = embed_in_batches(
+            texts,
+            embeddings,
+            checkpoint_path=checkpoint_path_for(pdf_name),
+            on_batch=(lambda n: progress.advance("chunks_embedded", n)) if progress else None,
+        )
+    with span("index", pipeline="ingest"):
+        vectorstore = FAISS.from_embeddings(list(zip(texts, vectors)), embeddings, metadatas=metadatas)
 
     # Save vectorstore to folder: vectorstore/<pdf_name_without_extension>/
     pdf_folder = os.path.join(base_dir, pathlib.Path(pdf_name).stem)
-    os.makedirs(pdf_folder, exist_ok=True)
+    save_vectorstore_segment(vectorstore, pdf_folder, progress=progress)
+    return vectorstore
+
 
+# Write a store as a new segment of `pdf_folder` and publish it atomically.
+# replace=True (a full ingest) retires the previous segments; False appends.
+def save_vectorstore_segment(vectorstore, pdf_folder: str, progress=None, replace: bool = True):
+    os.makedirs(pdf_folder, exist_ok=True)
     print(f" Saving vectorstore to: {pdf_folder}")
-    vectorstore.save_local(pdf_folder)
+    if progress:
+        progress.set_stage("saving")
+    # Convert to the configured index type (INDEX_TYPE / INDEX_QUANTIZATION)
+    with span("index_build", pipeline="ingest"):
+        index_meta = apply_index_type(vectorstore)
+    with span("save", pipeline="ingest"):
+        segment = write_segment(pdf_folder, vectorstore, index_meta)
+        commit_segment(pdf_folder, segment, vectorstore.index.ntotal, replace=replace)
+    if progress:
+        progress.update(bytes_saved=folder_size(os.path.join(pdf_folder, segment)))
     print(f" Vectorstore saved successfully.")
 
+
+# Split pages into chunks one page at a time. Repeated header/footer lines are
+# stripped first and duplicate chunks dropped; `stats` collects what was removed.
+def iter_chunks(pages, splitter=None, progress=None, stats=None):
+    splitter = splitter or get_text_splitter()
+    stats = stats or PreprocessStats()
+    pages = iter(BoilerplateStripper(stats).run(pages) if STRIP_BOILERPLATE else pages)
+    dedup = ChunkDeduplicator(stats) if DEDUP_CHUNKS else None
+    while True:
+        # Spans stop before each yield, so they never include the consumer's time
+        with span("load", pipeline="ingest"):
+            page = next(pages, None)
+        if page is None:
+            if stats.boilerplate_lines or stats.chunks_removed:
+                print(f" Preprocessing removed {stats.boilerplate_lines} boilerplate lines and "
+                      f"{stats.chunks_removed} duplicate chunks (~{stats.tokens_saved} tokens).")
+            return
+        if progress:
+            progress.advance("pages_parsed")
+        with span("split", pipeline="ingest") as attrs:
+            chunks = splitter.split_documents([page])
+            attrs["chunks"] = len(chunks)
+        if dedup:
+            with span("dedup", pipeline="ingest") as attrs:
+                kept = [chunk for chunk in chunks if dedup.keep(chunk)]
+                attrs["dropped"] = len(chunks) - len(kept)
+            chunks = kept
+        if progress:
+            progress.update(boilerplate_lines=stats.boilerplate_lines,
+                            chunks_deduplicated=stats.chunks_removed, tokens_saved=stats.tokens_saved)
+        for chunk in chunks:
+            if progress:
+                progress.advance("chunks_total")
+            yield chunk
+
+
+# Group chunks into fixed-size lists
+def iter_batches(chunks, batch_size: int):
+    batch = []
+    for chunk in chunks:
+        batch.append(chunk)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _batch_cost(batch) -> int:
+    return sum(len(doc.page_content.encode("utf-8")) + EST_VECTOR_BYTES for doc in batch)
+
+
+class _MemoryBudget:
+    """Blocks the producer while buffered batches exceed the byte ceiling."""
+
+    def __init__(self, limit_bytes: int):
+        self.limit = limit_bytes
+        self.used = 0
+        self.closed = False
+        self._cond = threading.Condition()
+
+    def acquire(self, n: int):
+        with self._cond:
+            # Always admit at least one batch so an oversized batch can't deadlock
+            while self.used and self.used + n > self.limit and not self.closed:
+                self._cond.wait()
+            self.used += n
+
+    def release(self, n: int):
+        with self._cond:
+            self.used -= n
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+_DONE = object()
+
+
+# Streaming page -> chunk -> embed pipeline
+def stream_pdf_to_vectorstore(
+    pdf_path: str,
+    base_dir="vectorstore/",
+    embeddings=None,
+    progress=None,
+    batch_size: int = EMBED_BATCH_SIZE,
+    max_in_flight: int = EMBED_MAX_IN_FLIGHT,
+    memory_mb: float = INGEST_MEMORY_MB,
+    target_pdf: str = None,
+):
+    """
+    Parse pages lazily on a producer thread while the caller's thread embeds
+    and indexes earlier windows of chunks. Chunks waiting to be embedded are
+    capped at `memory_mb`, so peak memory no longer grows with page count.
+    With `target_pdf`, the chunks are appended as a new segment of that PDF's
+    store instead of replacing the PDF's own store.
+    """
+    pdf_name = os.path.basename(pdf_path)
+    embeddings = embeddings or get_cached_embeddings()
+    budget = _MemoryBudget(int(memory_mb * 1024 * 1024))
+    windows = queue.Queue()
+
+    # One window = enough chunks to keep `max_in_flight` embedding requests busy
+    def produce():
+        try:
+            chunks = iter_chunks(iter_pages(pdf_path), progress=progress)
+            for window in iter_batches(chunks, batch_size * max(1, max_in_flight)):
+                cost = _batch_cost(window)
+                budget.acquire(cost)
+                if budget.closed:
+                    return
+                windows.put((window, cost))
+            windows.put((_DONE, 0))
+        except Exception as e:
+            windows.put((e, 0))
+
+    # Run in a copy of this context so the producer's load/split spans join the job's trace
+    producer = threading.Thread(target=contextvars.copy_context().run, args=(produce,),
+                                name=f"parse-{pdf_name}", daemon=True)
+    producer.start()
+
+    # Supplements are checkpointed per target, so "errata.pdf" of two books never collide
+    checkpoint_name = pdf_name if target_pdf is None else f"{pathlib.Path(target_pdf).stem}__{pdf_name}"
+    checkpoint = EmbeddingCheckpoint(checkpoint_path_for(checkpoint_name))
+    backoff = Backoff()
+    vectorstore = None
+    try:
+        while True:
+            window, cost = windows.get()
+            if window is _DONE:
+                break
+            if isinstance(window, Exception):
+                raise window
+            if progress and vectorstore is None:
+                progress.set_stage("embedding")
+
+            texts = [doc.page_content for doc in window]
+            metadatas = [doc.metadata for doc in window]
+            with span("embed", pipeline="ingest", chunks=len(texts), tokens=sum(estimate_tokens(t) for t in texts)):
+                vectors = embed_in_batches(
+                    texts,
+                    embeddings,
+                    batch_size=batch_size,
+                    max_in_flight=max_in_flight,
+                    checkpoint=checkpoint,
+                    backoff=backoff,
+                    on_batch=(lambda n: progress.advance("chunks_embedded", n)) if progress else None,
+                )
+            pairs = list(zip(texts, vectors))
+            with span("index", pipeline="ingest"):
+                if vectorstore is None:
+                    vectorstore = FAISS.from_embeddings(pairs, embeddings, metadatas=metadatas)
+                else:
+                    vectorstore.add_embeddings(pairs, metadatas=metadatas)
+            del window, texts, metadatas, vectors, pairs
+            budget.release(cost)
+    finally:
+        budget.close()
+
+    if vectorstore is None:
+        raise ValueError(f"No text could be extracted from '{pdf_name}'.")
+    print(f"Embedded {vectorstore.index.ntotal} chunks.")
+
+    pdf_folder = os.path.join(base_dir, pathlib.Path(target_pdf or pdf_name).stem)
+    save_vectorstore_segment(vectorstore, pdf_folder, progress=progress, replace=target_pdf is None)
+    checkpoint.clear()
+
     return vectorstore
 
 
 #  Full pipeline
-def process_pdf_and_create_vectorstore(pdf_path: str, base_dir="vectorstore/"):
+def process_pdf_and_create_vectorstore(pdf_path: str, base_dir="vectorstore/", progress=None):
     pdf_name = os.path.basename(pdf_path)
     vectorstore_dir = os.path.join(base_dir, pathlib.Path(pdf_name).stem)
 
     if os.path.exists(vectorstore_dir):
         print(f" Vectorstore already exists for '{pdf_name}' in {vectorstore_dir}. Overwriting.")
 
-    docs = load_pdf(pdf_path)
-    chunks = split_chunks(docs)
-    return create_and_save_vectorstore(chunks, pdf_name, base_dir)
+    if progress:
+        progress.set_stage("parsing")
+    return stream_pdf_to_vectorstore(pdf_path, base_dir, progress=progress)
+
+
+#  Append supplementary material (errata, a new chapter) to an existing PDF's store
+def append_pdf_to_vectorstore(pdf_path: str, target_pdf: str, base_dir="vectorstore/", progress=None):
+    target_dir = os.path.join(base_dir, pathlib.Path(target_pdf).stem)
+    if not os.path.exists(target_dir):
+        raise FileNotFoundError(f"Vectorstore for '{target_pdf}' not found in {target_dir}")
+
+    if progress:
+        progress.set_stage("parsing")
+    return stream_pdf_to_vectorstore(pdf_path, base_dir, progress=progress, target_pdf=target_pdf)
 
 
 #  Test block
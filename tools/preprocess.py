@@ -0,0 +1,186 @@
+# ingestion preprocessing: boilerplate stripping, chunk dedup, token-aware splitting
+import os
+import re
+import hashlib
+from collections import Counter, defaultdict, deque
+from typing import Iterator, List, Optional
+
+import numpy as np
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+
+from tools.memory import estimate_tokens
+
+# Splitter choice and sizes (override via .env); "tokens" sizes chunks by tokens, not characters
+CHUNK_SPLITTER = os.getenv("CHUNK_SPLITTER", "chars")
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "1000"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "200"))
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "256"))
+CHUNK_TOKEN_OVERLAP = int(os.getenv("CHUNK_TOKEN_OVERLAP", "48"))
+SPLITTERS = ("chars", "tokens")
+
+# Boilerplate: lines at the top/bottom of a page repeated on many pages
+STRIP_BOILERPLATE = os.getenv("STRIP_BOILERPLATE", "true").lower() == "true"
+BOILERPLATE_EDGE_LINES = int(os.getenv("BOILERPLATE_EDGE_LINES", "3"))
+BOILERPLATE_MIN_PAGES = int(os.getenv("BOILERPLATE_MIN_PAGES", "4"))
+# Pages read ahead of the one being stripped, so early pages get stripped too
+BOILERPLATE_WINDOW_PAGES = int(os.getenv("BOILERPLATE_WINDOW_PAGES", "24"))
+BOILERPLATE_MAX_LINE_CHARS = 160
+
+# Chunk dedup: exact (normalized text) and near-duplicate (SimHash Hamming distance)
+DEDUP_CHUNKS = os.getenv("DEDUP_CHUNKS", "true").lower() == "true"
+NEAR_DUP_MAX_DISTANCE = int(os.getenv("NEAR_DUP_MAX_DISTANCE", "6"))
+NEAR_DUP_MIN_WORDS = 12  # shorter chunks only get exact matching
+
+_WORD = re.compile(r"\w+")
+_DIGITS = re.compile(r"\d+")
+_SPACE = re.compile(r"\s+")
+
+
+# Chunks carry start_index (offset in their page) so tools.context can merge overlaps exactly
+def get_text_splitter(kind: Optional[str] = None):
+    kind = (kind or CHUNK_SPLITTER).lower()
+    if kind not in SPLITTERS:
+        raise ValueError(f"Unknown splitter '{kind}'. Choose one of: {', '.join(SPLITTERS)}.")
+    if kind == "chars":
+        return RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, add_start_index=True)
+    try:
+        return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+            encoding_name="cl100k_base", chunk_size=CHUNK_TOKENS, chunk_overlap=CHUNK_TOKEN_OVERLAP,
+            add_start_index=True
+        )
+    except Exception as e:  # tiktoken missing or its vocabulary not downloadable
+        print(f" tiktoken unavailable ({e}); sizing chunks with the ~4 chars/token estimate.")
+        return RecursiveCharacterTextSplitter(
+            chunk_size=CHUNK_TOKENS, chunk_overlap=CHUNK_TOKEN_OVERLAP, length_function=estimate_tokens,
+            add_start_index=True
+        )
+
+
+class PreprocessStats:
+    """What preprocessing removed from one ingestion."""
+
+    def __init__(self):
+        self.boilerplate_lines = 0
+        self.exact_duplicates = 0
+        self.near_duplicates = 0
+        self.tokens_saved = 0
+
+    @property
+    def chunks_removed(self) -> int:
+        return self.exact_duplicates + self.near_duplicates
+
+    def to_dict(self) -> dict:
+        return {
+            "boilerplate_lines": self.boilerplate_lines,
+            "exact_duplicates": self.exact_duplicates,
+            "near_duplicates": self.near_duplicates,
+            "chunks_removed": self.chunks_removed,
+            "tokens_saved": self.tokens_saved,
+        }
+
+
+def _line_key(line: str) -> str:
+    # Page numbers and dates vary from page to page; the rest of a running header does not
+    return _DIGITS.sub("#", _SPACE.sub(" ", line.strip().lower()))
+
+
+class BoilerplateStripper:
+    """
+    Counts on how many pages each (digit-normalized) edge line occurs and
+    removes edge lines seen on at least `min_pages` pages: running headers,
+    footers, page numbers, copyright notices.
+    """
+
+    def __init__(self, stats: PreprocessStats, edge_lines: int = BOILERPLATE_EDGE_LINES,
+                 min_pages: int = BOILERPLATE_MIN_PAGES):
+        self.stats = stats
+        self.edge_lines = edge_lines
+        self.min_pages = min_pages
+        self.page_counts = Counter()
+
+    def _edges(self, lines: List[str]) -> List[int]:
+        filled = [i for i, line in enumerate(lines) if line.strip()]
+        return sorted(set(filled[:self.edge_lines] + filled[-self.edge_lines:]))
+
+    def observe(self, page: Document):
+        lines = page.page_content.splitlines()
+        keys = {_line_key(lines[i]) for i in self._edges(lines) if len(lines[i]) <= BOILERPLATE_MAX_LINE_CHARS}
+        self.page_counts.update(keys)
+
+    def strip(self, page: Document) -> Document:
+        lines = page.page_content.splitlines()
+        drop = {i for i in self._edges(lines) if self.page_counts[_line_key(lines[i])] >= self.min_pages}
+        if not drop:
+            return page
+        self.stats.boilerplate_lines += len(drop)
+        self.stats.tokens_saved += sum(estimate_tokens(lines[i]) for i in drop)
+        kept = "\n".join(line for i, line in enumerate(lines) if i not in drop)
+        return Document(page_content=kept, metadata=page.metadata)
+
+    def run(self, pages, window: int = BOILERPLATE_WINDOW_PAGES) -> Iterator[Document]:
+        """Strip a page stream; each page is released once `window` later pages were counted."""
+        held = deque()
+        for page in pages:
+            self.observe(page)
+            held.append(page)
+            if len(held) > window:
+                yield self.strip(held.popleft())
+        while held:
+            yield self.strip(held.popleft())
+
+
+def simhash(text: str) -> int:
+    """64-bit SimHash over word 3-shingles."""
+    words = _WORD.findall(text.lower())
+    shingles = [" ".join(words[i:i + 3]) for i in range(max(1, len(words) - 2))]
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big") for s in shingles],
+        dtype=">u8",
+    )
+    bits = np.unpackbits(hashes.view(np.uint8)).reshape(-1, 64)
+    majority = np.packbits(bits.sum(axis=0) * 2 > len(shingles))
+    return int.from_bytes(majority.tobytes(), "big")
+
+
+class ChunkDeduplicator:
+    """
+    Drops chunks whose normalized text was already kept (exact) or whose
+    SimHash is within `max_distance` (at most 7) bits of a kept one (near).
+    Near matches are found through 8 x 8-bit bands: two hashes within 7 bits
+    share at least one band. A one-word edit in a chunk moves its SimHash by
+    ~1-10 bits; unrelated chunks sit 25+ bits apart.
+    """
+
+    BANDS = 8
+
+    def __init__(self, stats: PreprocessStats, max_distance: int = NEAR_DUP_MAX_DISTANCE):
+        self.stats = stats
+        self.max_distance = min(max_distance, self.BANDS - 1)
+        self._exact = set()
+        self._bands = defaultdict(list)
+
+    def _band_keys(self, value: int):
+        return [(band, (value >> (8 * band)) & 0xFF) for band in range(self.BANDS)]
+
+    def keep(self, chunk: Document) -> bool:
+        text = _SPACE.sub(" ", chunk.page_content.strip().lower())
+        digest = hashlib.sha1(text.encode("utf-8")).digest()
+        if digest in self._exact:
+            self.stats.exact_duplicates += 1
+            self.stats.tokens_saved += estimate_tokens(chunk.page_content)
+            return False
+        self._exact.add(digest)
+
+        if self.max_distance < 0 or len(text.split()) < NEAR_DUP_MIN_WORDS:
+            return True
+        value = simhash(text)
+        keys = self._band_keys(value)
+        for key in keys:
+            if any((value ^ other).bit_count() <= self.max_distance for other in self._bands[key]):
+                self.stats.near_duplicates += 1
+                self.stats.tokens_saved += estimate_tokens(chunk.page_content)
+                return False
+        for key in keys:
+            self._bands[key].append(value)
+        return True
@@ -0,0 +1,278 @@
+# retrieval strategies
+import os
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import numpy as np
+
+from tools.memory import estimate_tokens
+from tools.metrics import span
+
+# Default strategy for the deployment; requests may override it (override via .env)
+RETRIEVAL_STRATEGY = os.getenv("RETRIEVAL_STRATEGY", "hybrid")
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "6"))
+RETRIEVAL_FETCH_K = int(os.getenv("RETRIEVAL_FETCH_K", "15"))
+MULTI_QUERY_VARIANTS = int(os.getenv("MULTI_QUERY_VARIANTS", "3"))
+RRF_K = 60
+# Keyword-style questions answered from BM25 alone, without embedding the query
+LEXICAL_FAST_PATH = os.getenv("LEXICAL_FAST_PATH", "true").lower() == "true"
+LEXICAL_FAST_PATH_MAX_TERMS = int(os.getenv("LEXICAL_FAST_PATH_MAX_TERMS", "4"))
+
+STRATEGIES = ("hybrid", "mmr", "expand", "multi_query")
+
+MULTI_QUERY_PROMPT = (
+    "You are an AI language model assistant. Your task is to generate {n} different "
+    "versions of the given user question to retrieve relevant documents from a vector "
+    "database. By generating multiple perspectives on the user question, your goal is "
+    "to help the user overcome some of the limitations of distance-based similarity "
+    "search. Provide these alternative questions separated by newlines, without numbering.\n"
+    "Original question: {question}"
+)
+
+STOPWORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "be", "been", "do", "does", "did",
+    "what", "which", "who", "whom", "whose", "when", "where", "why", "how", "can",
+    "could", "would", "should", "will", "shall", "may", "might", "of", "in", "on",
+    "at", "to", "for", "from", "by", "with", "about", "and", "or", "it", "its",
+    "this", "that", "these", "those", "i", "me", "my", "you", "your", "we", "us",
+    "please", "explain", "tell", "describe", "give", "between",
+}
+
+# Shared pool for concurrent FAISS searches (faiss releases the GIL)
+_search_pool = ThreadPoolExecutor(max_workers=int(os.getenv("RETRIEVAL_SEARCH_THREADS", "8")),
+                                  thread_name_prefix="faiss-search")
+
+
+def resolve_strategy(strategy: Optional[str]) -> str:
+    strategy = (strategy or RETRIEVAL_STRATEGY).lower()
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown retrieval strategy '{strategy}'. Choose one of {STRATEGIES}.")
+    return strategy
+
+
+class LatencyStats:
+    """Rolling latency samples per retrieval strategy."""
+
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, strategy: str, ms: float):
+        with self._lock:
+            samples = self._samples.setdefault(strategy, [])
+            samples.append(ms)
+            if len(samples) > self.window:
+                del samples[0]
+
+    def summary(self) -> dict:
+        with self._lock:
+            out = {}
+            for strategy, samples in self._samples.items():
+                ordered = sorted(samples)
+                n = len(ordered)
+                out[strategy] = {
+                    "count": n,
+                    "mean_ms": sum(ordered) / n,
+                    "p50_ms": ordered[n // 2],
+                    "p95_ms": ordered[min(n - 1, int(n * 0.95))],
+                    "max_ms": ordered[-1],
+                }
+            return out
+
+
+retrieval_latency = LatencyStats()
+
+
+# Query embedding helpers
+
+def embed_queries(embeddings, texts: List[str]) -> List[List[float]]:
+    """Embed several queries in one call when the client supports it."""
+    with span("embed_query", tokens=sum(estimate_tokens(text) for text in texts)):
+        if hasattr(embeddings, "embed_queries"):
+            return embeddings.embed_queries(texts)
+        return [embeddings.embed_query(text) for text in texts]
+
+
+def is_keyword_query(question: str) -> bool:
+    """Short, term-like input ("Bernoulli equation", "section 4.3") rather than a question."""
+    words = re.findall(r"[\w\-\.]+", question.lower())
+    if not words or len(words) > LEXICAL_FAST_PATH_MAX_TERMS or question.rstrip().endswith("?"):
+        return False
+    return not any(w in STOPWORDS for w in words)
+
+
+def keyword_query(question: str) -> str:
+    """Rule-based rewrite: keep content words only."""
+    words = re.findall(r"[\w\-\.]+", question.lower())
+    kept = [w for w in words if w not in STOPWORDS]
+    return " ".join(kept) or question
+
+
+# FAISS access by raw ids, so results can be fused / deduplicated by id
+
+def _search_matrix(vector_store, vectors, n: int) -> List[List[int]]:
+    """One FAISS search call for a whole matrix of query vectors."""
+    query = np.asarray(vectors, dtype=np.float32)
+    if getattr(vector_store, "_normalize_L2", False):
+        query /= np.linalg.norm(query, axis=1, keepdims=True)
+    _, ids = vector_store.index.search(query, n)
+    return [[int(i) for i in row if i != -1] for row in ids]
+
+
+def _search_ids(vector_store, vector, n: int) -> List[int]:
+    return _search_matrix(vector_store, [vector], n)[0]
+
+
+def _docs_for(vector_store, ids: List[int]):
+    docs = []
+    for i in ids:
+        doc = vector_store.docstore.search(vector_store.index_to_docstore_id[i])
+        if not isinstance(doc, str):  # docstore returns a message string when missing
+            docs.append(doc)
+    return docs
+
+
+def rrf_fuse(rankings: List[List[int]], k: int) -> List[int]:
+    """Reciprocal rank fusion of several id rankings; returns the top k ids."""
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)[:k]
+
+
+def _search_many(vector_store, vectors, n: int) -> List[List[int]]:
+    with span("search"):
+        futures = [_search_pool.submit(_search_ids, vector_store, v, n) for v in vectors]
+        return [f.result() for f in futures]
+
+
+# Strategies
+
+def retrieve_mmr(vector_store, question: str, k: int = RETRIEVAL_K, fetch_k: int = RETRIEVAL_FETCH_K):
+    vector = embed_queries(vector_store.embedding_function, [question])[0]
+    with span("search"):
+        return vector_store.max_marginal_relevance_search_by_vector(vector, k=k, fetch_k=fetch_k)
+
+
+def retrieve_expand(vector_store, question: str, k: int = RETRIEVAL_K, fetch_k: int = RETRIEVAL_FETCH_K):
+    """
+    No-LLM expansion: the original question plus a keyword-only rewrite (one
+    batched embedding call), plus a pseudo-relevance-feedback query moved
+    towards the centroid of the top hits. Rankings are fused with RRF.
+    """
+    variants = [question]
+    keywords = keyword_query(question)
+    if keywords != question.lower():
+        variants.append(keywords)
+    vectors = embed_queries(vector_store.embedding_function, variants)
+    rankings = _search_many(vector_store, vectors, fetch_k)
+
+    # Embedding-neighborhood expansion (Rocchio); needs reconstructable vectors
+    try:
+        top = rankings[0][:3]
+        if top:
+            neighbors = np.stack([vector_store.index.reconstruct(i) for i in top])
+            expanded = np.asarray(vectors[0], dtype=np.float32) + 0.5 * neighbors.mean(axis=0)
+            with span("search"):
+                rankings.append(_search_ids(vector_store, expanded, fetch_k))
+    except RuntimeError:
+        pass
+
+    return _docs_for(vector_store, rrf_fuse(rankings, k))
+
+
+def retrieve_hybrid(vector_store, question: str, k: int = RETRIEVAL_K, fetch_k: int = RETRIEVAL_FETCH_K,
+                    timings: Optional[dict] = None):
+    """
+    BM25 and dense search run concurrently and are fused with RRF. Keyword-style
+    questions whose terms all occur in the PDF skip the query embedding.
+    """
+    lexical = getattr(vector_store, "lexical_index", None)
+    if lexical is None:
+        vector = embed_queries(vector_store.embedding_function, [question])[0]
+        with span("search"):
+            return _docs_for(vector_store, _search_ids(vector_store, vector, k))
+
+    if LEXICAL_FAST_PATH and is_keyword_query(question) and lexical.covers(question):
+        if timings is not None:
+            timings["lexical_fast_path"] = True
+        with span("lexical_search", fast_path=True):
+            return _docs_for(vector_store, [i for i, _ in lexical.search(question, k)])
+
+    lexical_future = _search_pool.submit(lexical.search, question, fetch_k)
+    vector = embed_queries(vector_store.embedding_function, [question])[0]
+    with span("search"):
+        dense = _search_ids(vector_store, vector, fetch_k)
+        sparse = [i for i, _ in lexical_future.result()]
+    return _docs_for(vector_store, rrf_fuse([dense, sparse], k))
+
+
+def generate_query_variants(llm, question: str, n: int = MULTI_QUERY_VARIANTS) -> List[str]:
+    # Tagged so the LLM metrics callback reports it as its own stage
+    response = llm.invoke(MULTI_QUERY_PROMPT.format(n=n, question=question), config={"tags": ["query_expansion"]})
+    text = getattr(response, "content", response)
+    lines = [line.strip(" -*0123456789.)\t") for line in str(text).splitlines()]
+    return [line for line in lines if line][:n]
+
+
+def retrieve_multi_query(vector_store, question: str, llm, k: int = RETRIEVAL_K, fetch_k: int = RETRIEVAL_FETCH_K):
+    """
+    One LLM call for query variants, one batched embedding call for all of
+    them, concurrent FAISS searches, then dedup + RRF fusion.
+    """
+    variants = [question] + generate_query_variants(llm, question)
+    vectors = embed_queries(vector_store.embedding_function, variants)
+    rankings = _search_many(vector_store, vectors, fetch_k)
+    return _docs_for(vector_store, rrf_fuse(rankings, k))
+
+
+def retrieve(vector_store, question: str, strategy: Optional[str] = None, llm=None, timings: Optional[dict] = None):
+    """Run the selected strategy; records its latency (and into `timings` if given)."""
+    strategy = resolve_strategy(strategy)
+    start = time.perf_counter()
+    # "retrieval" covers the whole strategy, including its embed/search/expansion stages
+    with span("retrieval", strategy=strategy) as attrs:
+        if strategy == "hybrid":
+            docs = retrieve_hybrid(vector_store, question, timings=timings)
+        elif strategy == "mmr":
+            docs = retrieve_mmr(vector_store, question)
+        elif strategy == "expand":
+            docs = retrieve_expand(vector_store, question)
+        else:
+            docs = retrieve_multi_query(vector_store, question, llm)
+        attrs["chunks"] = len(docs)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    retrieval_latency.record(strategy, elapsed_ms)
+    if timings is not None:
+        timings["retrieval_strategy"] = strategy
+        timings["retrieval_ms"] = elapsed_ms
+    return docs
+
+
+def retrieve_batch(vector_store, questions: List[str], k: int = RETRIEVAL_K,
+                   fetch_k: int = RETRIEVAL_FETCH_K) -> List[list]:
+    """
+    Hybrid retrieval for many independent questions: one embedding call for
+    all of them, one FAISS search over the query matrix, BM25 searches on the
+    search pool meanwhile, then RRF per question. Returns one doc list per question.
+    """
+    start = time.perf_counter()
+    with span("retrieval", strategy="batch") as attrs:
+        lexical = getattr(vector_store, "lexical_index", None)
+        sparse_futures = [_search_pool.submit(lexical.search, q, fetch_k) for q in questions] if lexical is not None else []
+        vectors = embed_queries(vector_store.embedding_function, questions)
+        with span("search"):
+            dense = _search_matrix(vector_store, vectors, fetch_k if lexical is not None else k)
+            sparse = [[i for i, _ in future.result()] for future in sparse_futures]
+        results = [
+            _docs_for(vector_store, rrf_fuse([ids, sparse[row]], k) if lexical is not None else ids)
+            for row, ids in enumerate(dense)
+        ]
+        attrs["chunks"] = sum(len(docs) for docs in results)
+    retrieval_latency.record("batch", (time.perf_counter() - start) * 1000)
+    return results
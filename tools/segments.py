@@ -0,0 +1,416 @@
+# segmented vectorstores: immutable segments, tombstones, atomic manifests, compaction
+import os
+import json
+import time
+import uuid
+import shutil
+import bisect
+import pickle
+import threading
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+import numpy as np
+from langchain_community.vectorstores import FAISS
+
+from tools.chunk_store import ChunkStore, has_chunk_store, identity_id_map
+from tools.index_builder import apply_index_type, load_local_index, read_index_meta, save_local_index, write_index_meta
+
+try:
+    import fcntl
+except ImportError:  # Windows: writers are only serialized within one process
+    fcntl = None
+
+# Compaction policy (override via .env)
+COMPACT_MAX_SEGMENTS = int(os.getenv("COMPACT_MAX_SEGMENTS", "4"))
+COMPACT_TOMBSTONE_RATIO = float(os.getenv("COMPACT_TOMBSTONE_RATIO", "0.2"))
+COMPACT_INTERVAL_SECONDS = float(os.getenv("COMPACT_INTERVAL_SECONDS", "60"))
+# Retired segments stay on disk this long for readers still loading them
+SEGMENT_GC_GRACE_SECONDS = float(os.getenv("SEGMENT_GC_GRACE_SECONDS", "300"))
+
+# Folder layout:
+#   segments.json   manifest: version, live segments (+ tombstoned row ids), retired segments
+#   seg-<id>/       one immutable index + chunk store + BM25 index per segment
+# Folders written before segments existed hold a single segment at their root (".").
+MANIFEST_FILE = "segments.json"
+LOCK_FILE = ".segments.lock"
+COMPACTOR_LOCK_FILE = ".compactor.lock"
+ROOT_SEGMENT = "."
+LEGACY_FILES = ("index.faiss", "index.pkl", "index_meta.json", "lexical.npz",
+                "chunks.txt", "chunks.meta", "chunks.idx", "chunks.json")
+
+_folder_locks = {}
+_folder_locks_guard = threading.Lock()
+
+
+@contextmanager
+def folder_lock(folder_path: str):
+    """Serialize manifest writers for one vectorstore folder (across processes where supported)."""
+    with _folder_locks_guard:
+        lock = _folder_locks.setdefault(os.path.abspath(folder_path), threading.Lock())
+    with lock:
+        if fcntl is None or not os.path.isdir(folder_path):
+            yield
+            return
+        with open(os.path.join(folder_path, LOCK_FILE), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_manifest(folder_path: str) -> dict:
+    path = os.path.join(folder_path, MANIFEST_FILE)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    if os.path.exists(os.path.join(folder_path, "index.faiss")):
+        return {"version": 0, "segments": [{"name": ROOT_SEGMENT, "tombstones": []}], "retired": {}}
+    return {"version": 0, "segments": [], "retired": {}}
+
+
+def _write_manifest(folder_path: str, manifest: dict, bump: bool = True):
+    if bump:
+        manifest["version"] = manifest.get("version", 0) + 1
+    tmp = os.path.join(folder_path, f"{MANIFEST_FILE}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, os.path.join(folder_path, MANIFEST_FILE))  # the atomic version switch
+
+
+def store_version(folder_path: str) -> str:
+    """Changes whenever the set of live segments or tombstones changes."""
+    if os.path.exists(os.path.join(folder_path, MANIFEST_FILE)):
+        return f"v{read_manifest(folder_path)['version']}"
+    index_file = os.path.join(folder_path, "index.faiss")
+    return str(os.stat(index_file).st_mtime_ns) if os.path.exists(index_file) else "missing"
+
+
+def segment_path(folder_path: str, name: str) -> str:
+    return folder_path if name == ROOT_SEGMENT else os.path.join(folder_path, name)
+
+
+# Writing
+
+def write_segment(folder_path: str, vector_store: FAISS, index_meta: dict) -> str:
+    """Write a store as a new, not yet visible segment; returns its name."""
+    name = f"seg-{time.time_ns():x}-{uuid.uuid4().hex[:6]}"
+    building = os.path.join(folder_path, f".building-{name}")
+    os.makedirs(building)
+    try:
+        save_local_index(vector_store, building)
+        write_index_meta(building, index_meta)
+        os.rename(building, os.path.join(folder_path, name))  # complete or absent, never partial
+    except Exception:
+        shutil.rmtree(building, ignore_errors=True)
+        raise
+    return name
+
+
+def commit_segment(folder_path: str, name: str, ntotal: int, replace: bool = False):
+    """Make a written segment queryable; `replace` retires every other segment (re-ingest)."""
+    with folder_lock(folder_path):
+        manifest = read_manifest(folder_path)
+        if replace:
+            for seg in manifest["segments"]:
+                manifest["retired"][seg["name"]] = time.time()
+            manifest["segments"] = []
+        manifest["segments"].append({"name": name, "ntotal": ntotal, "tombstones": []})
+        _write_manifest(folder_path, manifest)
+    gc_segments(folder_path)
+
+
+def _segment_documents(seg_path: str):
+    """(row id, Document) of every chunk in a segment, read without loading its vectors."""
+    if has_chunk_store(seg_path):
+        store = ChunkStore(seg_path)
+        try:
+            yield from enumerate(store.iter_documents())
+        finally:
+            store.close()
+        return
+    # Legacy layout: pickled docstore
+    with open(os.path.join(seg_path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    for i, doc_id in index_to_docstore_id.items():
+        yield i, docstore.search(doc_id)
+
+
+def delete_source(folder_path: str, source_path: str) -> int:
+    """Tombstone every chunk whose metadata `source` is the file at `source_path`; returns the count."""
+    source_path = os.path.normpath(source_path)
+    with folder_lock(folder_path):
+        manifest = read_manifest(folder_path)
+        deleted = 0
+        for seg in manifest["segments"]:
+            dead = set(seg["tombstones"])
+            for i, doc in _segment_documents(segment_path(folder_path, seg["name"])):
+                if i in dead:
+                    continue
+                if not isinstance(doc, str) and os.path.normpath(str(doc.metadata.get("source", ""))) == source_path:
+                    dead.add(i)
+                    deleted += 1
+            seg["tombstones"] = sorted(dead)
+        if deleted:
+            _write_manifest(folder_path, manifest)
+        return deleted
+
+
+def delete_store(folder_path: str):
+    """Remove a whole vectorstore folder without racing a compaction commit."""
+    with folder_lock(folder_path):
+        shutil.rmtree(folder_path, ignore_errors=True)
+
+
+def gc_segments(folder_path: str, grace_seconds: float = SEGMENT_GC_GRACE_SECONDS):
+    """Delete retired segments once no reader can still be loading them."""
+    with folder_lock(folder_path):
+        if not os.path.exists(os.path.join(folder_path, MANIFEST_FILE)):
+            return
+        manifest = read_manifest(folder_path)
+        now = time.time()
+        expired = [name for name, retired_at in manifest["retired"].items() if now - retired_at >= grace_seconds]
+        for name in expired:
+            try:
+                if name == ROOT_SEGMENT:
+                    for file_name in LEGACY_FILES:
+                        path = os.path.join(folder_path, file_name)
+                        if os.path.exists(path):
+                            os.remove(path)
+                else:
+                    shutil.rmtree(os.path.join(folder_path, name))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f" Could not remove retired segment {name} in {folder_path}: {e}")
+                continue
+            del manifest["retired"][name]
+        if expired:
+            _write_manifest(folder_path, manifest, bump=False)  # readers' view is unchanged
+
+
+# Reading: one FAISS store over all live segments
+
+class SegmentedIndex:
+    """
+    Read-only index over several segment indexes. Global id = segment offset +
+    local row id; tombstoned rows never appear in search results.
+    """
+
+    def __init__(self, indexes: list, tombstones: List[set]):
+        self.indexes = indexes
+        self.tombstones = tombstones
+        self.offsets = [0]
+        for index in indexes:
+            self.offsets.append(self.offsets[-1] + index.ntotal)
+        self.ntotal = self.offsets[-1]
+        self.d = indexes[0].d
+
+    def search(self, x, k: int):
+        x = np.asarray(x, dtype=np.float32)
+        hits = [[] for _ in range(x.shape[0])]
+        for index, dead, offset in zip(self.indexes, self.tombstones, self.offsets):
+            if index.ntotal == 0:
+                continue
+            distances, ids = index.search(x, min(index.ntotal, k + len(dead)))
+            for row in range(x.shape[0]):
+                hits[row].extend(
+                    (float(d), offset + int(i)) for d, i in zip(distances[row], ids[row])
+                    if i != -1 and int(i) not in dead
+                )
+        out_d = np.full((x.shape[0], k), np.inf, dtype=np.float32)
+        out_i = np.full((x.shape[0], k), -1, dtype=np.int64)
+        for row, row_hits in enumerate(hits):
+            row_hits.sort()
+            for col, (d, i) in enumerate(row_hits[:k]):
+                out_d[row, col], out_i[row, col] = d, i
+        return out_d, out_i
+
+    def _locate(self, i: int):
+        seg = bisect.bisect_right(self.offsets, i) - 1
+        return self.indexes[seg], i - self.offsets[seg]
+
+    def reconstruct(self, i: int):
+        index, local = self._locate(int(i))
+        return index.reconstruct(local)
+
+    def reconstruct_n(self, i0: int, n: int):
+        return np.stack([self.reconstruct(i) for i in range(i0, i0 + n)])
+
+
+class SegmentedDocstore:
+    """Docstore over segment stores; ids are str(global id)."""
+
+    def __init__(self, stores: list, offsets: List[int]):
+        self.stores = stores
+        self.offsets = offsets
+
+    def search(self, search: str):
+        try:
+            i = int(search)
+        except ValueError:
+            return f"ID {search} not found."
+        seg = bisect.bisect_right(self.offsets, i) - 1
+        if not 0 <= seg < len(self.stores) or i >= self.offsets[-1]:
+            return f"ID {search} not found."
+        store = self.stores[seg]
+        return store.docstore.search(store.index_to_docstore_id[i - self.offsets[seg]])
+
+
+class SegmentedLexicalIndex:
+    """BM25 over segments (scores use per-segment statistics), tombstones filtered."""
+
+    def __init__(self, lexicals: list, offsets: List[int], tombstones: List[set]):
+        self.lexicals = lexicals
+        self.offsets = offsets
+        self.tombstones = tombstones
+
+    @property
+    def nbytes(self) -> int:
+        return sum(lexical.nbytes for lexical in self.lexicals)
+
+    def covers(self, query: str) -> bool:
+        return any(lexical.covers(query) for lexical in self.lexicals)
+
+    def search(self, query: str, k: int):
+        hits = []
+        for lexical, offset, dead in zip(self.lexicals, self.offsets, self.tombstones):
+            hits.extend((offset + i, score) for i, score in lexical.search(query, k + len(dead)) if i not in dead)
+        hits.sort(key=lambda hit: hit[1], reverse=True)
+        return hits[:k]
+
+
+def load_segmented_store(folder_path: str, embeddings) -> FAISS:
+    """Load every live segment as one store (a plain FAISS store for a single clean segment)."""
+    manifest = read_manifest(folder_path)
+    if not manifest["segments"]:
+        raise FileNotFoundError(f"No index segments in {folder_path}")
+    stores = [load_local_index(segment_path(folder_path, seg["name"]), embeddings) for seg in manifest["segments"]]
+    tombstones = [set(seg["tombstones"]) for seg in manifest["segments"]]
+    if len(stores) == 1 and not tombstones[0]:
+        return stores[0]
+
+    index = SegmentedIndex([store.index for store in stores], tombstones)
+    docstore = SegmentedDocstore(stores, index.offsets)
+    vector_store = FAISS(embeddings, index, docstore, identity_id_map(index.ntotal))
+    lexicals = [getattr(store, "lexical_index", None) for store in stores]
+    vector_store.lexical_index = (
+        SegmentedLexicalIndex(lexicals, index.offsets, tombstones) if all(l is not None for l in lexicals) else None
+    )
+    return vector_store
+
+
+# Compaction
+
+def needs_compaction(manifest: dict) -> bool:
+    segments = manifest["segments"]
+    if len(segments) > COMPACT_MAX_SEGMENTS:
+        return True
+    total = sum(seg.get("ntotal", 0) for seg in segments)
+    dead = sum(len(seg["tombstones"]) for seg in segments)
+    return bool(dead) and (not total or dead / total >= COMPACT_TOMBSTONE_RATIO)
+
+
+def compact(folder_path: str, embeddings) -> bool:
+    """
+    Merge all live segments into one without tombstoned rows. Built outside the
+    lock; committed only if no segment or tombstone changed in the meantime,
+    with segments added during the merge kept as they are.
+    """
+    snapshot = read_manifest(folder_path)
+    merged = snapshot["segments"]
+    if len(merged) < 2 and not any(seg["tombstones"] for seg in merged):
+        return False
+
+    texts, vectors, metadatas = [], [], []
+    for seg in merged:
+        path = segment_path(folder_path, seg["name"])
+        store = load_local_index(path, embeddings, mmap=False)
+        dead = set(seg["tombstones"])
+        live = [i for i in range(store.index.ntotal) if i not in dead]
+        docs = [store.docstore.search(store.index_to_docstore_id[i]) for i in live]
+        texts.extend(doc.page_content for doc in docs)
+        metadatas.extend(doc.metadata for doc in docs)
+        if read_index_meta(path).get("quantization", "none") == "none":
+            vectors.extend(store.index.reconstruct(i) for i in live)
+        else:
+            # Quantized codes are lossy; re-embed (served by the embedding cache)
+            vectors.extend(embeddings.embed_documents([doc.page_content for doc in docs]))
+
+    if not texts:
+        name = None
+    else:
+        vector_store = FAISS.from_embeddings(
+            list(zip(texts, [list(map(float, v)) for v in vectors])), embeddings, metadatas=metadatas
+        )
+        name = write_segment(folder_path, vector_store, apply_index_type(vector_store))
+
+    with folder_lock(folder_path):
+        current = read_manifest(folder_path)
+        by_name = {seg["name"]: seg for seg in current["segments"]}
+        if any(by_name.get(seg["name"]) != seg for seg in merged):
+            # Re-ingested, tombstoned or deleted while merging
+            print(f" Compaction of {folder_path} raced with a writer; retrying later.")
+            if name:
+                shutil.rmtree(os.path.join(folder_path, name), ignore_errors=True)
+            return False
+        merged_names = {seg["name"] for seg in merged}
+        kept = [seg for seg in current["segments"] if seg["name"] not in merged_names]
+        for seg_name in merged_names:
+            current["retired"][seg_name] = time.time()
+        current["segments"] = ([{"name": name, "ntotal": len(texts), "tombstones": []}] if name else []) + kept
+        _write_manifest(folder_path, current)
+    print(f" Compacted {len(merged)} segments of {folder_path} into {len(texts)} chunks.")
+    return True
+
+
+class Compactor:
+    """Background thread that compacts and garbage-collects every vectorstore folder."""
+
+    def __init__(self, base_dir: str, embeddings_factory: Callable, on_change: Optional[Callable[[str], None]] = None,
+                 interval: float = COMPACT_INTERVAL_SECONDS):
+        self.base_dir = base_dir
+        self.embeddings_factory = embeddings_factory
+        self.on_change = on_change
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="segment-compactor", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def run_once(self):
+        if not os.path.isdir(self.base_dir):
+            return
+        if fcntl is None:
+            self._compact_all()
+            return
+        # With several worker processes only one of them compacts per round
+        with open(os.path.join(self.base_dir, COMPACTOR_LOCK_FILE), "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            try:
+                self._compact_all()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _compact_all(self):
+        for name in sorted(os.listdir(self.base_dir)):
+            folder = os.path.join(self.base_dir, name)
+            if not os.path.exists(os.path.join(folder, MANIFEST_FILE)):
+                continue
+            try:
+                if needs_compaction(read_manifest(folder)) and compact(folder, self.embeddings_factory()):
+                    if self.on_change:
+                        self.on_change(name)
+                gc_segments(folder)
+            except Exception as e:
+                print(f" Compaction failed for {folder}: {e}")
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,127 @@
+# LRU cache of loaded chat sessions
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from tools.metrics import record_cache
+
+# Memory budget for resident FAISS indexes + chunk text (override via .env)
+SESSION_CACHE_MB = float(os.getenv("SESSION_CACHE_MB", "1024"))
+
+
+def _index_bytes(index) -> int:
+    if hasattr(index, "indexes"):  # tools.segments.SegmentedIndex
+        return sum(_index_bytes(segment) for segment in index.indexes)
+    if hasattr(index, "hnsw"):
+        # Quantized/flat storage codes + ~2*M neighbour ids per vector in the graph
+        per_vector = getattr(index.storage, "code_size", index.d * 4) + index.hnsw.nb_neighbors(0) * 4 * 2
+    else:
+        per_vector = getattr(index, "code_size", index.d * 4)  # float32 when unquantized
+    return index.ntotal * per_vector
+
+
+def estimate_vector_store_bytes(vector_store) -> int:
+    """Approximate resident size of a LangChain FAISS store: vectors + chunk text + BM25 postings."""
+    size = _index_bytes(vector_store.index)
+    for doc in getattr(vector_store.docstore, "_dict", {}).values():
+        size += len(doc.page_content) + 200  # text + metadata/object overhead
+    lexical = getattr(vector_store, "lexical_index", None)
+    if lexical is not None:
+        size += lexical.nbytes
+    return size
+
+
+class SessionCache:
+    """
+    Keeps chat sessions (index + chain) for recently used PDFs within a byte
+    budget. Misses are loaded from disk with `loader(pdf_name)`, which must
+    return (session, size_bytes); the least recently used entries are evicted
+    when the budget is exceeded. With `current_version(pdf_name)`, a hit whose
+    on-disk index changed since it was loaded (e.g. by another worker process)
+    is reloaded.
+    """
+
+    def __init__(self, loader: Callable[[str], tuple], max_mb: float = SESSION_CACHE_MB,
+                 current_version: Optional[Callable[[str], str]] = None):
+        self.loader = loader
+        self.current_version = current_version
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._entries = OrderedDict()  # pdf_name -> (session, size, version)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._loading = {}  # pdf_name -> Lock, so each index is loaded once
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, pdf_name: str):
+        """Return the session for `pdf_name`, loading it on a miss.
+        Raises FileNotFoundError if the PDF has no index on disk."""
+        version = self.current_version(pdf_name) if self.current_version else None
+        with self._lock:
+            entry = self._entries.get(pdf_name)
+            if entry is not None and entry[2] != version:
+                self._entries.pop(pdf_name)
+                self._bytes -= entry[1]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(pdf_name)
+                self.hits += 1
+                record_cache("session", hits=1)
+                return entry[0]
+            self.misses += 1
+            record_cache("session", misses=1)
+            load_lock = self._loading.setdefault(pdf_name, threading.Lock())
+
+        with load_lock:
+            # Another request may have loaded it while we waited
+            with self._lock:
+                entry = self._entries.get(pdf_name)
+                if entry is not None and entry[2] == version:
+                    self._entries.move_to_end(pdf_name)
+                    return entry[0]
+            try:
+                session, size = self.loader(pdf_name)
+                self.put(pdf_name, session, size, version)
+            finally:
+                # Only once the entry is in, or a request arriving in between would load it again
+                with self._lock:
+                    self._loading.pop(pdf_name, None)
+            return session
+
+    def put(self, pdf_name: str, session, size: int, version: Optional[str] = None):
+        with self._lock:
+            old = self._entries.pop(pdf_name, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[pdf_name] = (session, size, version)
+            self._bytes += size
+            # Evict LRU entries, but never the one just inserted
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                name, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+                print(f" Evicted chat session for '{name}' ({evicted_size} bytes).")
+
+    def invalidate(self, pdf_name: str):
+        with self._lock:
+            entry = self._entries.pop(pdf_name, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+
+    def __contains__(self, pdf_name: str) -> bool:
+        with self._lock:
+            return pdf_name in self._entries
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "resident": list(self._entries.keys()),
+            }
@@ -0,0 +1,479 @@
+# disk quota, LRU eviction and cold-index archiving for uploaded PDFs
+import os
+import time
+import shutil
+import sqlite3
+import tarfile
+import argparse
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+from tools.collection import CollectionRegistry
+from tools.memory import clear_conversation_memory
+from tools.segments import delete_store, fcntl, folder_lock
+from tools.uploads import ContentIndex, fork_store
+
+# Quota over uploads, indexes and archives; 0 disables enforcement (override via .env)
+STORAGE_QUOTA_MB = float(os.getenv("STORAGE_QUOTA_MB", "0"))
+# Indexes idle this long are compressed into the archive; 0 archives only to meet the quota
+STORAGE_ARCHIVE_AFTER_HOURS = float(os.getenv("STORAGE_ARCHIVE_AFTER_HOURS", "0"))
+# Let the quota archive LRU indexes before it evicts them
+STORAGE_ARCHIVE_ON_QUOTA = os.getenv("STORAGE_ARCHIVE_ON_QUOTA", "true").lower() == "true"
+# Documents used this recently are never archived or evicted
+STORAGE_MIN_IDLE_SECONDS = float(os.getenv("STORAGE_MIN_IDLE_SECONDS", "900"))
+STORAGE_CHECK_INTERVAL_SECONDS = float(os.getenv("STORAGE_CHECK_INTERVAL_SECONDS", "300"))
+STORAGE_CATALOG_PATH = os.getenv("STORAGE_CATALOG_PATH", "cache/storage.sqlite")
+STORAGE_ARCHIVE_DIR = os.getenv("STORAGE_ARCHIVE_DIR", "archive/")
+# Last-access writes per document are throttled to one per interval
+STORAGE_TOUCH_INTERVAL_SECONDS = 60
+
+TEMP_DIR = "temp/"
+VECTORSTORE_DIR = "vectorstore/"
+STORAGE_LOCK_FILE = ".storage.lock"
+
+
+def disk_usage(*paths: str) -> int:
+    """Bytes under `paths`; hard-linked files (deduplicated uploads) count once."""
+    seen, total = set(), 0
+    for path in paths:
+        if os.path.isfile(path):
+            walk = [(os.path.dirname(path), [], [os.path.basename(path)])]
+        else:
+            walk = os.walk(path)
+        for root, _, files in walk:
+            for name in files:
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue  # removed while walking
+                if (st.st_dev, st.st_ino) not in seen:
+                    seen.add((st.st_dev, st.st_ino))
+                    total += st.st_size
+    return total
+
+
+class StorageCatalog:
+    """SQLite table of uploaded PDFs with their sizes and last access, shared by worker processes."""
+
+    def __init__(self, path: str = STORAGE_CATALOG_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            " pdf TEXT PRIMARY KEY, pdf_bytes INTEGER NOT NULL, index_bytes INTEGER NOT NULL,"
+            " state TEXT NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def upsert(self, pdf: str, pdf_bytes: int, index_bytes: int, state: str, accessed: Optional[float] = None):
+        """Insert or refresh sizes; last access moves forward to `accessed` (a new row defaults to now)."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO documents (pdf, pdf_bytes, index_bytes, state, created, last_access)"
+                " VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(pdf) DO UPDATE SET"
+                " pdf_bytes = excluded.pdf_bytes, index_bytes = excluded.index_bytes, state = excluded.state,"
+                " last_access = MAX(documents.last_access, ?)",
+                (pdf, pdf_bytes, index_bytes, state, now, accessed or now, accessed or 0),
+            )
+            self._conn.commit()
+
+    def touch(self, pdf: str, when: float):
+        with self._lock:
+            self._conn.execute("UPDATE documents SET last_access = MAX(last_access, ?) WHERE pdf = ?", (when, pdf))
+            self._conn.commit()
+
+    def forget(self, pdf: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM documents WHERE pdf = ?", (pdf,))
+            self._conn.commit()
+
+    def set_state(self, pdf: str, state: str):
+        with self._lock:
+            self._conn.execute("UPDATE documents SET state = ? WHERE pdf = ?", (state, pdf))
+            self._conn.commit()
+
+    def state(self, pdf: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT state FROM documents WHERE pdf = ?", (pdf,)).fetchone()
+        return row[0] if row else None
+
+    def names(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT pdf FROM documents ORDER BY pdf")]
+
+    def rows(self) -> List[dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT pdf, pdf_bytes, index_bytes, state, created, last_access FROM documents ORDER BY last_access"
+            ).fetchall()
+        keys = ("pdf", "pdf_bytes", "index_bytes", "state", "created", "last_access")
+        return [dict(zip(keys, row)) for row in rows]
+
+
+class StorageManager:
+    """
+    Keeps the catalog of uploaded PDFs and holds temp/ + vectorstore/ + the
+    archive under the quota. Cold indexes are compressed into the archive and
+    restored on next access; when archiving is not enough, indexes are evicted
+    least recently used first. Uploads, supplements and history are kept, so
+    `rebuild(pdf_name)` re-ingests an evicted index on its next access.
+    `on_change(pdf_names)` is told about archived or evicted documents so
+    in-process caches can drop them.
+    """
+
+    def __init__(self, content_index: ContentIndex, temp_dir: str = TEMP_DIR, vectorstore_dir: str = VECTORSTORE_DIR,
+                 archive_dir: str = STORAGE_ARCHIVE_DIR, catalog: Optional[StorageCatalog] = None,
+                 quota_mb: float = STORAGE_QUOTA_MB, archive_after_hours: float = STORAGE_ARCHIVE_AFTER_HOURS,
+                 on_change: Optional[Callable[[List[str]], None]] = None,
+                 rebuild: Optional[Callable[[str], None]] = None):
+        self.content_index = content_index
+        self.temp_dir = temp_dir
+        self.vectorstore_dir = vectorstore_dir
+        self.archive_dir = archive_dir
+        self.catalog = catalog or StorageCatalog()
+        self.quota_bytes = int(quota_mb * 1024 * 1024)
+        self.archive_after = archive_after_hours * 3600
+        self.on_change = on_change
+        self.rebuild = rebuild
+        self._touched = {}  # pdf_name -> last access written by this process
+        self._rebuild_locks = {}
+        self._rebuild_guard = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        os.makedirs(archive_dir, exist_ok=True)
+
+    # Paths
+
+    def _stem(self, pdf_name: str) -> str:
+        return os.path.splitext(pdf_name)[0]
+
+    def index_path(self, pdf_name: str) -> str:
+        return os.path.join(self.vectorstore_dir, self._stem(pdf_name))
+
+    def archive_path(self, pdf_name: str) -> str:
+        return os.path.join(self.archive_dir, f"{self._stem(pdf_name)}.tar.gz")
+
+    def _supplements_path(self, pdf_name: str) -> str:
+        return os.path.join(self.temp_dir, "supplements", self._stem(pdf_name))
+
+    def _index_state(self, owner: str, owner_state: Optional[str] = None) -> str:
+        """active / archived / evicted (rebuilt on access) / missing (not ingested yet, or failed)."""
+        if os.path.isdir(self.index_path(owner)):
+            return "active"
+        if os.path.exists(self.archive_path(owner)):
+            return "archived"
+        return "evicted" if owner_state == "evicted" else "missing"
+
+    # Catalog upkeep
+
+    def record(self, pdf_name: str):
+        """Refresh one document's sizes and mark it used (after upload, ingestion or append)."""
+        pdf_path = os.path.join(self.temp_dir, pdf_name)
+        if not os.path.exists(pdf_path):
+            self.catalog.forget(pdf_name)
+            return
+        owner = self.content_index.resolve(pdf_name)
+        state = self._index_state(owner, self.catalog.state(owner))
+        index_bytes = disk_usage(self.archive_path(owner) if state == "archived" else self.index_path(owner))
+        self.catalog.upsert(pdf_name, disk_usage(pdf_path, self._supplements_path(pdf_name)), index_bytes, state,
+                            accessed=time.time())
+        self._touched[pdf_name] = time.time()
+
+    def touch(self, pdf_name: str):
+        now = time.time()
+        if now - self._touched.get(pdf_name, 0) >= STORAGE_TOUCH_INTERVAL_SECONDS:
+            self._touched[pdf_name] = now
+            self.catalog.touch(pdf_name, now)
+
+    def forget(self, pdf_name: str):
+        self.catalog.forget(pdf_name)
+        self._touched.pop(pdf_name, None)
+
+    def list_pdfs(self) -> List[str]:
+        return self.catalog.names()
+
+    def sync(self):
+        """Reconcile the catalog with the PDFs on disk and refresh every size."""
+        on_disk = {
+            name for name in os.listdir(self.temp_dir) if name.endswith(".pdf")
+        } if os.path.isdir(self.temp_dir) else set()
+        states = {row["pdf"]: row["state"] for row in self.catalog.rows()}
+        known = set(states)
+        for name in known - on_disk:
+            self.catalog.forget(name)
+        links = self.content_index.links()
+        for name in on_disk:
+            owner = links.get(name, name)
+            state = self._index_state(owner, states.get(owner))
+            pdf_path = os.path.join(self.temp_dir, name)
+            try:
+                mtime = os.path.getmtime(pdf_path)
+            except FileNotFoundError:
+                continue
+            index_bytes = disk_usage(self.archive_path(owner) if state == "archived" else self.index_path(owner))
+            # Rows seen for the first time start from the file's age; known rows keep their last access
+            self.catalog.upsert(name, disk_usage(pdf_path, self._supplements_path(name)), index_bytes, state,
+                                accessed=None if name in known else mtime)
+
+    def usage(self) -> int:
+        return disk_usage(self.temp_dir, self.vectorstore_dir, self.archive_dir)
+
+    # Archive / restore
+
+    def archive(self, owner: str) -> bool:
+        """Compress owner's index into the archive and remove the folder; False if there is none."""
+        folder, target = self.index_path(owner), self.archive_path(owner)
+        with folder_lock(self.archive_dir):
+            if not os.path.isdir(folder):
+                return False
+            with folder_lock(folder):
+                part = f"{target}.part"
+                with tarfile.open(part, "w:gz") as tar:
+                    tar.add(folder, arcname=".")
+                os.replace(part, target)
+                shutil.rmtree(folder, ignore_errors=True)  # open mmaps of the old files stay valid
+        print(f" Archived index of '{owner}' ({os.path.getsize(target)} bytes).")
+        return True
+
+    def restore(self, owner: str) -> bool:
+        """Bring owner's archived index back into vectorstore/; False if it was not archived."""
+        folder, source = self.index_path(owner), self.archive_path(owner)
+        if os.path.isdir(folder) or not os.path.exists(source):
+            return False
+        with folder_lock(self.archive_dir):
+            if os.path.isdir(folder) or not os.path.exists(source):
+                return False  # restored by another request or worker meanwhile
+            staging = f"{folder}.restoring"
+            shutil.rmtree(staging, ignore_errors=True)
+            with tarfile.open(source, "r:gz") as tar:
+                if hasattr(tarfile, "data_filter"):
+                    tar.extractall(staging, filter="data")
+                else:
+                    tar.extractall(staging)
+            os.rename(staging, folder)
+            os.remove(source)
+        print(f" Restored index of '{owner}' from the archive.")
+        return True
+
+    @contextmanager
+    def _rebuild_lock(self, owner: str):
+        """One rebuild per index across requests and worker processes."""
+        with self._rebuild_guard:
+            lock = self._rebuild_locks.setdefault(owner, threading.Lock())
+        with lock, open(os.path.join(self.archive_dir, f".{self._stem(owner)}.rebuild.lock"), "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def ensure_index(self, owner: str) -> bool:
+        """Restore owner's archived index or re-ingest an evicted one; False if nothing had to be done."""
+        if self.restore(owner):
+            return True
+        if self.rebuild is None or self.catalog.state(owner) != "evicted":
+            return False
+        with self._rebuild_lock(owner):
+            if self.catalog.state(owner) != "evicted" or os.path.isdir(self.index_path(owner)):
+                return False  # rebuilt by another request or worker meanwhile
+            print(f" Rebuilding evicted index of '{owner}'...")
+            self.rebuild(owner)
+            self.record(owner)
+        return True
+
+    def has_index(self, pdf_name: str) -> bool:
+        owner = self.content_index.resolve(pdf_name)
+        return self._index_state(owner, self.catalog.state(owner)) != "missing"
+
+    def evict(self, owner: str) -> bool:
+        """Delete owner's index (folder or archive) but keep the upload; False if there was none."""
+        folder, archived = self.index_path(owner), self.archive_path(owner)
+        with folder_lock(self.archive_dir):
+            if not os.path.isdir(folder) and not os.path.exists(archived):
+                return False
+            self.catalog.set_state(owner, "evicted")  # before the files go, so a reader rebuilds
+            if os.path.isdir(folder):
+                delete_store(folder)
+            if os.path.exists(archived):
+                os.remove(archived)
+        return True
+
+    # Removal
+
+    def release_index(self, pdf_name: str, keep: bool = False) -> Optional[str]:
+        """
+        Drop pdf_name's claim on its index before it is deleted or overwritten.
+        Other names linked to it inherit the folder (or archive); their name is returned.
+        With `keep` (overwrite), pdf_name keeps serving its old segments until the
+        re-ingest's commit replaces them, and an heir gets a copy instead.
+        """
+        other, linked = self.content_index.release(pdf_name)
+        if linked:
+            return None  # nothing on disk belongs to a link
+        archived = self.archive_path(pdf_name)
+        evicted = self.catalog.state(pdf_name) == "evicted"
+        self.catalog.set_state(pdf_name, "missing")  # new content must not be rebuilt from the old upload
+        if keep:
+            self.restore(pdf_name)  # an archived index is swapped like an active one
+            if other:
+                if evicted:
+                    self.catalog.set_state(other, "evicted")
+                fork_store(self.vectorstore_dir, pdf_name, other)
+            return other
+        if other:
+            if evicted:
+                self.catalog.set_state(other, "evicted")
+            fork_store(self.vectorstore_dir, pdf_name, other, move=True)
+            if os.path.exists(archived):
+                os.replace(archived, self.archive_path(other))
+            return other
+        self.discard_index(pdf_name)
+        return None
+
+    def discard_index(self, pdf_name: str):
+        """Delete pdf_name's own index folder and archive."""
+        if os.path.exists(self.index_path(pdf_name)):
+            delete_store(self.index_path(pdf_name))
+        if os.path.exists(self.archive_path(pdf_name)):
+            os.remove(self.archive_path(pdf_name))
+
+    def remove(self, pdf_name: str) -> Optional[str]:
+        """Delete an uploaded PDF with its index, supplements, history and catalog entry."""
+        pdf_path = os.path.join(self.temp_dir, pdf_name)
+        if os.path.exists(pdf_path):
+            os.remove(pdf_path)
+        heir = self.release_index(pdf_name)
+        shutil.rmtree(self._supplements_path(pdf_name), ignore_errors=True)
+        clear_conversation_memory(pdf_name)
+        CollectionRegistry().remove_pdf(pdf_name)
+        self.forget(pdf_name)
+        return heir
+
+    # Policy
+
+    def _groups(self) -> List[tuple]:
+        """(last access, index owner, [pdf names]) per index, least recently used first."""
+        groups: Dict[str, list] = {}
+        links = self.content_index.links()
+        for row in self.catalog.rows():
+            entry = groups.setdefault(links.get(row["pdf"], row["pdf"]), [0.0, []])
+            entry[0] = max(entry[0], row["last_access"])
+            entry[1].append(row["pdf"])
+        return sorted((last, owner, names) for owner, (last, names) in groups.items())
+
+    def enforce(self) -> dict:
+        """Archive cold indexes, then archive / evict LRU indexes until usage fits the quota."""
+        report = {"archived": [], "evicted": []}
+        now = time.time()
+        idle = [group for group in self._groups() if now - group[0] >= STORAGE_MIN_IDLE_SECONDS]
+
+        if self.archive_after > 0:
+            for last, owner, names in idle:
+                if now - last >= self.archive_after and self.archive(owner):
+                    report["archived"].append(owner)
+
+        usage = self.usage()
+        if self.quota_bytes > 0 and usage > self.quota_bytes and STORAGE_ARCHIVE_ON_QUOTA:
+            for _, owner, _ in idle:
+                if usage <= self.quota_bytes:
+                    break
+                if owner not in report["archived"] and self.archive(owner):
+                    report["archived"].append(owner)
+                    usage = self.usage()
+        if self.quota_bytes > 0 and usage > self.quota_bytes:
+            for _, owner, names in idle:
+                if usage <= self.quota_bytes:
+                    break
+                if self.evict(owner):
+                    report["evicted"] += names
+                    print(f" Evicted the index of {', '.join(names)} to stay under the storage quota.")
+                    usage = self.usage()
+            if usage > self.quota_bytes:
+                print(f" Storage still over quota ({usage} bytes) after evicting every idle index.")
+
+        changed = [name for _, owner, names in idle if owner in report["archived"] for name in names]
+        changed += report["evicted"]
+        if changed:
+            self.sync()
+            if self.on_change:
+                self.on_change(changed)
+        report["usage_bytes"] = usage
+        return report
+
+    def status(self) -> dict:
+        return {
+            "usage_bytes": self.usage(),
+            "quota_bytes": self.quota_bytes or None,
+            "documents": self.catalog.rows(),
+        }
+
+    # Background task
+
+    def start(self, interval: float = STORAGE_CHECK_INTERVAL_SECONDS):
+        if not self.catalog.names():
+            self.sync()  # first run: adopt what is already on disk
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(interval,), name="storage-manager", daemon=True)
+            self._thread.start()
+
+    def _run(self, interval: float):
+        while not self._stop.wait(interval):
+            self.run_once()
+
+    def run_once(self):
+        # With several worker processes only one of them enforces per round
+        with open(os.path.join(self.archive_dir, STORAGE_LOCK_FILE), "a") as f:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return
+            try:
+                self.sync()
+                self.enforce()
+            except Exception as e:
+                print(f" Storage check failed: {e}")
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def stop(self):
+        self._stop.set()
+
+
+#  python -m tools.storage status | enforce | archive <pdf> | restore <pdf> | evict <pdf>
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="StudyMate storage manager.")
+    parser.add_argument("command", choices=("status", "enforce", "archive", "restore", "evict"))
+    parser.add_argument("pdf_name", nargs="?", help="PDF to archive, restore or evict.")
+    args = parser.parse_args()
+
+    manager = StorageManager(ContentIndex())
+    manager.sync()
+    if args.command in ("archive", "restore", "evict"):
+        if not args.pdf_name:
+            parser.error(f"{args.command} needs a PDF name")
+        action = {"archive": manager.archive, "restore": manager.restore, "evict": manager.evict}[args.command]
+        done = action(manager.content_index.resolve(args.pdf_name))
+        if not done:
+            print(f" Nothing to {args.command} for '{args.pdf_name}'.")
+        manager.sync()
+    elif args.command == "enforce":
+        report = manager.enforce()
+        print(f" Archived {len(report['archived'])}, evicted {len(report['evicted'])}; "
+              f"{report['usage_bytes'] / 1024 / 1024:.1f} MB in use.")
+    else:
+        status = manager.status()
+        quota = f"{status['quota_bytes'] / 1024 / 1024:.1f} MB" if status["quota_bytes"] else "no quota"
+        print(f" {status['usage_bytes'] / 1024 / 1024:.1f} MB in use ({quota}).")
+        for row in status["documents"]:
+            idle_h = (time.time() - row["last_access"]) / 3600
+            print(f" {row['pdf']:<40} {row['state']:<9} pdf {row['pdf_bytes'] / 1024:9.0f} KB  "
+                  f"index {row['index_bytes'] / 1024:9.0f} KB  idle {idle_h:7.1f} h")
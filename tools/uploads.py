@@ -0,0 +1,202 @@
+# streamed uploads and content-hash dedup
+import os
+import json
+import shutil
+import hashlib
+import threading
+from typing import Optional, Tuple
+
+from tools.segments import folder_lock
+
+# Upload limits and dedup registry location (override via .env)
+MAX_UPLOAD_MB = float(os.getenv("MAX_UPLOAD_MB", "200"))
+MAX_UPLOAD_BYTES = int(MAX_UPLOAD_MB * 1024 * 1024)
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_KB", "1024")) * 1024
+CONTENT_INDEX_PATH = os.getenv("CONTENT_INDEX_PATH", "vectorstore/content_index.json")
+
+
+class UploadTooLargeError(Exception):
+    """Raised when an upload exceeds the configured size limit."""
+
+
+async def stream_to_disk(upload, dest_path: str, max_bytes: int = MAX_UPLOAD_BYTES) -> Tuple[str, int]:
+    """
+    Copy an UploadFile to dest_path chunk by chunk, hashing on the way.
+    Returns (sha256 hex, size); the partial file is removed on any error.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(dest_path, "wb") as out:
+            while True:
+                chunk = await upload.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLargeError(
+                        f"Upload exceeds the {max_bytes // (1024 * 1024)} MB limit."
+                    )
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        raise
+    return digest.hexdigest(), size
+
+
+def link_or_move(part_path: str, existing_path: str, dest_path: str):
+    """Make dest_path share existing_path's bytes (hard link) and drop the fresh copy."""
+    if os.path.exists(dest_path):
+        os.remove(dest_path)
+    try:
+        os.link(existing_path, dest_path)
+        os.remove(part_path)
+    except OSError:
+        os.replace(part_path, dest_path)  # no hard links here (or the original is gone): keep the copy
+
+
+class ContentIndex:
+    """
+    Maps the sha256 of every ingested PDF to the upload that owns its index,
+    plus the names linked to that owner. Persisted as one JSON file:
+    {"digests": {sha: {"pdf": owner, "size": n, "job": id}}, "links": {name: owner}}
+    """
+
+    def __init__(self, path: str = CONTENT_INDEX_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._cache = None  # (file identity, parsed registry), reused until the file is replaced
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def _locked(self):
+        # Same lock file the segment writers use, so other worker processes see one registry
+        return folder_lock(os.path.dirname(self.path) or ".")
+
+    def _read(self, for_update: bool = False) -> dict:
+        """Parsed registry, re-read only when the file changed; callers that mutate it pass for_update."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return {"digests": {}, "links": {}}
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if not for_update and self._cache is not None and self._cache[0] == key:
+            return self._cache[1]
+        with open(self.path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if not for_update:
+            self._cache = (key, data)
+        return data
+
+    def _write(self, data: dict):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, self.path)
+        st = os.stat(self.path)
+        self._cache = ((st.st_ino, st.st_mtime_ns, st.st_size), data)
+
+    def resolve(self, pdf_name: str) -> str:
+        """Name whose vectorstore serves pdf_name (itself unless it is a link)."""
+        with self._lock:
+            return self._read()["links"].get(pdf_name, pdf_name)
+
+    def claim(self, digest: str, pdf_name: str, size: int) -> Optional[dict]:
+        """
+        Register pdf_name as the owner of digest, unless another upload already
+        owns it: then pdf_name becomes a link and the owner's entry is returned.
+        """
+        with self._lock, self._locked():
+            data = self._read(for_update=True)
+            entry = data["digests"].get(digest)
+            if entry is not None and entry["pdf"] != pdf_name:
+                data["links"][pdf_name] = entry["pdf"]
+                self._write(data)
+                return dict(entry)
+            data["digests"][digest] = {"pdf": pdf_name, "size": size, "job": None}
+            self._write(data)
+            return None
+
+    def set_job(self, digest: str, job_id: str):
+        with self._lock, self._locked():
+            data = self._read(for_update=True)
+            if digest in data["digests"]:
+                data["digests"][digest]["job"] = job_id
+                self._write(data)
+
+    def forget(self, digest: str) -> list:
+        """Drop a digest whose ingestion failed; returns the names that were linked to it."""
+        with self._lock, self._locked():
+            data = self._read(for_update=True)
+            entry = data["digests"].pop(digest, None)
+            if entry is None:
+                return []
+            linked = [name for name, owner in data["links"].items() if owner == entry["pdf"]]
+            for name in linked:
+                del data["links"][name]
+            self._write(data)
+            return linked
+
+    def links(self) -> dict:
+        """Copy of {linked name: owner}, for resolving many names at once."""
+        with self._lock:
+            return dict(self._read()["links"])
+
+    def digest_of(self, pdf_name: str) -> Optional[str]:
+        """Digest of the content pdf_name serves (its owner's, for a link)."""
+        with self._lock:
+            data = self._read()
+            owner = data["links"].get(pdf_name, pdf_name)
+            return next((d for d, e in data["digests"].items() if e["pdf"] == owner), None)
+
+    def lookup(self, digest: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._read()["digests"].get(digest)
+        return dict(entry) if entry else None
+
+    def release(self, pdf_name: str) -> Tuple[Optional[str], bool]:
+        """
+        Take pdf_name out of the registry before its index is deleted or changed.
+        Returns (other, linked): `linked` is True when pdf_name only linked to
+        `other`'s index; otherwise `other` is the heir that now owns pdf_name's
+        index (None when no other name uses it).
+        """
+        with self._lock, self._locked():
+            data = self._read(for_update=True)
+            owner = data["links"].pop(pdf_name, None)
+            if owner is not None:
+                self._write(data)
+                return owner, True
+
+            digest = next((d for d, e in data["digests"].items() if e["pdf"] == pdf_name), None)
+            if digest is None:
+                return None, False
+            heirs = [name for name, owner in data["links"].items() if owner == pdf_name]
+            if not heirs:
+                del data["digests"][digest]
+                self._write(data)
+                return None, False
+            heir = heirs[0]
+            del data["links"][heir]
+            for name in heirs[1:]:
+                data["links"][name] = heir
+            data["digests"][digest]["pdf"] = heir
+            self._write(data)
+            return heir, False
+
+
+def fork_store(base_dir: str, src_pdf: str, dst_pdf: str, move: bool = False):
+    """Give dst_pdf its own copy of src_pdf's vectorstore folder (or take it over with move=True)."""
+    src = os.path.join(base_dir, os.path.splitext(src_pdf)[0])
+    dst = os.path.join(base_dir, os.path.splitext(dst_pdf)[0])
+    if not os.path.isdir(src):
+        return
+    with folder_lock(src):
+        if os.path.exists(dst):
+            shutil.rmtree(dst)
+        if move:
+            os.rename(src, dst)  # open mmaps of the old path stay valid
+        else:
+            shutil.copytree(src, dst)